@@ -231,20 +231,19 @@ def predict(samples):
     return prediction
 
 
-def analyzeFile(item):
+def analyzeFile(fpath: str):
     """Analyzes a file.
 
     Predicts the scores for the file and saves the results.
 
+    Worker processes get the config from utils.initWorker().
+
     Args:
-        item: Tuple containing (file path, config)
+        fpath: Path to the audio file.
 
     Returns:
         The `True` if the file was analyzed successfully.
     """
-    # Get file path and restore cfg
-    fpath: str = item[0]
-    cfg.set_config(item[1])
     results = {}
 
     # Start time
@@ -521,19 +520,14 @@ if __name__ == "__main__":
     # Set batch size
     cfg.BATCH_SIZE = max(1, int(args.batchsize))
 
-    # Add config items to each file list entry.
-    # We have to do this for Windows which does not
-    # support fork() and thus each process has to
-    # have its own config. USE LINUX!
-    flist = [(f, cfg.get_config()) for f in cfg.FILE_LIST]
-
-    # Analyze files
+    # Analyze files, workers get the config once from the pool initializer
     if cfg.CPU_THREADS < 2:
-        for entry in flist:
-            analyzeFile(entry)
+        for fpath in cfg.FILE_LIST:
+            analyzeFile(fpath)
     else:
-        with Pool(cfg.CPU_THREADS) as p:
-            p.map(analyzeFile, flist)
+        with Pool(cfg.CPU_THREADS, initializer=utils.initWorker, initargs=(cfg.get_config(),)) as p:
+            for _ in p.imap_unordered(analyzeFile, cfg.FILE_LIST, utils.getChunksize(len(cfg.FILE_LIST), cfg.CPU_THREADS)):
+                pass
 
     # A few examples to test
     # python3 analyze.py --i example/ --o example/ --slist example/ --min_conf 0.5 --threads 4
@@ -1,5 +1,8 @@
 """Module containing audio helper functions.
 """
+import functools
+import math
+
 import numpy as np
 
 import config as cfg
@@ -10,7 +13,9 @@ RANDOM = np.random.RandomState(cfg.RANDOM_SEED)
 def openAudioFile(path: str, sample_rate=cfg.SAMPLE_RATE, offset=0.0, duration=None):
     """Open an audio file.
 
-    Opens an audio file with librosa and the given settings.
+    Reads the file directly with soundfile and only resamples it if the native
+    sample rate differs from the given one. Formats soundfile cannot read are
+    opened with librosa.
 
     Args:
         path: Path to the audio file.
@@ -21,14 +26,524 @@ def openAudioFile(path: str, sample_rate=cfg.SAMPLE_RATE, offset=0.0, duration=N
     Returns:
         Returns the audio time series and the sampling rate.
     """
-    # Open file with librosa (uses ffmpeg or libav)
-    import librosa
+    import soundfile as sf
+
+    try:
+        info = sf.info(path)
+    except RuntimeError:
+        # Open file with librosa (uses ffmpeg or libav)
+        import librosa
+
+        sig, rate = librosa.load(path, sr=sample_rate, offset=offset, duration=duration, mono=True, res_type="kaiser_fast")
+
+        return sig, rate
 
-    sig, rate = librosa.load(path, sr=sample_rate, offset=offset, duration=duration, mono=True, res_type="kaiser_fast")
+    start = int(offset * info.samplerate)
+    stop = start + int(duration * info.samplerate) if duration is not None else None
+    sig, rate = sf.read(path, start=start, stop=stop, dtype="float32", always_2d=True)
+    sig = toMono(sig)
+
+    if sample_rate and rate != sample_rate:
+        sig = resample(sig, rate, sample_rate)
+        rate = sample_rate
 
     return sig, rate
 
 
+def getAudioFileLength(path: str):
+    """Returns the duration of an audio file without decoding it.
+
+    Args:
+        path: Path to the audio file.
+
+    Returns:
+        The duration in seconds.
+    """
+    import soundfile as sf
+
+    try:
+        return sf.info(path).duration
+    except RuntimeError:
+        import librosa
+
+        return librosa.get_duration(path=path)
+
+
+def openAudioStream(path: str, sample_rate=cfg.SAMPLE_RATE, block_seconds=30.0, offset=0.0, duration=None):
+    """Open an audio file for block-wise reading.
+
+    Decodes the file block by block with soundfile and resamples every block,
+    so only one block of the signal is held in memory at a time. Each block is
+    read with a few extra frames on both sides that are cut off after resampling,
+    which keeps the resampled blocks continuous at their borders.
+    Mono files at the target sample rate are read without any resampling.
+
+    With an offset or a duration only that time range is decoded, the reader
+    seeks to the start of the range instead of decoding the file up to there.
+
+    Formats soundfile cannot read are loaded as a whole with librosa and then
+    handed out block by block.
+
+    Args:
+        path: Path to the audio file.
+        sample_rate: The sample rate at which the file should be processed.
+        block_seconds: Duration of the decoded blocks in seconds.
+        offset: Start of the time range in seconds.
+        duration: Duration of the time range in seconds, `None` reads to the end of the file.
+
+    Returns:
+        A generator of consecutive mono signal blocks at the given sample rate
+        and the name of the decoder used for the file.
+    """
+    import soundfile as sf
+
+    try:
+        f = sf.SoundFile(path)
+    except RuntimeError:
+        sig, rate = openAudioFile(path, sample_rate, offset, duration)
+        blocks = (sig[i : i + int(block_seconds * rate)] for i in range(0, len(sig), int(block_seconds * rate)))
+
+        return blocks, "librosa"
+
+    if f.samplerate == sample_rate:
+        decoder = "native" if f.channels == 1 and f.subtype.startswith("PCM") else "soundfile"
+    else:
+        decoder = f"soundfile+{cfg.RESAMPLE_TYPE}"
+
+    start = int(round(offset * sample_rate))
+    stop = start + int(round(duration * sample_rate)) if duration is not None else None
+
+    return _readBlocks(f, sample_rate, block_seconds, start, stop), decoder
+
+
+def readAudioRanges(path: str, ranges, sample_rate=cfg.SAMPLE_RATE, max_gap=1.0):
+    """Reads sample ranges of an audio file.
+
+    Opens the file once and only decodes the requested ranges instead of the
+    whole file. The ranges are read in order of their start, ranges less than
+    `max_gap` seconds apart are read together, and only the decoded excerpts
+    are resampled.
+
+    Formats soundfile cannot read are loaded as a whole with librosa.
+
+    Args:
+        path: Path to the audio file.
+        ranges: List of (start, end) sample indices at the given sample rate.
+        sample_rate: The sample rate at which the file should be processed.
+        max_gap: Maximum gap in seconds between ranges that are read together.
+
+    Returns:
+        The signals of the ranges in the given order, cut off at the end of the file.
+    """
+    import soundfile as sf
+
+    try:
+        f = sf.SoundFile(path)
+    except RuntimeError:
+        sig, _ = openAudioFile(path, sample_rate)
+
+        return [sig[start:end] for start, end in ranges]
+
+    signals = [None] * len(ranges)
+    order = sorted(range(len(ranges)), key=lambda i: ranges[i][0])
+    groups = []
+
+    # Merge ranges that overlap or are close to each other
+    for i in order:
+        start, end = ranges[i]
+
+        if groups and start - groups[-1][1] <= max_gap * sample_rate:
+            groups[-1][1] = max(groups[-1][1], end)
+            groups[-1][2].append(i)
+        else:
+            groups.append([start, end, [i]])
+
+    with f:
+        for start, end, members in groups:
+            blocks = list(_readRange(f, sample_rate, 30.0, start, end))
+            sig = np.concatenate(blocks) if blocks else np.zeros(0, dtype="float32")
+
+            for i in members:
+                signals[i] = sig[ranges[i][0] - start : ranges[i][1] - start]
+
+    return signals
+
+
+def _readBlocks(f, sample_rate, block_seconds, start=0, stop=None, margin=4096):
+    """Reads and resamples an opened soundfile block by block and closes it.
+
+    Args:
+        f: The opened soundfile.
+        sample_rate: The target sample rate.
+        block_seconds: Duration of the decoded blocks in seconds.
+        start: Index of the first sample at the target sample rate.
+        stop: Index after the last sample at the target sample rate, `None` for the end of the file.
+        margin: Number of extra frames read on both sides of a block.
+
+    Returns:
+        A generator of consecutive mono signal blocks.
+    """
+    with f:
+        yield from _readRange(f, sample_rate, block_seconds, start, stop, margin)
+
+
+def _readRange(f, sample_rate, block_seconds, start=0, stop=None, margin=4096):
+    """Reads and resamples a range of an opened soundfile block by block.
+
+    Args:
+        f: The opened soundfile.
+        sample_rate: The target sample rate.
+        block_seconds: Duration of the decoded blocks in seconds.
+        start: Index of the first sample at the target sample rate.
+        stop: Index after the last sample at the target sample rate, `None` for the end of the file.
+        margin: Number of extra frames read on both sides of a block.
+
+    Returns:
+        A generator of consecutive mono signal blocks.
+    """
+    native_rate = f.samplerate
+    up = sample_rate // math.gcd(native_rate, sample_rate)
+    down = native_rate // math.gcd(native_rate, sample_rate)
+
+    # Align blocks and margins to the resampling period, so that every
+    # block starts on the output sample grid
+    block_frames = max(1, int(block_seconds * native_rate) // down) * down
+    margin = -(-margin // down) * down if native_rate != sample_rate else 0
+
+    # Start on the resampling period before the first sample and skip the samples up to it
+    pos = start // up * down
+    produced = start // up * up
+    skip = start - produced
+    last = f.frames if stop is None else min(f.frames, -(-stop * down // up))
+    remaining = None if stop is None else stop - start
+
+    while pos < last and remaining != 0:
+        # Read block plus margin on both sides
+        first = max(0, pos - margin)
+        end = min(last, pos + block_frames)
+        f.seek(first)
+        block = toMono(f.read(min(f.frames, end + margin) - first, dtype="float32", always_2d=True))
+
+        if native_rate == sample_rate:
+            block = block[pos - first : end - first]
+        else:
+            block = resample(block, native_rate, sample_rate)
+
+            # Cut off the margins, keep track of the total length to avoid rounding drift
+            n = -(-end * up // down) - produced
+            offset = (pos - first) // down * up
+            block = block[offset : offset + n]
+            produced += len(block)
+
+        # Trim to the requested range
+        if skip:
+            block, skip = block[skip:], max(0, skip - len(block))
+
+        if remaining is not None:
+            block = block[:remaining]
+            remaining -= len(block)
+
+        yield block
+
+        pos = end
+
+
+def toMono(sig):
+    """Mixes a (frames, channels) signal down to mono.
+
+    Args:
+        sig: The 2-D signal as read by soundfile.
+
+    Returns:
+        The mono signal, a view for single channel signals.
+    """
+    return sig[:, 0] if sig.shape[1] == 1 else sig.mean(axis=1)
+
+
+def resample(sig, rate, sample_rate, res_type=None):
+    """Resamples a signal.
+
+    Args:
+        sig: The signal to be resampled.
+        rate: The sampling rate of the signal.
+        sample_rate: The target sampling rate.
+        res_type: Name of the resampler in `RESAMPLERS`, defaults to cfg.RESAMPLE_TYPE.
+
+    Returns:
+        The resampled float32 signal.
+    """
+    return RESAMPLERS[res_type or cfg.RESAMPLE_TYPE](sig, rate, sample_rate).astype("float32", copy=False)
+
+
+def _resampleKaiser(sig, rate, sample_rate):
+    """Resamples with librosa's kaiser_fast filter."""
+    import librosa
+
+    return librosa.resample(sig, orig_sr=rate, target_sr=sample_rate, res_type="kaiser_fast")
+
+
+@functools.lru_cache(maxsize=None)
+def _polyphaseFilter(up: int, down: int):
+    """Designs the anti-aliasing filter used by scipy's resample_poly once per rate pair."""
+    from scipy.signal import firwin
+
+    max_rate = max(up, down)
+
+    return firwin(2 * 10 * max_rate + 1, 1.0 / max_rate, window=("kaiser", 5.0)).astype("float32")
+
+
+def _resamplePolyphase(sig, rate, sample_rate):
+    """Resamples with a polyphase filter and a cached filter design."""
+    from scipy.signal import resample_poly
+
+    g = math.gcd(rate, sample_rate)
+
+    return resample_poly(sig, sample_rate // g, rate // g, window=_polyphaseFilter(sample_rate // g, rate // g))
+
+
+# Available resamplers, selected with cfg.RESAMPLE_TYPE
+RESAMPLERS = {"kaiser_fast": _resampleKaiser, "polyphase": _resamplePolyphase}
+
+
+def splitSignalStream(blocks, rate, seconds, overlap, minlen, batch_size=1):
+    """Split a stream of signal blocks with overlap.
+
+    Produces the same splits as `splitSignal`, but only keeps the signal
+    needed for the next batch in memory. Batches are strided views into the
+    current block, only the padded batch at the end of the signal is copied.
+
+    Args:
+        blocks: Iterable of consecutive signal blocks.
+        rate: The sampling rate.
+        seconds: The duration of a segment.
+        overlap: The overlapping seconds of segments.
+        minlen: Minimum length of a split.
+        batch_size: Number of splits per yielded batch.
+
+    Returns:
+        A generator of 2-D arrays with up to `batch_size` splits each.
+    """
+    step = int((seconds - overlap) * rate)
+
+    if step <= 0:
+        return
+
+    buffer = np.zeros(0, dtype="float32")
+
+    for block in blocks:
+        buffer = np.concatenate((buffer, block))
+        chunks = chunkSignal(buffer, rate, seconds, overlap)
+
+        # Only yield full batches, the rest is carried over to the next block
+        n = len(chunks) // batch_size * batch_size
+
+        for i in range(0, n, batch_size):
+            yield chunks[i : i + batch_size]
+
+        buffer = buffer[n * step :]
+
+    # End of signal
+    chunks = chunkSignal(padSignal(buffer, rate, seconds, overlap, minlen), rate, seconds, overlap)
+
+    for i in range(0, len(chunks), batch_size):
+        yield chunks[i : i + batch_size]
+
+
+def chunkSignal(sig, rate, seconds, overlap):
+    """Split signal into overlapping chunks without copying.
+
+    Only chunks that lie completely inside the signal are returned.
+
+    Args:
+        sig: The original signal to be split.
+        rate: The sampling rate.
+        seconds: The duration of a segment.
+        overlap: The overlapping seconds of segments.
+
+    Returns:
+        A read-only 2-D view of shape (number of chunks, seconds * rate).
+    """
+    length = int(seconds * rate)
+    step = int((seconds - overlap) * rate)
+
+    if len(sig) < length:
+        return np.zeros((0, length), dtype=sig.dtype)
+
+    return np.lib.stride_tricks.sliding_window_view(sig, length)[::step]
+
+
+def detectActivity(chunks, rate, fmin, fmax, margin_db, frame_length=512):
+    """Finds chunks with short loud events in a frequency band.
+
+    Splits every chunk into frames and computes the energy of each frame in the
+    band from `fmin` to `fmax`. The median frame energy of a chunk serves as its
+    noise floor, a chunk is active if its loudest frame exceeds the floor by
+    more than `margin_db`. All chunks are processed at once.
+
+    Args:
+        chunks: 2-D array of chunks.
+        rate: The sampling rate.
+        fmin: Lower edge of the band in Hz.
+        fmax: Upper edge of the band in Hz.
+        margin_db: Minimum difference between loudest frame and floor in dB.
+        frame_length: Number of samples per frame.
+
+    Returns:
+        A boolean array with one entry per chunk.
+    """
+    chunks = np.asarray(chunks, dtype="float32")
+    n_frames = chunks.shape[1] // frame_length
+    frames = chunks[:, : n_frames * frame_length].reshape(len(chunks), n_frames, frame_length)
+
+    freqs = np.fft.rfftfreq(frame_length, 1.0 / rate)
+    band = (freqs >= fmin) & (freqs <= fmax)
+    spec = np.fft.rfft(frames * np.hanning(frame_length).astype("float32"), axis=-1)[..., band]
+
+    energy = 10.0 * np.log10((spec.real**2 + spec.imag**2).sum(axis=-1) + 1e-12)
+    floor = np.median(energy, axis=1)
+
+    return energy.max(axis=1) - floor > margin_db
+
+
+def loadNoiseProfile(path: str):
+    """Loads a noise profile recorded with `sox noiseprof`.
+
+    Args:
+        path: Path to the .prof file.
+
+    Returns:
+        The mean natural log power of the noise per bin of a 2048 point DFT for channel 0.
+    """
+    with open(path, "r") as f:
+        for line in f:
+            if line.startswith("Channel 0:"):
+                return np.array([float(v) for v in line.split(":", 1)[1].split(",")], dtype="float32")
+
+    raise ValueError(f"No noise profile for channel 0 in {path}")
+
+
+@functools.lru_cache(maxsize=None)
+def getNoiseFloor(path: str, n_fft: int):
+    """Returns the noise floor of a profile for a DFT size.
+
+    The profile is loaded once per process. Its bins are interpolated to the
+    bins of the DFT, which are assumed to span the same frequency range, and
+    the power is scaled with the energy of a Hann window of that size.
+
+    Args:
+        path: Path to the .prof file.
+        n_fft: The DFT size.
+
+    Returns:
+        The noise power per bin of an `n_fft` point DFT of a Hann-windowed signal in [-1, 1].
+    """
+    profile = np.exp(loadNoiseProfile(path).astype("float64"))
+    power = np.interp(np.linspace(0.0, 1.0, n_fft // 2 + 1), np.linspace(0.0, 1.0, len(profile)), profile)
+
+    return (power * n_fft / (2 * (len(profile) - 1))).astype("float32")
+
+
+def spectralGate(spec, floor, level=0.5, floor_gain=0.1):
+    """Attenuates the bins of an STFT that do not rise above the noise floor.
+
+    A bin passes if its power exceeds the floor by more than `level` * 12 dB.
+    The pass mask is widened by one frame on both sides, so the onsets and
+    tails of calls are kept. All other bins are attenuated by `floor_gain`.
+
+    Args:
+        spec: Complex STFT of shape (..., frames, bins).
+        floor: The noise power per bin, see getNoiseFloor().
+        level: The sensitivity of the gate in [0, 1].
+        floor_gain: The gain of the gated bins.
+
+    Returns:
+        The gated STFT.
+    """
+    power = spec.real**2 + spec.imag**2
+    mask = power > floor * 10.0 ** (1.2 * level)
+
+    # Widen the mask in time
+    mask[..., 1:, :] |= mask[..., :-1, :].copy()
+    mask[..., :-1, :] |= mask[..., 1:, :].copy()
+
+    return spec * np.where(mask, np.float32(1.0), np.float32(floor_gain))
+
+
+def reduceNoise(sig, profile_path: str, level=0.5, n_fft=2048):
+    """Removes the noise of a microphone profile from signals.
+
+    Gates the STFT of the signals with the noise floor of the profile and
+    resynthesizes them by overlap-add of Hann windows with 75 % overlap.
+
+    Args:
+        sig: A signal or a 2-D array of signals, e.g. chunks.
+        profile_path: Path to the .prof file.
+        level: The sensitivity of the gate, see spectralGate().
+        n_fft: The DFT size.
+
+    Returns:
+        The denoised float32 signals in the shape of `sig`.
+    """
+    sig = np.asarray(sig, dtype="float32")
+    signals = np.atleast_2d(sig)
+    hop = n_fft // 4
+    length = signals.shape[1]
+    window = np.hanning(n_fft + 1)[:-1].astype("float32")
+
+    padded = np.pad(signals, ((0, 0), (n_fft // 2, n_fft // 2 + hop)))
+    frames = np.lib.stride_tricks.sliding_window_view(padded, n_fft, axis=1)[:, ::hop]
+    spec = spectralGate(np.fft.rfft(frames * window, axis=-1), getNoiseFloor(profile_path, n_fft), level)
+    frames = np.fft.irfft(spec, n=n_fft, axis=-1).astype("float32") * window
+
+    # Overlap-add, the frames of every phase do not overlap each other
+    out = np.zeros((len(signals), padded.shape[1] + n_fft), dtype="float32")
+    norm = np.zeros(padded.shape[1] + n_fft, dtype="float32")
+
+    for phase in range(n_fft // hop):
+        phase_frames = frames[:, phase :: n_fft // hop]
+        size = phase_frames.shape[1] * n_fft
+        out[:, phase * hop : phase * hop + size] += phase_frames.reshape(len(signals), -1)
+        norm[phase * hop : phase * hop + size] += np.tile(window**2, phase_frames.shape[1])
+
+    out = out[:, n_fft // 2 : n_fft // 2 + length] / np.maximum(norm[n_fft // 2 : n_fft // 2 + length], 1e-6)
+
+    return out.reshape(sig.shape)
+
+
+def padSignal(sig, rate, seconds, overlap, minlen):
+    """Pad the end of a signal with noise.
+
+    Pads the signal so that the last split which is at least `minlen` long
+    becomes a complete chunk, the same way `splitSignal` pads its last splits.
+
+    Args:
+        sig: The end of the signal.
+        rate: The sampling rate.
+        seconds: The duration of a segment.
+        overlap: The overlapping seconds of segments.
+        minlen: Minimum length of a split.
+
+    Returns:
+        The padded signal or the signal itself if no padding is needed.
+    """
+    length = int(seconds * rate)
+    step = int((seconds - overlap) * rate)
+
+    # Start of the last split that is long enough
+    last = -1
+
+    for i in range(0, len(sig), step):
+        if len(sig) - i < int(minlen * rate):
+            break
+
+        last = i
+
+    if last < 0 or last + length <= len(sig):
+        return sig
+
+    return np.hstack((sig, noise(sig[last:], (last + length - len(sig)), 0.5)))
+
+
 def saveSignal(sig, fname: str):
     """Saves a signal to file.
 
@@ -1,20 +1,31 @@
 """Module to analyze audio samples.
 """
 import argparse
+import collections
+import contextlib
 import datetime
+import functools
+import glob
 import json
-import operator
+import math
 import os
+import pathlib
+import queue
 import sys
-from multiprocessing import Pool, freeze_support
+import time
+from multiprocessing import Pool, Process, Queue, freeze_support
 import numpy as np
 import audio
+import batchspec
+import columnar
 import config as cfg
+import detection_db
+import embedding_cache
+import manifest
 import model
+import segments
 import species
 import utils
-import subprocess
-import pathlib
 
 
 def load_codes():
@@ -26,10 +37,66 @@ def load_codes():
         codes = json.load(cfile)
     return codes
 
-def save_result_file(r: dict[str, list], path: str, afile_path: str):
+# Output strings per label, see get_label_table()
+LABEL_TABLE = None
+
+
+def get_label_table():
+    """Precomputes the output strings for every label.
+    The table is built once per process and rebuilt when the labels change.
+    Returns:
+        A dictionary with lists of "scientific", "common", "code" and "audacity" names
+        in label index order and the boolean "species_mask" of the species list.
+    """
+    global LABEL_TABLE
+
+    key = (tuple(cfg.LABELS), tuple(cfg.TRANSLATED_LABELS), tuple(cfg.SPECIES_LIST), len(cfg.CODES))
+
+    if LABEL_TABLE is None or LABEL_TABLE["key"] != key:
+        species_list = set(cfg.SPECIES_LIST)
+        LABEL_TABLE = {
+            "key": key,
+            "scientific": [label.split("_", 1)[0] for label in cfg.TRANSLATED_LABELS],
+            "common": [label.split("_", 1)[-1] for label in cfg.TRANSLATED_LABELS],
+            "code": [cfg.CODES[label] if label in cfg.CODES else label for label in cfg.LABELS],
+            "audacity": [label.replace("_", ", ") for label in cfg.TRANSLATED_LABELS],
+            "species_mask": np.array([not species_list or label in species_list for label in cfg.LABELS]),
+        }
+
+    return LABEL_TABLE
+
+
+def extract_detections(prediction, first_chunk=0):
+    """Extracts the detections from a prediction matrix.
+    Keeps the scores above cfg.MIN_CONFIDENCE for labels in the species list
+    and, if cfg.TOP_K is set, only the k best labels of every chunk.
+    Args:
+        prediction: The scores of shape (number of chunks, number of labels).
+        first_chunk: Index of the first chunk in the prediction.
+    Returns:
+        The (chunk index, label index, score) arrays of the detections,
+        sorted by chunk and descending score.
+    """
+    prediction = np.asarray(prediction)
+    mask = (prediction > cfg.MIN_CONFIDENCE) & get_label_table()["species_mask"]
+
+    if 0 < cfg.TOP_K < prediction.shape[1]:
+        top_k = np.argpartition(prediction, -cfg.TOP_K, axis=1)[:, -cfg.TOP_K:]
+        top_k_mask = np.zeros_like(mask)
+        np.put_along_axis(top_k_mask, top_k, True, axis=1)
+        mask &= top_k_mask
+
+    chunk_idx, label_idx = np.nonzero(mask)
+    scores = prediction[chunk_idx, label_idx]
+    order = np.lexsort((label_idx, -scores, chunk_idx))
+
+    return chunk_idx[order] + first_chunk, label_idx[order], scores[order]
+
+
+def save_result_file(r: tuple[list, tuple], path: str, afile_path: str):
     """Saves the results to the hard drive.
     Args:
-        r: The dictionary with {segment: scores}.
+        r: The results as ([(start, end) per chunk], (chunk index, label index, score)).
         path: The path where the result should be saved.
         afile_path: The path to audio file.
     """
@@ -37,6 +104,9 @@ def save_result_file(r: dict[str, list], path: str, afile_path: str):
     if os.path.dirname(path):
         os.makedirs(os.path.dirname(path), exist_ok=True)
 
+    timestamps, detections = r
+    labels = get_label_table()
+
     # Selection table
     out_string = ""
 
@@ -47,39 +117,24 @@ def save_result_file(r: dict[str, list], path: str, afile_path: str):
         # Write header
         out_string += header
 
-        # Extract valid predictions for every timestamp
-        for timestamp in get_sorted_timestamps(r):
-            rstring = ""
-            start, end = timestamp.split("-", 1)
-
-            for c in r[timestamp]:
-                if c[1] > cfg.MIN_CONFIDENCE and (not cfg.SPECIES_LIST or c[0] in cfg.SPECIES_LIST):
-                    selection_id += 1
-                    label = cfg.TRANSLATED_LABELS[cfg.LABELS.index(c[0])]
-                    rstring += "{}\tSpectrogram 1\t1\t{}\t{}\t{}\t{}\t{:.4f}\n".format(
-                        selection_id,
-                        start,
-                        end,
-                        cfg.CODES[c[0]] if c[0] in cfg.CODES else c[0],
-                        label.split("_", 1)[-1],
-                        c[1],
-                    )
-
-            # Write result string to file
-            out_string += rstring
+        # Write every detection
+        for chunk, label, score in zip(*detections):
+            start, end = timestamps[chunk]
+            selection_id += 1
+            out_string += "{}\tSpectrogram 1\t1\t{}\t{}\t{}\t{}\t{:.4f}\n".format(
+                selection_id,
+                start,
+                end,
+                labels["code"][label],
+                labels["common"][label],
+                score,
+            )
 
     elif cfg.RESULT_TYPE == "audacity":
         # Audacity timeline labels
-        for timestamp in get_sorted_timestamps(r):
-            rstring = ""
-
-            for c in r[timestamp]:
-                if c[1] > cfg.MIN_CONFIDENCE and (not cfg.SPECIES_LIST or c[0] in cfg.SPECIES_LIST):
-                    label = cfg.TRANSLATED_LABELS[cfg.LABELS.index(c[0])]
-                    rstring += "{}\t{}\t{:.4f}\n".format(timestamp.replace("-", "\t"), label.replace("_", ", "), c[1])
-
-            # Write result string to file
-            out_string += rstring
+        for chunk, label, score in zip(*detections):
+            start, end = timestamps[chunk]
+            out_string += "{}\t{}\t{}\t{:.4f}\n".format(start, end, labels["audacity"][label], score)
 
     elif cfg.RESULT_TYPE == "r":
         # Output format for R
@@ -87,32 +142,24 @@ def save_result_file(r: dict[str, list], path: str, afile_path: str):
                   "overlap,sensitivity,min_conf,species_list,model")
         out_string += header
 
-        for timestamp in get_sorted_timestamps(r):
-            rstring = ""
-            start, end = timestamp.split("-", 1)
-
-            for c in r[timestamp]:
-                if c[1] > cfg.MIN_CONFIDENCE and (not cfg.SPECIES_LIST or c[0] in cfg.SPECIES_LIST):
-                    label = cfg.TRANSLATED_LABELS[cfg.LABELS.index(c[0])]
-                    rstring += "\n{},{},{},{},{},{:.4f},{:.4f},{:.4f},{},{},{},{},{},{}".format(
-                        afile_path,
-                        start,
-                        end,
-                        label.split("_", 1)[0],
-                        label.split("_", 1)[-1],
-                        c[1],
-                        cfg.LATITUDE,
-                        cfg.LONGITUDE,
-                        cfg.WEEK,
-                        cfg.SIG_OVERLAP,
-                        (1.0 - cfg.SIGMOID_SENSITIVITY) + 1.0,
-                        cfg.MIN_CONFIDENCE,
-                        cfg.SPECIES_LIST_FILE,
-                        os.path.basename(cfg.MODEL_PATH),
-                    )
-
-            # Write result string to file
-            out_string += rstring
+        for chunk, label, score in zip(*detections):
+            start, end = timestamps[chunk]
+            out_string += "\n{},{},{},{},{},{:.4f},{:.4f},{:.4f},{},{},{},{},{},{}".format(
+                afile_path,
+                start,
+                end,
+                labels["scientific"][label],
+                labels["common"][label],
+                score,
+                cfg.LATITUDE,
+                cfg.LONGITUDE,
+                cfg.WEEK,
+                cfg.SIG_OVERLAP,
+                (1.0 - cfg.SIGMOID_SENSITIVITY) + 1.0,
+                cfg.MIN_CONFIDENCE,
+                cfg.SPECIES_LIST_FILE,
+                os.path.basename(cfg.MODEL_PATH),
+            )
 
     elif cfg.RESULT_TYPE == "kaleidoscope":
         # Output format for kaleidoscope
@@ -123,31 +170,23 @@ def save_result_file(r: dict[str, list], path: str, afile_path: str):
         folder_path, filename = os.path.split(afile_path)
         parent_folder, folder_name = os.path.split(folder_path)
 
-        for timestamp in get_sorted_timestamps(r):
-            rstring = ""
-            start, end = timestamp.split("-", 1)
-
-            for c in r[timestamp]:
-                if c[1] > cfg.MIN_CONFIDENCE and (not cfg.SPECIES_LIST or c[0] in cfg.SPECIES_LIST):
-                    label = cfg.TRANSLATED_LABELS[cfg.LABELS.index(c[0])]
-                    rstring += "\n{},{},{},{},{},{},{},{:.4f},{:.4f},{:.4f},{},{},{}".format(
-                        parent_folder.rstrip("/"),
-                        folder_name,
-                        filename,
-                        start,
-                        float(end) - float(start),
-                        label.split("_", 1)[0],
-                        label.split("_", 1)[-1],
-                        c[1],
-                        cfg.LATITUDE,
-                        cfg.LONGITUDE,
-                        cfg.WEEK,
-                        cfg.SIG_OVERLAP,
-                        (1.0 - cfg.SIGMOID_SENSITIVITY) + 1.0,
-                    )
-
-            # Write result string to file
-            out_string += rstring
+        for chunk, label, score in zip(*detections):
+            start, end = timestamps[chunk]
+            out_string += "\n{},{},{},{},{},{},{},{:.4f},{:.4f},{:.4f},{},{},{}".format(
+                parent_folder.rstrip("/"),
+                folder_name,
+                filename,
+                start,
+                float(end) - float(start),
+                labels["scientific"][label],
+                labels["common"][label],
+                score,
+                cfg.LATITUDE,
+                cfg.LONGITUDE,
+                cfg.WEEK,
+                cfg.SIG_OVERLAP,
+                (1.0 - cfg.SIGMOID_SENSITIVITY) + 1.0,
+            )
 
     else:
         # CSV output file
@@ -156,23 +195,13 @@ def save_result_file(r: dict[str, list], path: str, afile_path: str):
         # Write header
         out_string += header
 
-        for timestamp in get_sorted_timestamps(r):
-            rstring = ""
-
-            for c in r[timestamp]:
-                start, end = timestamp.split("-", 1)
-
-                if c[1] > cfg.MIN_CONFIDENCE and (not cfg.SPECIES_LIST or c[0] in cfg.SPECIES_LIST):
-                    label = cfg.TRANSLATED_LABELS[cfg.LABELS.index(c[0])]
-                    rstring += "{},{},{},{},{:.4f}\n".format(start, end, label.split("_", 1)[0],
-                                                             label.split("_", 1)[-1], c[1])
+        for chunk, label, score in zip(*detections):
+            start, end = timestamps[chunk]
+            out_string += "{},{},{},{},{:.4f}\n".format(start, end, labels["scientific"][label],
+                                                        labels["common"][label], score)
 
-            # Write result string to file
-            out_string += rstring
-
-    # Save as file
-    with open(path, "w", encoding="utf-8") as rfile:
-        rfile.write(out_string)
+    # Save as file, a crash never leaves a partly written result
+    utils.writeFileAtomic(path, out_string)
     return out_string
 
 
@@ -186,24 +215,62 @@ def get_sorted_timestamps(results: dict[str, list]):
     return sorted(results, key=lambda t: float(t.split("-", 1)[0]))
 
 
-def get_raw_audio_from_file(fpath: str):
+def get_raw_audio_from_file(fpath: str, first_chunk: int = 0, n_chunks: int = None):
     """Reads an audio file.
-    Reads the file and splits the signal into chunks.
+    Opens the file as a stream and splits the signal into chunks.
+    With first_chunk or n_chunks only the time range of those chunks is read.
     Args:
         fpath: Path to the audio file.
+        first_chunk: Index of the first chunk to read.
+        n_chunks: Number of chunks to read, `None` reads to the end of the file.
     Returns:
-        The signal split into a list of chunks.
+        A generator of batches with up to cfg.BATCH_SIZE chunks and the name of the decoder.
     """
+    step = int((cfg.SIG_LENGTH - cfg.SIG_OVERLAP) * cfg.SAMPLE_RATE)
+    offset = first_chunk * step / cfg.SAMPLE_RATE
+    duration = None
+
+    if n_chunks is not None:
+        duration = ((n_chunks - 1) * step + int(cfg.SIG_LENGTH * cfg.SAMPLE_RATE)) / cfg.SAMPLE_RATE
+
     # Open file
-    sig, rate = audio.openAudioFile(fpath, cfg.SAMPLE_RATE)
+    blocks, decoder = audio.openAudioStream(fpath, cfg.SAMPLE_RATE, offset=offset, duration=duration)
 
-    # Split into raw audio chunks
-    chunks = audio.splitSignal(sig, rate, cfg.SIG_LENGTH, cfg.SIG_OVERLAP, cfg.SIG_MINLEN)
+    # Split into batches of raw audio chunks
+    batches = audio.splitSignalStream(blocks, cfg.SAMPLE_RATE, cfg.SIG_LENGTH, cfg.SIG_OVERLAP, cfg.SIG_MINLEN,
+                                      cfg.BATCH_SIZE)
 
-    return chunks
+    if n_chunks is not None:
+        batches = take_chunks(batches, n_chunks)
 
+    # Remove the microphone noise from every chunk before inference
+    if cfg.NOISE_PROFILE:
+        batches = (audio.reduceNoise(chunks, cfg.NOISE_PROFILE, cfg.NOISE_LEVEL) for chunks in batches)
 
-def predict(samples):
+    return batches, decoder
+
+
+def take_chunks(batches, n_chunks: int):
+    """Limits batches of chunks to a number of chunks.
+    Args:
+        batches: Iterable of batches.
+        n_chunks: Number of chunks to keep.
+    Returns:
+        A generator of the batches, the last one shortened if needed.
+    """
+    for chunks in batches:
+        if n_chunks <= 0:
+            return
+
+        yield chunks[:n_chunks]
+        n_chunks -= len(chunks)
+
+
+# Per-process counters of the ultrasonic pre-screen, see predict()
+PRESCREEN_STATS = {"chunks": 0, "skipped": 0, "screen_time": 0.0, "predicted": 0, "predict_time": 0.0}
+
+
+def predict_chunks(samples):
     """Predicts the classes for the given samples.
 
     Args:
@@ -212,137 +279,900 @@ def predict(samples):
     Returns:
         The prediction scores.
     """
-    # Prepare sample and pass through model
-    data = np.array(samples, dtype="float32")
-    prediction = model.predict(data)
+    # Pass the batch of chunks through model, all heads share one embedding pass
+    if cfg.HEADS:
+        prediction = np.concatenate(model.predictWithHeads(samples, [head["classifier"] for head in cfg.HEADS]), axis=1)
+    else:
+        prediction = model.predict(samples)
+
+    return get_scores(prediction)
+
+
+def predict_features(features):
+    """Predicts the classes for precomputed embeddings.
+
+    Args:
+        features: Embeddings of the chunks, e.g. from the embedding cache.
+
+    Returns:
+        The prediction scores.
+    """
+    if cfg.HEADS:
+        prediction = np.concatenate(model.classifyWithHeads(features, [head["classifier"] for head in cfg.HEADS]), axis=1)
+    else:
+        prediction = model.classify(features)
+
+    return get_scores(prediction)
+
+
+def get_scores(prediction):
+    """Converts the output of the classifiers to scores.
+
+    Args:
+        prediction: The logits.
 
+    Returns:
+        The sigmoid activations if cfg.APPLY_SIGMOID is set, otherwise the logits.
+    """
     # Logits or sigmoid activations?
     if cfg.APPLY_SIGMOID:
-        prediction = model.flat_sigmoid(np.array(prediction), sensitivity=-cfg.SIGMOID_SENSITIVITY)
+        prediction = np.array(prediction)
+        model.flat_sigmoid(prediction, sensitivity=-cfg.SIGMOID_SENSITIVITY, out=prediction)
 
     return prediction
 
 
-def analyze_file(item):
-    """Analyzes a file.
+def get_cached_features(fpath: str, block_size: int = 4096):
+    """Reads the embeddings of a file from the embedding cache.
+
+    Embeddings that are not cached yet are computed for all chunks and stored,
+    the pre-screen is not applied to them.
+    Args:
+        fpath: Path to the audio file.
+        block_size: Number of chunks per returned block.
+    Returns:
+        A generator of float32 embedding blocks in chunk order and the name of the decoder,
+        "embedding cache" if the embeddings were cached.
+    """
+    decoder = "embedding cache"
+
+    def compute():
+        nonlocal decoder
+        batches, decoder = get_raw_audio_from_file(fpath)
+        features = [model.embeddings(samples) for samples in batches]
+
+        return np.concatenate(features) if features else np.zeros((0, 0), dtype="float32")
+
+    features = embedding_cache.get_embeddings(fpath, compute)
+
+    # Cached embeddings are memory-mapped, only one block at a time is read and upcast
+    blocks = (np.asarray(features[i : i + block_size], dtype="float32") for i in range(0, len(features), block_size))
+
+    return blocks, decoder
 
-    Predicts the scores for the file and saves the results.
+
+def predict(samples):
+    """Predicts the classes for the given samples.
+
+    If cfg.PRESCREEN_DB is set, only chunks with ultrasonic activity are passed
+    to the model, all other chunks get a score of 0 for every label.
 
     Args:
-        item: Tuple containing (file path, config)
+        samples: Samples to be predicted.
 
     Returns:
-        The `True` if the file was analyzed successfully.
+        The prediction scores, in multi-head mode the scores of all heads side by side.
     """
-    # Get file path and restore cfg
-    fpath: str = item[0]
-    cfg.set_config(item[1])
+    if cfg.PRESCREEN_DB <= 0:
+        return predict_chunks(samples)
 
-    # Start time
-    start_time = datetime.datetime.now()
+    samples = np.asarray(samples)
+    start = time.perf_counter()
+    active = audio.detectActivity(samples, cfg.SAMPLE_RATE, cfg.PRESCREEN_FMIN, cfg.PRESCREEN_FMAX, cfg.PRESCREEN_DB)
+    PRESCREEN_STATS["screen_time"] += time.perf_counter() - start
+    PRESCREEN_STATS["chunks"] += len(samples)
+    PRESCREEN_STATS["skipped"] += int(len(samples) - active.sum())
 
-    # Status
-    print(f"Analyzing {fpath}", flush=True)
+    n_labels = sum(len(head["labels"]) for head in cfg.HEADS) if cfg.HEADS else len(cfg.LABELS)
+    prediction = np.zeros((len(samples), n_labels), dtype="float32")
+
+    if active.any():
+        start = time.perf_counter()
+        prediction[active] = predict_chunks(samples[active])
+        PRESCREEN_STATS["predict_time"] += time.perf_counter() - start
+        PRESCREEN_STATS["predicted"] += int(active.sum())
+
+    return prediction
+
+
+def get_prescreen_summary(stats: dict = None):
+    """Summarizes the pre-screen counters.
+    The speed-up is estimated from the measured time per predicted chunk.
+    Args:
+        stats: The counters, defaults to the counters of this process.
+    Returns:
+        A line with the number of skipped chunks and the estimated speed-up.
+    """
+    stats = stats or PRESCREEN_STATS
+    summary = "Pre-screen skipped {} of {} chunks".format(stats["skipped"], stats["chunks"])
+
+    if stats["predicted"]:
+        time_per_chunk = stats["predict_time"] / stats["predicted"]
+        elapsed = stats["screen_time"] + stats["predict_time"]
+        summary += ", estimated speed-up {:.2f}x".format(time_per_chunk * stats["chunks"] / elapsed)
+
+    return summary
+
+
+def collect_results(predictions, first_chunk: int = 0):
+    """Extracts the detections of all chunks and their timestamps.
+    Args:
+        predictions: Iterable of prediction batches in chunk order.
+        first_chunk: Index of the first chunk in the file, for the timestamps of time ranges.
+    Returns:
+        The results as ([(start, end) per chunk], (chunk index, label index, score)).
+    """
+    step = cfg.SIG_LENGTH - cfg.SIG_OVERLAP
+    timestamps = []
+    detections = []
+
+    for prediction in predictions:
+        detections.append(extract_detections(prediction, len(timestamps)))
+
+        # Computed from the chunk index, so time ranges give the same timestamps as whole files,
+        # rounded so that float errors do not show in the result files
+        for i in range(first_chunk + len(timestamps), first_chunk + len(timestamps) + len(prediction)):
+            start = round(i * step, 6) if i else 0
+            timestamps.append((str(start), str(round(start + cfg.SIG_LENGTH, 6))))
+
+    if not detections:
+        detections.append(extract_detections(np.zeros((0, len(cfg.LABELS)))))
+
+    return timestamps, tuple(np.concatenate(d) for d in zip(*detections))
+
+
+@contextlib.contextmanager
+def use_head(head: dict):
+    """Switches the labels and the classifier to those of a head.
+    Args:
+        head: One of cfg.HEADS or `None` to keep the current settings.
+    """
+    if head is None:
+        yield
+        return
+
+    previous = cfg.CUSTOM_CLASSIFIER, cfg.LABELS, cfg.TRANSLATED_LABELS
+    cfg.CUSTOM_CLASSIFIER, cfg.LABELS, cfg.TRANSLATED_LABELS = head["classifier"], head["labels"], head["translated_labels"]
 
     try:
-        # Open audio file and split into 3-second chunks
-        chunks = get_raw_audio_from_file(fpath)
+        yield
+    finally:
+        cfg.CUSTOM_CLASSIFIER, cfg.LABELS, cfg.TRANSLATED_LABELS = previous
+
+
+def get_head_names():
+    """Returns the names of the heads.
+    Returns:
+        The names of cfg.HEADS or [None] without multi-head mode.
+    """
+    return [head["name"] for head in cfg.HEADS] or [None]
+
+
+def collect_head_results(predictions, first_chunk: int = 0):
+    """Extracts the detections of all chunks for every head.
+    Args:
+        predictions: Iterable of prediction batches in chunk order.
+        first_chunk: Index of the first chunk in the file, see collect_results().
+    Returns:
+        A dictionary {head name: results}, with the single entry `None` without cfg.HEADS.
+    """
+    if not cfg.HEADS:
+        return {None: collect_results(predictions, first_chunk)}
+
+    predictions = list(predictions)
+    results = {}
+    offset = 0
+
+    for head in cfg.HEADS:
+        n_labels = len(head["labels"])
+
+        with use_head(head):
+            results[head["name"]] = collect_results((p[:, offset : offset + n_labels] for p in predictions), first_chunk)
+
+        offset += n_labels
+
+    return results
+
+
+def get_result_path(fpath: str, head_name: str = None):
+    """Returns the path of the result file for an audio file.
+    Args:
+        fpath: Path to the audio file.
+        head_name: Name of the head in multi-head mode, added to the file name.
+    Returns:
+        The path of the result file, cfg.OUTPUT_PATH if it is a file.
+    """
+    # We have to check if output path is a file or directory
+    if not cfg.OUTPUT_PATH.rsplit(".", 1)[-1].lower() in ["txt", "csv"]:
+        rpath = fpath.replace(cfg.INPUT_PATH, "")
+        rpath = rpath[1:] if rpath[0] in ["/", "\\"] else rpath
+
+        if cfg.RESULT_TYPE == "table":
+            rtype = "bat.selection.table.txt"
+        elif cfg.RESULT_TYPE == "audacity":
+            rtype = ".bat.results.txt"
+        else:
+            rtype = ".bat.results.csv"
+
+        if head_name:
+            rtype = "." + head_name + (rtype if rtype.startswith(".") else "." + rtype)
+
+        return os.path.join(cfg.OUTPUT_PATH, rpath.rsplit(".", 1)[0] + rtype)
+
+    if head_name:
+        base, ext = cfg.OUTPUT_PATH.rsplit(".", 1)
+        return f"{base}.{head_name}.{ext}"
+
+    return cfg.OUTPUT_PATH
+
+
+def save_results(fpath: str, results: tuple[list, tuple], head_name: str = None):
+    """Saves the results of a file as selection table and adds them to Results.csv.
+    Args:
+        fpath: Path to the audio file.
+        results: The results as ([(start, end) per chunk], (chunk index, label index, score)).
+        head_name: Name of the head in multi-head mode, added to the file names.
+    Returns:
+        The `True` if the results were saved successfully.
+    """
+    try:
+        out_string = save_result_file(results, get_result_path(fpath, head_name), fpath)
+
+        # Save as file
+        with open(cfg.OUTPUT_PATH + ("Results.{}.csv".format(head_name) if head_name else "Results.csv"), "a",
+                  encoding="utf-8") as rfile:
+            postString = out_string.split("\n", 1)[1]
+            # rfile.write(fpath.join(postString.splitlines(True)))
+            rfile.write("\n"+fpath+"\n")
+            rfile.write(postString)
 
-    # If no chunks, show error and skip
     except Exception as ex:
-        print(f"Error: Cannot open audio file {fpath}", flush=True)
+        # Write error log
+        print(f"Error: Cannot save result for {fpath}.\n", flush=True)
         utils.writeErrorLog(ex)
-
         return False
 
-    # Process each chunk
+    return True
+
+
+def store_results(fpath: str, results: tuple[list, tuple]):
+    """Adds the results of a file to the detection database if cfg.DB_PATH is set.
+    Args:
+        fpath: Path to the audio file.
+        results: The results as ([(start, end) per chunk], (chunk index, label index, score)).
+    """
+    if not cfg.DB_PATH:
+        return
+
     try:
-        start, end = 0, cfg.SIG_LENGTH
-        results = {}
-        samples = []
-        timestamps = []
+        detection_db.add_results(fpath, results)
+    except Exception as ex:
+        print(f"Error: Cannot store result for {fpath} in the database.\n", flush=True)
+        utils.writeErrorLog(ex)
 
-        for chunk_index, chunk in enumerate(chunks):
-            # Add to batch
-            samples.append(chunk)
-            timestamps.append([start, end])
 
-            # Advance start and end
-            start += cfg.SIG_LENGTH - cfg.SIG_OVERLAP
-            end = start + cfg.SIG_LENGTH
+def collect_segments(fpath: str, results: tuple[list, tuple]):
+    """Adds the detections of a file to the segment candidates if cfg.SEGMENTS_PATH is set.
+    Every process appends the candidates to its own file in cfg.SEGMENTS_PATH,
+    the segments are selected and cut at the end of the run by extract_segments().
+    Args:
+        fpath: Path to the audio file.
+        results: The results as ([(start, end) per chunk], (chunk index, label index, score)).
+    """
+    if not cfg.SEGMENTS_PATH:
+        return
 
-            # Check if batch is full or last chunk
-            if len(samples) < cfg.BATCH_SIZE and chunk_index < len(chunks) - 1:
-                continue
+    timestamps, detections = results
+    labels = get_label_table()
+    lines = []
 
-            # Predict
-            prediction = predict(samples)
+    for chunk, label, score in zip(*detections):
+        start, end = timestamps[chunk]
+        lines.append(json.dumps({"audio": fpath, "start": float(start), "end": float(end),
+                                 "species": labels["common"][label], "confidence": float(score)}) + "\n")
 
-            # Add to results
-            for i in range(len(samples)):
-                # Get timestamp
-                s_start, s_end = timestamps[i]
+    if lines:
+        os.makedirs(cfg.SEGMENTS_PATH, exist_ok=True)
 
-                # Get prediction
-                pred = prediction[i]
+        with open(os.path.join(cfg.SEGMENTS_PATH, f".segments.{os.getpid()}.jsonl"), "a", encoding="utf-8") as f:
+            f.writelines(lines)
 
-                # Assign scores to labels
-                p_labels = zip(cfg.LABELS, pred)
 
-                # Sort by score
-                p_sorted = sorted(p_labels, key=operator.itemgetter(1), reverse=True)
+def extract_segments():
+    """Cuts the segments of the run from the candidates of collect_segments().
+    Selects at most cfg.SEGMENTS_MAX random segments per species over all files,
+    the same way segments.py does, and only reads their time ranges from the audio files.
+    """
+    candidates = []
+
+    for path in glob.glob(os.path.join(cfg.SEGMENTS_PATH, ".segments.*.jsonl")):
+        with open(path, "r", encoding="utf-8") as f:
+            candidates.extend(json.loads(line) for line in f)
+
+        os.remove(path)
+
+    # Files finish in any order, sort for a reproducible selection
+    candidates.sort(key=lambda seg: (seg["audio"], seg["start"], seg["species"]))
+    flist = [(entry, max(cfg.SIG_LENGTH, cfg.SEGMENTS_LENGTH))
+             for entry in segments.selectSegments(candidates, cfg.SEGMENTS_MAX)]
+    extract = functools.partial(segments.extractSegments, output_path=cfg.SEGMENTS_PATH)
+
+    if cfg.CPU_THREADS < 2:
+        for entry in flist:
+            extract(entry)
+    else:
+        with Pool(cfg.CPU_THREADS, initializer=utils.initWorker, initargs=(cfg.get_config(),)) as p:
+            for _ in p.imap_unordered(extract, flist):
+                pass
+
+
+def save_head_results(fpath: str, head_results: dict):
+    """Saves and stores the results of a file for every head.
+    Args:
+        fpath: Path to the audio file.
+        head_results: The results as {head name: results}, see collect_head_results().
+    Returns:
+        The `True` if the results of all heads were saved successfully.
+    """
+    heads = {head["name"]: head for head in cfg.HEADS}
+
+    for head_name, results in head_results.items():
+        with use_head(heads.get(head_name)):
+            if not save_results(fpath, results, head_name):
+                return False
+
+            store_results(fpath, results)
+            collect_segments(fpath, results)
+
+    return True
+
+
+def get_file_results(fpath: str, first_chunk: int = 0, n_chunks: int = None):
+    """Predicts the scores for a file and extracts the detections.
+    Args:
+        fpath: Path to the audio file.
+        first_chunk: Index of the first chunk to analyze.
+        n_chunks: Number of chunks to analyze, `None` analyzes to the end of the file.
+            Time ranges are not supported with the embedding cache.
+    Returns:
+        The results as {head name: results}, see collect_head_results(),
+        and the name of the decoder or `None` if the file could not be analyzed.
+    """
+    # Classifiers on top of cached embeddings, the audio is only decoded for new files
+    if cfg.EMBEDDING_CACHE_PATH and cfg.CUSTOM_CLASSIFIER:
+        try:
+            blocks, decoder = get_cached_features(fpath)
+            results = collect_head_results(predict_features(features) for features in blocks)
+
+        except Exception as ex:
+            print(f"Error: Cannot analyze audio file {fpath}.\n", flush=True)
+            utils.writeErrorLog(ex)
+            return None
+
+        return results, decoder
+
+    try:
+        # Open audio file and split into 3-second chunks
+        batches, decoder = get_raw_audio_from_file(fpath, first_chunk, n_chunks)
+
+    # If no chunks, show error and skip
+    except Exception as ex:
+        print(f"Error: Cannot open audio file {fpath}", flush=True)
+        utils.writeErrorLog(ex)
 
-                # Store top 5 results and advance indices
-                results[str(s_start) + "-" + str(s_end)] = p_sorted
+        return None
 
-            # Clear batch
-            samples = []
-            timestamps = []
+    # Process each batch of chunks
+    try:
+        results = collect_head_results((predict(samples) for samples in batches), first_chunk)
 
     except Exception as ex:
         # Write error log
         print(f"Error: Cannot analyze audio file {fpath}.\n", flush=True)
         utils.writeErrorLog(ex)
+        return None
+
+    return results, decoder
+
+
+def analyze_file(fpath: str):
+    """Analyzes a file.
+
+    Predicts the scores for the file and saves the results.
+    Worker processes get the config from utils.initWorker().
+
+    Args:
+        fpath: Path to the audio file.
+
+    Returns:
+        The `True` if the file was analyzed successfully.
+    """
+    # Start time
+    start_time = datetime.datetime.now()
+
+    # Status
+    print(f"Analyzing {fpath}", flush=True)
+
+    stats = dict(PRESCREEN_STATS)
+    analyzed = get_file_results(fpath)
+
+    if analyzed is None:
         return False
 
+    results, decoder = analyzed
+
     # Save as selection table
-    try:
-        # We have to check if output path is a file or directory
-        if not cfg.OUTPUT_PATH.rsplit(".", 1)[-1].lower() in ["txt", "csv"]:
-            rpath = fpath.replace(cfg.INPUT_PATH, "")
-            rpath = rpath[1:] if rpath[0] in ["/", "\\"] else rpath
+    if not save_head_results(fpath, results):
+        return False
+
+    delta_time = (datetime.datetime.now() - start_time).total_seconds()
+    print("Finished {} in {:.2f} seconds ({})".format(fpath, delta_time, decoder), flush=True)
+
+    if cfg.PRESCREEN_DB > 0:
+        print(get_prescreen_summary({k: PRESCREEN_STATS[k] - stats[k] for k in stats}), flush=True)
+
+    return True
 
-            # Make target directory if it doesn't exist
-            rdir = os.path.join(cfg.OUTPUT_PATH, os.path.dirname(rpath))
 
-            os.makedirs(rdir, exist_ok=True)
+def detect_file(fpath: str):
+    """Analyzes a file and returns the detections instead of saving them.
+    Used when the results of all files go through a single writer.
+    Args:
+        fpath: Path to the audio file.
+    Returns:
+        The file path and the results or `None` if the file could not be analyzed.
+    """
+    print(f"Analyzing {fpath}", flush=True)
 
-            if cfg.RESULT_TYPE == "table":
-                rtype = "bat.selection.table.txt"
-            elif cfg.RESULT_TYPE == "audacity":
-                rtype = ".bat.results.txt"
+    analyzed = get_file_results(fpath)
+
+    if analyzed is None:
+        return fpath, None
+
+    results = analyzed[0][None]
+    store_results(fpath, results)
+    collect_segments(fpath, results)
+    print(f"Finished {fpath} ({analyzed[1]})", flush=True)
+
+    return fpath, results
+
+
+def get_file_duration(fpath: str):
+    """Returns the duration of a file from its header.
+    Args:
+        fpath: Path to the audio file.
+    Returns:
+        The duration in seconds, estimated from the file size if the header cannot be read.
+    """
+    try:
+        return audio.getAudioFileLength(fpath)
+    except Exception:
+        pass
+
+    # As 16 bit mono at the analysis sample rate
+    try:
+        return os.path.getsize(fpath) / (2 * cfg.SAMPLE_RATE)
+    except OSError:
+        return 0.0
+
+
+def get_jobs(files: list[str], split: bool = True):
+    """Splits the files into jobs and orders them largest-first.
+    The durations are read from the file headers. The longest files start first
+    and the short ones fill up the idle workers at the end. With several CPU
+    threads, files longer than cfg.JOB_LENGTH are split into time ranges of
+    whole chunks. The ranges get shorter if there are fewer of them than
+    workers, but not shorter than a minute.
+    Args:
+        files: Paths to the audio files.
+        split: `False` to keep every file in one job.
+    Returns:
+        A list of jobs (file path, index of first chunk, number of chunks or `None` for the rest of the file).
+    """
+    step = cfg.SIG_LENGTH - cfg.SIG_OVERLAP
+    durations = {fpath: get_file_duration(fpath) for fpath in files}
+    jobs = []
+
+    # Cached embeddings are read per file
+    split = split and cfg.CPU_THREADS > 1 and cfg.JOB_LENGTH > 0
+    split = split and not (cfg.EMBEDDING_CACHE_PATH and cfg.CUSTOM_CLASSIFIER)
+    job_length = min(cfg.JOB_LENGTH, max(60.0, sum(durations.values()) / max(1, cfg.CPU_THREADS)))
+    chunks_per_job = max(1, int(job_length / step))
+
+    for fpath, duration in durations.items():
+        n_chunks = int(math.ceil(duration / step))
+
+        if not split or n_chunks <= chunks_per_job:
+            jobs.append((duration, (fpath, 0, None)))
+            continue
+
+        # The last range reads to the end of the file, whatever its actual length
+        for first_chunk in range(0, n_chunks, chunks_per_job):
+            if first_chunk + chunks_per_job < n_chunks:
+                jobs.append((chunks_per_job * step, (fpath, first_chunk, chunks_per_job)))
             else:
-                rtype = ".bat.results.csv"
+                jobs.append((duration - first_chunk * step, (fpath, first_chunk, None)))
+
+    jobs.sort(key=lambda job: job[0], reverse=True)
+
+    return [job for _, job in jobs]
+
+
+def merge_results(parts: list[dict]):
+    """Merges the results of the time ranges of a file.
+    The ranges of get_jobs() are whole chunks of the chunk grid of the file,
+    every chunk belongs to exactly one range. The chunks of the ranges are
+    appended in order and every detection appears once in the merged results.
+    Args:
+        parts: The results of the ranges in chunk order as {head name: results}.
+    Returns:
+        The results of the whole file as {head name: results}.
+    """
+    merged = {}
+
+    for head_name in parts[0]:
+        timestamps = []
+        detections = []
+
+        for part in parts:
+            part_timestamps, (chunk_idx, label_idx, scores) = part[head_name]
+            detections.append((chunk_idx + len(timestamps), label_idx, scores))
+            timestamps.extend(part_timestamps)
+
+        merged[head_name] = timestamps, tuple(np.concatenate(d) for d in zip(*detections))
+
+    return merged
+
+
+def analyze_range(job: tuple):
+    """Predicts the scores for a time range of a file and extracts the detections.
+    Args:
+        job: (file path, index of first chunk, number of chunks), see get_jobs().
+    Returns:
+        The job and its results as {head name: results} or `None` if the range could not be analyzed.
+    """
+    fpath, first_chunk, n_chunks = job
+
+    print("Analyzing {} from {:.2f} seconds".format(fpath, first_chunk * (cfg.SIG_LENGTH - cfg.SIG_OVERLAP)), flush=True)
+
+    analyzed = get_file_results(fpath, first_chunk, n_chunks)
+
+    return job, None if analyzed is None else analyzed[0]
+
+
+def analyze_job(job: tuple):
+    """Runs a job of get_jobs() in a pool worker.
+    Whole files are analyzed and saved by the worker, the results of time
+    ranges are returned and merged by collect_job_results().
+    Args:
+        job: (file path, index of first chunk, number of chunks).
+    Returns:
+        The job and, for whole files, `True` if the file was analyzed successfully,
+        otherwise the results of the range, see analyze_range().
+    """
+    if job[1] == 0 and job[2] is None:
+        return job, analyze_file(job[0])
 
-            out_string = save_result_file(results, os.path.join(cfg.OUTPUT_PATH, rpath.rsplit(".", 1)[0] + rtype), fpath)
+    return analyze_range(job)
+
+
+def detect_job(job: tuple):
+    """Runs a job of get_jobs() in a pool worker and returns the detections, see detect_file().
+    Args:
+        job: (file path, index of first chunk, number of chunks).
+    Returns:
+        The job and, for whole files, the results or `None`,
+        otherwise the results of the range, see analyze_range().
+    """
+    if job[1] == 0 and job[2] is None:
+        return job, detect_file(job[0])[1]
+
+    return analyze_range(job)
+
+
+def collect_job_results(job_results, jobs: list[tuple], finish):
+    """Collects the results of jobs and merges the time ranges of split files.
+    Args:
+        job_results: Iterable of (job, result) in any order, e.g. from Pool.imap_unordered().
+        jobs: The jobs, see get_jobs().
+        finish: Function called with the file path and the merged results of a split file,
+            which returns the result of the file.
+    Returns:
+        A generator of (file path, result), once per file.
+        The result of a split file is `None` if one of its ranges failed.
+    """
+    n_parts = collections.Counter(job[0] for job in jobs)
+    parts = {}
+
+    for job, result in job_results:
+        fpath, first_chunk, _ = job
+
+        if n_parts[fpath] == 1:
+            yield fpath, result
+            continue
+
+        entry = parts.setdefault(fpath, {})
+        entry[first_chunk] = result
+
+        # Wait until all ranges of the file are done
+        if len(entry) < n_parts[fpath]:
+            continue
+
+        del parts[fpath]
+
+        if any(r is None for r in entry.values()):
+            print(f"Error: Cannot analyze audio file {fpath}.\n", flush=True)
+            yield fpath, None
         else:
-            out_string = save_result_file(results, cfg.OUTPUT_PATH, fpath)
-            # Save as file
-        with open(cfg.OUTPUT_PATH + "Results.csv", "a", encoding="utf-8") as rfile:
-            postString = out_string.split("\n", 1)[1]
-            # rfile.write(fpath.join(postString.splitlines(True)))
-            rfile.write("\n"+fpath+"\n")
-            rfile.write(postString)
+            yield fpath, finish(fpath, merge_results([entry[i] for i in sorted(entry)]))
+
+
+def save_merged_results(fpath: str, results: dict):
+    """Saves the merged results of a split file, see collect_job_results().
+    Args:
+        fpath: Path to the audio file.
+        results: The results as {head name: results}.
+    Returns:
+        The `True` if the results were saved successfully.
+    """
+    if not save_head_results(fpath, results):
+        return False
+
+    print(f"Finished {fpath}", flush=True)
+
+    return True
+
+
+def store_merged_results(fpath: str, results: dict):
+    """Stores the merged results of a split file for the single writer, see collect_job_results().
+    Args:
+        fpath: Path to the audio file.
+        results: The results as {head name: results}.
+    Returns:
+        The results of the file.
+    """
+    results = results[None]
+    store_results(fpath, results)
+    collect_segments(fpath, results)
+    print(f"Finished {fpath}", flush=True)
+
+    return results
+
+
+def init_decoder(chunk_queue, config):
+    """Initializes a decoder process of the pipeline.
+    Args:
+        chunk_queue: Queue the decoded chunks are put into.
+        config: The config to restore.
+    """
+    global CHUNK_QUEUE
+
+    CHUNK_QUEUE = chunk_queue
+    cfg.set_config(config)
+
+
+def decode_file(job: tuple):
+    """Decodes a file or a time range of a file for the pipeline.
+    Puts (file path, index of first chunk, chunks) for every batch into the chunk queue,
+    followed by (file path, None, number of chunks) or (file path, None, -1) on errors.
+    Args:
+        job: (file path, index of first chunk, number of chunks), see get_jobs().
+    """
+    fpath, first_chunk, n_job_chunks = job
+    n_chunks = 0
+
+    # Status
+    if first_chunk:
+        print("Analyzing {} from {:.2f} seconds".format(fpath, first_chunk * (cfg.SIG_LENGTH - cfg.SIG_OVERLAP)), flush=True)
+    else:
+        print(f"Analyzing {fpath}", flush=True)
+
+    try:
+        batches, decoder = get_raw_audio_from_file(fpath, first_chunk, n_job_chunks)
+
+        for chunks in batches:
+            CHUNK_QUEUE.put((fpath, first_chunk + n_chunks, np.array(chunks)))
+            n_chunks += len(chunks)
 
     except Exception as ex:
-        # Write error log
-        print(f"Error: Cannot save result for {fpath}.\n", flush=True)
+        print(f"Error: Cannot open audio file {fpath}", flush=True)
         utils.writeErrorLog(ex)
-        return False
+        n_chunks = -1
+
+    CHUNK_QUEUE.put((fpath, None, n_chunks))
+
+
+def inference_worker(chunk_queue, result_queue, config):
+    """Runs inference on batches assembled across files.
+    Collects chunks from the queue until cfg.BATCH_SIZE chunks are available or
+    no more chunks arrive, predicts them in one go and puts the predictions for
+    every (file path, index of first chunk) into the result queue.
+    Stops when it receives None.
+    Args:
+        chunk_queue: Queue with decoded chunks.
+        result_queue: Queue for the predictions.
+        config: The config to restore.
+    """
+    cfg.set_config(config)
+    pending = []
+    n_pending = 0
+
+    while True:
+        try:
+            item = chunk_queue.get(timeout=0.1) if pending else chunk_queue.get()
+        except queue.Empty:
+            item = ()
+
+        # End markers are passed on to the writer
+        if item and item[1] is None:
+            result_queue.put(item)
+            continue
+
+        if item:
+            pending.append(item)
+            n_pending += len(item[2])
+
+        if pending and (n_pending >= cfg.BATCH_SIZE or not item):
+            try:
+                prediction = predict(np.concatenate([chunks for _, _, chunks in pending]))
+            except Exception as ex:
+                utils.writeErrorLog(ex)
+                prediction = None
+
+            offset = 0
+
+            for fpath, index, chunks in pending:
+                result_queue.put((fpath, index, None if prediction is None else prediction[offset : offset + len(chunks)]))
+                offset += len(chunks)
+
+            pending = []
+            n_pending = 0
+
+        if item is None:
+            break
+
+    if cfg.PRESCREEN_DB > 0:
+        print(get_prescreen_summary(), flush=True)
+
+
+def run_pipeline(files: list[str], writer=None, run_manifest=None, timeout: float = 300.0):
+    """Analyzes files with a decoding, inference and writing pipeline.
+    Decoder processes feed chunks of all files into a shared queue, inference
+    workers assemble full batches across file boundaries and the main process
+    collects the predictions per file and saves the results.
+    Args:
+        files: Paths to the audio files.
+        writer: Optional columnar.DetectionWriter for the results of all files,
+            otherwise the results are saved per file.
+        run_manifest: Optional manifest.Manifest the completed files are added to.
+            Not used with a writer, whose results are only final once it is closed.
+        timeout: Seconds without any results after which the remaining files are given up,
+            e.g. when a decoder process was killed.
+    Returns:
+        The paths of the files that were analyzed successfully.
+    """
+    # Longest files first, so they do not hold up the end of the run,
+    # long files are decoded in time ranges by several decoders
+    jobs = get_jobs(files)
+    n_parts = collections.Counter(job[0] for job in jobs)
+    n_decoders = max(1, cfg.CPU_THREADS // 2)
+    n_workers = max(1, cfg.CPU_THREADS - n_decoders)
+    cfg.TFLITE_THREADS = 1
+
+    # Bounded, so decoders cannot run away from the inference workers
+    chunk_queue = Queue(maxsize=4 * n_workers)
+    result_queue = Queue()
+
+    workers = [Process(target=inference_worker, args=(chunk_queue, result_queue, cfg.get_config()))
+               for _ in range(n_workers)]
+
+    for worker in workers:
+        worker.start()
+
+    start_time = datetime.datetime.now()
+
+    with Pool(n_decoders, initializer=init_decoder, initargs=(chunk_queue, cfg.get_config())) as decoders:
+        decoding = decoders.map_async(decode_file, jobs, chunksize=1)
+
+        # {file path: [number of chunks, {index of first chunk: predictions}, number of decoded ranges]}
+        pending = {}
+        finished = set()
+        completed = []
+        failed = False
+        last_result = time.monotonic()
+
+        while len(finished) < len(files):
+            try:
+                fpath, index, data = result_queue.get(timeout=1.0)
+            except queue.Empty:
+                # The end markers of lost decoder jobs never arrive, give up instead of waiting forever
+                if decoding.ready() and not decoding.successful():
+                    failed = "a decoder failed"
+                elif any(not worker.is_alive() for worker in workers):
+                    failed = "an inference worker stopped"
+                elif time.monotonic() - last_result > timeout:
+                    failed = "no results for {:.0f} seconds".format(timeout)
+
+                if failed:
+                    for fpath in files:
+                        if fpath not in finished:
+                            print(f"Error: Cannot analyze audio file {fpath}, {failed}.\n", flush=True)
+
+                    break
+
+                continue
+
+            last_result = time.monotonic()
+
+            if fpath in finished:
+                continue
+
+            # Skip files that could not be decoded or predicted
+            if (index is None and data < 0) or (index is not None and data is None):
+                if data is None:
+                    print(f"Error: Cannot analyze audio file {fpath}.\n", flush=True)
+
+                finished.add(fpath)
+                pending.pop(fpath, None)
+                continue
+
+            entry = pending.setdefault(fpath, [0, {}, 0])
+
+            if index is None:
+                entry[0] += data
+                entry[2] += 1
+            else:
+                entry[1][index] = data
+
+            # Wait until all ranges are decoded and all predictions for the file arrived
+            if entry[2] < n_parts[fpath] or sum(len(p) for p in entry[1].values()) < entry[0]:
+                continue
+
+            results = collect_head_results(entry[1][i] for i in sorted(entry[1]))
+
+            if writer is not None:
+                results = results[None]
+                writer.write(fpath, results)
+                store_results(fpath, results)
+                collect_segments(fpath, results)
+                print(f"Finished {fpath}", flush=True)
+                completed.append(fpath)
+
+            elif save_head_results(fpath, results):
+                print(f"Finished {fpath}", flush=True)
+                completed.append(fpath)
+
+                if run_manifest is not None:
+                    run_manifest.add(fpath, get_result_path(fpath, get_head_names()[-1]))
+
+            finished.add(fpath)
+            del pending[fpath]
+
+    # The queue may be full with nobody reading it after a failure
+    for worker in workers:
+        if failed:
+            worker.terminate()
+        else:
+            chunk_queue.put(None)
+
+    for worker in workers:
+        worker.join()
 
     delta_time = (datetime.datetime.now() - start_time).total_seconds()
-    print("Finished {} in {:.2f} seconds".format(fpath, delta_time), flush=True)
-    return True
+    print("Finished {} of {} files in {:.2f} seconds".format(len(completed), len(files), delta_time), flush=True)
+
+    return completed
+
 
 def set_analysis_location(kHz = 256):
     if args.classifier is not None:
@@ -484,7 +1314,7 @@ def set_custom_classifier():
     if args.classifier is None:
         return
     cfg.CUSTOM_CLASSIFIER = args.classifier  # we treat this as absolute path, so no need to join with dirname
-    cfg.LABELS_FILE = args.classifier.replace(".tflite", "_Labels.txt")  # same for labels file
+    cfg.LABELS_FILE = args.classifier.rsplit(".", 1)[0] + "_Labels.txt"  # same for labels file
     cfg.LABELS = utils.readLines(cfg.LABELS_FILE)
     args.lat = -1
     args.lon = -1
@@ -520,11 +1350,35 @@ def add_parser_arguments():
                         default=0.0,
                         help="Overlap of prediction segments. Values in [0.0, 2.9]. Defaults to 0.0."
                         )
+    parser.add_argument("--top_k",
+                        type=int,
+                        default=0,
+                        help="Only report the k most likely species per segment. Defaults to 0 (all above --min_conf)."
+                        )
+    parser.add_argument("--prescreen",
+                        type=float,
+                        default=0.0,
+                        help="Skip segments without ultrasonic activity before inference. Minimum difference in dB "
+                             "between the loudest frame and the noise floor of a segment in the 15-120 kHz band, "
+                             "higher values skip more segments. Values in [0, 40], e.g. 10. Defaults to 0 (off)."
+                        )
     parser.add_argument("--rtype",
                         default="csv",
-                        help="Specifies output format. Values in ['table', 'audacity', 'r',  'kaleidoscope', 'csv']. "
+                        help="Specifies output format. Values in ['table', 'audacity', 'r',  'kaleidoscope', 'csv', 'parquet']. "
+                             "'parquet' writes the detections of all files into a single Results.parquet (requires pyarrow). "
                              "Defaults to 'csv' (Raven selection table)."
                         )
+    parser.add_argument("--db",
+                        default="",
+                        help="Path to a SQLite detection database. If set, the detections are also stored in it. "
+                             "Query it with detection_db.py. Defaults to '' (off)."
+                        )
+    parser.add_argument("--embedding_cache",
+                        default="",
+                        help="Path to a folder to cache the embeddings in. Runs with other thresholds or classifiers "
+                             "on the same files reuse them and skip the main net. Not used with --pipeline, "
+                             "--prescreen is ignored. Defaults to '' (off)."
+                        )
     parser.add_argument("--threads",
                         type=int,
                         default=4,
@@ -534,6 +1388,22 @@ def add_parser_arguments():
                         default=1,
                         help="Number of samples to process at the same time. Defaults to 1."
                         )
+    parser.add_argument("--job_length",
+                        type=float,
+                        default=cfg.JOB_LENGTH,
+                        help="Files longer than this many seconds are split into time ranges that are analyzed in "
+                             "parallel. 0 never splits files. Defaults to 600."
+                        )
+    parser.add_argument("--pipeline",
+                        default="off",
+                        help="off or on. Decode and predict in separate processes and batch chunks across files. "
+                             "Use with a larger --batchsize on folders with many short files. Defaults to 'off'."
+                        )
+    parser.add_argument("--resume",
+                        default="off",
+                        help="on or off. Skip files that are unchanged and were already analyzed with the same settings, "
+                             "as recorded in Results.manifest.jsonl next to the output. Defaults to 'off'."
+                        )
     parser.add_argument("--sf_thresh",
                         type=float,
                         default=0.03,
@@ -552,6 +1422,16 @@ def add_parser_arguments():
                         help="Reduce the microphone specific noise in visualized spectrum."
                         "Values in [off, audiomoth, emtouch2, emtouch2-raspi]. Defaults to off."
                         )
+    parser.add_argument("--denoise",
+                        default="off",
+                        help="Remove the microphone specific noise from the audio before inference. "
+                             "Values in [off, audiomoth, emtouch2, emtouch2-raspi]. Defaults to off."
+                        )
+    parser.add_argument("--resampler",
+                        default="polyphase",
+                        help="Resampler for files that are not recorded at the analysis sample rate. "
+                             "Values in ['polyphase', 'kaiser_fast']. Defaults to 'polyphase'."
+                        )
     parser.add_argument("--i",
                         default=cfg.INPUT_PATH_SAMPLES,  # "put-your-files-here/",
                         help="Path to input file or folder. If this is a file, --o needs to be a file too.")
@@ -559,6 +1439,12 @@ def add_parser_arguments():
                         default=cfg.OUTPUT_PATH_SAMPLES,
                         help="Path to output file or folder. If this is a file, --i needs to be a file too.")
 
+    parser.add_argument("--heads",
+                        default="",
+                        help="Comma separated areas (e.g. 'Bavaria,Bavaria-high,UK') or paths to custom classifiers. "
+                             "Computes the embeddings once and writes one result set per classifier. "
+                             "Overrides --area and --classifier. Defaults to '' (off)."
+                        )
     parser.add_argument("--classifier",
                         default=None,
                         help="Path to custom trained classifier. Defaults to None. "
@@ -623,12 +1509,27 @@ def parse_input_files():
 
 def set_analysis_parameters():
     cfg.MIN_CONFIDENCE = max(0.01, min(0.99, float(args.min_conf)))
+    cfg.TOP_K = max(0, int(args.top_k))
+    cfg.PRESCREEN_DB = max(0.0, min(40.0, float(args.prescreen)))
     cfg.SIGMOID_SENSITIVITY = max(0.5, min(1.0 - (float(args.sensitivity) - 1.0), 1.5))
     cfg.SIG_OVERLAP = max(0.0, min(2.9, float(args.overlap)))
     cfg.BATCH_SIZE = max(1, int(args.batchsize))
+    cfg.JOB_LENGTH = max(0.0, float(args.job_length))
+    cfg.RESAMPLE_TYPE = args.resampler if args.resampler in audio.RESAMPLERS else "polyphase"
+    cfg.EMBEDDING_CACHE_PATH = args.embedding_cache
+
+    for option, value in (("denoise", args.denoise), ("noisered", args.noisered)):
+        if value != "off" and value not in cfg.NOISE_PROFILES:
+            exit(code=f"Unknown --{option} option {value}, values in [off, {', '.join(cfg.NOISE_PROFILES)}].")
+
+    if args.denoise in cfg.NOISE_PROFILES:
+        script_dir = os.path.dirname(os.path.abspath(sys.argv[0]))
+        cfg.NOISE_PROFILE = os.path.join(script_dir, cfg.NOISE_PROFILES[args.denoise][0])
+        cfg.NOISE_LEVEL = cfg.NOISE_PROFILES[args.denoise][1]
 
 def set_hardware_parameters():
-    if os.path.isdir(cfg.INPUT_PATH):
+    # A long single file is split into time ranges for several processes
+    if os.path.isdir(cfg.INPUT_PATH) or get_file_duration(cfg.INPUT_PATH) > cfg.JOB_LENGTH > 0:
         cfg.CPU_THREADS = max(1, int(args.threads))
         cfg.TFLITE_THREADS = 1
     else:
@@ -645,9 +1546,55 @@ def load_translated_labels():
     else:
         cfg.TRANSLATED_LABELS = cfg.LABELS
 
+def get_area_classifier(area: str, high: bool = False):
+    """Returns the path of the classifier for an area.
+    Args:
+        area: The area, e.g. 'Bavaria' or 'USA-EAST'.
+        high: Use the variant for higher id accuracy, see --no_noise.
+    """
+    name = area.replace("South-Wales", "SouthWales")
+    return cfg.BAT_CLASSIFIER_LOCATION + "/BattyBirdNET-{}-256kHz{}.tflite".format(name, "-high" if high else "")
+
+def set_heads():
+    """Loads the classifiers given with --heads for multi-head mode."""
+    if not args.heads:
+        return
+
+    cfg.HEADS = []
+
+    for spec in args.heads.split(","):
+        spec = spec.strip()
+
+        if spec.endswith(".tflite") or spec.endswith(".npz"):
+            name, classifier = os.path.basename(spec).rsplit(".", 1)[0], spec
+        elif spec.endswith("-high"):
+            name, classifier = spec, get_area_classifier(spec[: -len("-high")], high=True)
+        else:
+            name, classifier = spec, get_area_classifier(spec)
+
+        if not os.path.isfile(classifier):
+            exit(code=f"Unknown head {spec}, {classifier} does not exist.")
+
+        labels_file = classifier.rsplit(".", 1)[0] + "_Labels.txt"
+        labels = utils.readLines(labels_file)
+        lfile = os.path.join(cfg.TRANSLATED_BAT_LABELS_PATH,
+                             os.path.basename(labels_file).replace(".txt", "_{}.txt".format(args.locale)))
+        translated_labels = utils.readLines(lfile) if args.locale not in ["en"] and os.path.isfile(lfile) else labels
+
+        cfg.HEADS.append({"name": name, "classifier": classifier, "labels": labels, "translated_labels": translated_labels})
+
+    # Heads share the embeddings of the main net, the first head is the default classifier
+    cfg.CUSTOM_CLASSIFIER = cfg.HEADS[0]["classifier"]
+    cfg.LABELS = cfg.HEADS[0]["labels"]
+    cfg.TRANSLATED_LABELS = cfg.HEADS[0]["translated_labels"]
+
+    if cfg.RESULT_TYPE == "parquet":
+        cfg.RESULT_TYPE = "csv"
+        print("The parquet output is not available with --heads. Using csv output.")
+
 def check_result_type():
     cfg.RESULT_TYPE = args.rtype.lower()
-    if cfg.RESULT_TYPE not in ["table", "audacity", "r", "kaleidoscope", "csv"]:
+    if cfg.RESULT_TYPE not in ["table", "audacity", "r", "kaleidoscope", "csv", "parquet"]:
         cfg.RESULT_TYPE = "csv"
         print("Unknown output option. Using csv output.")
 
@@ -662,32 +1609,106 @@ if __name__ == "__main__":
     check_result_type()
     set_analysis_location(args.kHz)
     load_translated_labels()
+    set_heads()
     load_species_list()
     parse_input_files()
     set_analysis_parameters()
     set_hardware_parameters()
-    # Add config items to each file list entry.
-    # We have to do this for Windows which does not
-    # support fork() and thus each process has to
-    # have its own config. USE LINUX!
-    flist = [(f, cfg.get_config()) for f in cfg.FILE_LIST]
+
+    if args.db:
+        cfg.DB_PATH = args.db
+        cfg.DB_RUN_ID = detection_db.start_run("bat_ident")
+
+    # Skip files that are complete from a previous run
+    run_manifest = None
+    n_skipped = 0
+
+    if args.resume == "on":
+        run_manifest = manifest.Manifest(manifest.get_manifest_path(cfg.OUTPUT_PATH))
+        n_files = len(cfg.FILE_LIST)
+        cfg.FILE_LIST = [f for f in cfg.FILE_LIST if not run_manifest.is_done(f)]
+        n_skipped = n_files - len(cfg.FILE_LIST)
+
+        if n_skipped:
+            print(f"Skipping {n_skipped} files that were already analyzed")
+
+    def record(fpath, result_path=None):
+        if run_manifest is not None:
+            run_manifest.add(fpath, result_path or get_result_path(fpath, get_head_names()[-1]))
+
+    # The detections are collected for the segments while the files are analyzed
+    if args.segment == "on" or args.spectrum == "on":
+        script_dir = os.path.dirname(os.path.abspath(sys.argv[0]))
+        cfg.SEGMENTS_PATH = os.path.join(script_dir, args.i + "/results")
+
+        # Left over from an interrupted run
+        for path in glob.glob(os.path.join(cfg.SEGMENTS_PATH, ".segments.*.jsonl")):
+            os.remove(path)
+
+    # Workers get the config once from the pool initializer and then only jobs,
+    # which are sent one at a time, so the largest ones spread across the workers
+    initargs = (cfg.get_config(),)
+    jobs = get_jobs(cfg.FILE_LIST) if cfg.CPU_THREADS > 1 else []
 
     # Analyze files
-    if cfg.CPU_THREADS < 2:
-        for entry in flist:
-            analyze_file(entry)
+    if cfg.RESULT_TYPE == "parquet":
+        parquet_path = columnar.get_parquet_path(cfg.OUTPUT_PATH)
+
+        # Keep the detections of the files skipped from a previous run
+        if n_skipped and os.path.exists(parquet_path):
+            parquet_path = parquet_path.rsplit(".", 1)[0] + datetime.datetime.now().strftime(".%Y%m%d-%H%M%S.parquet")
+
+        # Detections of all files go through a single writer in this process
+        completed = []
+
+        with columnar.DetectionWriter(parquet_path) as writer:
+            if args.pipeline == "on" and os.path.isdir(cfg.INPUT_PATH):
+                completed = run_pipeline(cfg.FILE_LIST, writer)
+            elif cfg.CPU_THREADS < 2:
+                for fpath, results in map(detect_file, cfg.FILE_LIST):
+                    if results is not None:
+                        writer.write(fpath, results)
+                        completed.append(fpath)
+            else:
+                with Pool(cfg.CPU_THREADS, initializer=utils.initWorker, initargs=initargs) as p:
+                    job_results = p.imap_unordered(detect_job, jobs)
+
+                    for fpath, results in collect_job_results(job_results, jobs, store_merged_results):
+                        if results is not None:
+                            writer.write(fpath, results)
+                            completed.append(fpath)
+
+        # The detections are only in the Parquet file once the writer is closed
+        for fpath in completed:
+            record(fpath, writer.path)
+
+        print(f"Saved {writer.n_rows} detections to {writer.path}")
+    elif args.pipeline == "on" and os.path.isdir(cfg.INPUT_PATH):
+        run_pipeline(cfg.FILE_LIST, run_manifest=run_manifest)
+    elif cfg.CPU_THREADS < 2:
+        for fpath in cfg.FILE_LIST:
+            if analyze_file(fpath):
+                record(fpath)
+
+        for stage, (calls, seconds) in model.getTimings().items():
+            print(f"Inference {stage}: {calls} calls in {seconds:.2f} seconds")
+
+        if cfg.PRESCREEN_DB > 0:
+            print(get_prescreen_summary())
     else:
-        with Pool(cfg.CPU_THREADS) as p:
-            p.map(analyze_file, flist)
+        with Pool(cfg.CPU_THREADS, initializer=utils.initWorker, initargs=initargs) as p:
+            job_results = p.imap_unordered(analyze_job, jobs)
+
+            for fpath, success in collect_job_results(job_results, jobs, save_merged_results):
+                if success:
+                    record(fpath)
+
+    if run_manifest is not None:
+        run_manifest.close()
 
     if args.segment == "on" or args.spectrum == "on":
-        script_dir = os.path.dirname(os.path.abspath(sys.argv[0]))
+        extract_segments()
         results_dir = pathlib.Path(os.path.join(script_dir, args.o))
-        audio_dir = pathlib.Path(os.path.join(script_dir, args.i ))
-        out_dir = pathlib.Path(os.path.join(script_dir, args.i + "/results"))
-
-        cmd = ['python3', "segments.py", "--audio", audio_dir ,"--o", out_dir,"--results", results_dir]
-        subprocess.run(cmd)
 
         if args.spectrum == "on":
             # iterate through the segements folder subfolders, call the plotter
@@ -699,5 +1720,4 @@ if __name__ == "__main__":
                 if not os.path.isfile(f):
 
                     print("Spectrum in progres for: " + f)
-                    cmd = ['python3', "batchspec.py", f, f, args.noisered, script_dir]
-                    subprocess.run(cmd)
+                    batchspec.main(f, f, args.noisered, script_dir, max(1, int(args.threads)))
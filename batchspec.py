@@ -1,13 +1,28 @@
 # under MIT License from https://github.com/agsimmons/batchspec/blob/master/batchspec.py,2023
 import argparse
 import os
-import shutil
+import struct
 import sys
 import pathlib
-import subprocess
+import zlib
+from multiprocessing import Pool
+
+import numpy as np
+
+import audio
+import config as cfg
 
 LOSSLESS_EXTENSIONS = ['.flac', '.wav']
 
+# Same resolution as `sox spectrogram -X 1000`: 1000 pixels per second, 257
+# frequency rows (a 512 point DFT) and a dynamic range of 120 dB below full scale
+PIXELS_PER_SECOND = 1000
+N_ROWS = 257
+DYNAMIC_RANGE = 120.0
+
+# Number of spectrograms computed in one batched STFT
+BATCH_SIZE = 16
+
 
 def _parse_args():
     parser = argparse.ArgumentParser(description='Batch create spectogram images from files in specified directory')
@@ -17,52 +32,163 @@ def _parse_args():
                         default=os.getcwd())
     parser.add_argument('noise_prof', help='Reduce microphone noise.')
     parser.add_argument('script_dir', help='Directory from which called.')
-    parser.add_argument('--sox_path', help='Path to SoX executable. Will use sox or sox.exe in PATH by default')
+    parser.add_argument('--threads', type=int, default=4, help='Number of CPU threads.')
 
     return parser.parse_args()
 
 
-def _get_sox_path(specified_sox_path):
-    sox_path = None
-    if specified_sox_path is not None:
+def _make_palette(n_colors=256):
+    """Builds the default color palette of sox spectrograms.
 
-        specified_sox_path = pathlib.Path(specified_sox_path)
-        if specified_sox_path.is_file():
-            sox_path = specified_sox_path
-        else:
-            print('ERROR: Specified SoX path is not valid')
-            sys.exit(1)
+    Runs from black over purple and red to yellow and white.
 
-    elif os.name == 'posix':
-        sox_path = shutil.which('sox')
-    elif os.name == 'nt':
-        sox_path = shutil.which('sox.exe')
+    Args:
+        n_colors: Number of colors.
 
-    if sox_path:
-        return sox_path
-    else:
-        print('ERROR: SoX not found in path and not specified')
-        sys.exit(1)
+    Returns:
+        The palette as (n_colors, 3) uint8 array.
+    """
+    x = np.linspace(0.0, 1.0, n_colors)
+    r = np.where(x < 0.13, 0.0, np.where(x < 0.73, np.sin((x - 0.13) / 0.60 * np.pi / 2), 1.0))
+    g = np.where(x < 0.60, 0.0, np.where(x < 0.91, np.sin((x - 0.60) / 0.31 * np.pi / 2), 1.0))
+    b = np.where(x < 0.60, 0.5 * np.sin(x / 0.60 * np.pi), np.where(x < 0.78, 0.0, (x - 0.78) / 0.22))
 
+    return (np.stack((r, g, b), axis=1) * 255 + 0.5).astype(np.uint8)
 
-def main(source_directory, dest_directory, sox_path, noise_prof='off', script_dir="."):
-    source_directory = pathlib.Path(source_directory)
-    dest_directory = pathlib.Path(dest_directory)
-    noise_prof_p = ""
-    level = '0.5'
 
-    if noise_prof == "audiomoth":
-        noise_prof_p = pathlib.Path( os.path.join(script_dir, "checkpoints/bats/mic-noise/noise-audiomoth-1-2.prof"))
+PALETTE = _make_palette()
+
+
+def spectrogram_levels(signals, rate, noise_profile=None, level=0.5):
+    """Computes the spectrograms of signals of equal length in one batched STFT.
+
+    Uses a periodic Hann window and one frame per pixel. The levels are scaled
+    so that a full scale sine is at the top of the palette and DYNAMIC_RANGE dB
+    below it at the bottom.
+
+    Args:
+        signals: 2-D array of mono signals.
+        rate: The sample rate of the signals.
+        noise_profile: Optional path of a .prof file, the spectrograms are then
+            also rendered after spectral gating with its noise floor.
+        level: The sensitivity of the gate, see audio.spectralGate().
+
+    Returns:
+        The palette indices as (signals, N_ROWS, frames) uint8 array, low frequencies in the last row,
+        and the same for the gated spectrograms or `None` without a noise profile.
+    """
+    n_fft = 2 * (N_ROWS - 1)
+    hop = max(1, int(round(rate / PIXELS_PER_SECOND)))
+    n_frames = max(1, -(-signals.shape[1] // hop))
+    window = np.hanning(n_fft + 1)[:-1].astype("float32")
+
+    # Frames are centered on their pixel
+    padded = np.pad(signals.astype("float32", copy=False), ((0, 0), (n_fft // 2, n_fft // 2)))
+    frames = np.lib.stride_tricks.sliding_window_view(padded, n_fft, axis=1)[:, ::hop][:, :n_frames]
+    spec = np.fft.rfft(frames * window, axis=-1)
+
+    def to_levels(spec):
+        power = (spec.real ** 2 + spec.imag ** 2) * (2.0 / window.sum()) ** 2
+        levels = (10.0 * np.log10(power + 1e-20) + DYNAMIC_RANGE) / DYNAMIC_RANGE
+
+        return (np.clip(levels, 0.0, 1.0) * (len(PALETTE) - 1) + 0.5).astype(np.uint8).transpose(0, 2, 1)[:, ::-1]
+
+    if not noise_profile:
+        return to_levels(spec), None
+
+    return to_levels(spec), to_levels(audio.spectralGate(spec, audio.getNoiseFloor(noise_profile, n_fft), level))
+
+
+def _png_chunk(tag, data):
+    return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+
+def write_png(path, pixels, palette=PALETTE):
+    """Writes an indexed color PNG.
+
+    Palette images need one byte per pixel, which keeps the compression fast.
+
+    Args:
+        path: The output path.
+        pixels: 2-D uint8 array of palette indices.
+        palette: The (colors, 3) uint8 palette.
+    """
+    height, width = pixels.shape
 
-    if noise_prof == "emtouch2":
-        noise_prof_p = pathlib.Path(os.path.join(script_dir, "checkpoints/bats/mic-noise/noise-touch2.prof"))
-        level = '0.7'
+    # Every row starts with filter type 0
+    raw = np.zeros((height, width + 1), dtype=np.uint8)
+    raw[:, 1:] = pixels
 
-    if noise_prof == "emtouch2-raspi":
-        noise_prof_p = pathlib.Path(os.path.join(script_dir, "checkpoints/bats/mic-noise/noise-raspi-touch2.prof"))
-        level = '0.7'
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(_png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 3, 0, 0, 0)))
+        f.write(_png_chunk(b'PLTE', palette.tobytes()))
+        f.write(_png_chunk(b'IDAT', zlib.compress(raw.tobytes(), 1)))
+        f.write(_png_chunk(b'IEND', b''))
 
 
+def _read_mono(path):
+    import soundfile as sf
+
+    sig, rate = sf.read(path, dtype='float32', always_2d=True)
+
+    return sig.mean(axis=1), rate
+
+
+def render_spectrograms(jobs):
+    """Renders the spectrograms of audio files.
+
+    Files with the same sample rate and length go through one batched STFT.
+
+    Args:
+        jobs: List of (audio path, image path, image path of the denoised spectrogram or `None`,
+            noise profile path or `None`, level).
+
+    Returns:
+        The number of written images.
+    """
+    groups = {}
+
+    for audio_path, *job in jobs:
+        try:
+            sig, rate = _read_mono(audio_path)
+        except Exception as ex:
+            print('ERROR: Cannot read {}: {}'.format(audio_path, ex))
+            continue
+
+        groups.setdefault((rate, len(sig), job[2], job[3]), []).append((sig, job[0], job[1]))
+
+    n_images = 0
+
+    for (rate, _, noise_profile, level), items in groups.items():
+        for i in range(0, len(items), BATCH_SIZE):
+            batch = items[i:i + BATCH_SIZE]
+            levels, denoised = spectrogram_levels(np.stack([sig for sig, _, _ in batch]), rate, noise_profile, level)
+
+            for j, (_, image_path, denoised_path) in enumerate(batch):
+                write_png(image_path, levels[j])
+                n_images += 1
+
+                if denoised is not None:
+                    write_png(denoised_path, denoised[j])
+                    n_images += 1
+
+    return n_images
+
+
+def main(source_directory, dest_directory, noise_prof='off', script_dir=".", threads=4):
+    source_directory = pathlib.Path(source_directory)
+    dest_directory = pathlib.Path(dest_directory)
+    noise_prof_p = None
+    level = 0.5
+
+    if noise_prof in cfg.NOISE_PROFILES:
+        noise_prof_p, level = cfg.NOISE_PROFILES[noise_prof]
+        noise_prof_p = os.path.join(script_dir, noise_prof_p)
+    elif noise_prof != 'off':
+        print('ERROR: Unknown noise profile {}, values in [off, {}]'.format(noise_prof, ', '.join(cfg.NOISE_PROFILES)))
+        sys.exit(1)
+
     # Validate paths
     if not source_directory.is_dir():
         print('ERROR: Source directory is not valid')
@@ -72,24 +198,26 @@ def main(source_directory, dest_directory, sox_path, noise_prof='off', script_di
         sys.exit(1)
 
     audio_files = [file for file in source_directory.glob('*') if file.is_file() and file.suffix.lower() in LOSSLESS_EXTENSIONS]
+    jobs = []
 
     for file in audio_files:
         file_output_path = dest_directory / (file.stem + '.png')
-        file_output_path_red = dest_directory / (file.stem + '-noise.png')
+        file_output_path_red = dest_directory / (file.stem + '-noise.png') if noise_prof_p else None
 
         print('Processing {}'.format(file.name))
-        file_output_path_n = dest_directory / (file.stem + 'noisered' + file.suffix)
-        absolute_file_path = file.absolute()
-
-        if noise_prof != "off":
-            subprocess.run([sox_path, file.absolute(), file_output_path_n, 'noisered', noise_prof_p , level])
-            subprocess.run([sox_path, file_output_path_n, '-n', 'spectrogram', '-o', file_output_path_red, '-X', '1000'])
-
-        subprocess.run([sox_path, file.absolute(), '-n', 'spectrogram', '-o', file_output_path, '-X', '1000'])
+        jobs.append((file.absolute(), file_output_path, file_output_path_red, noise_prof_p, level))
 
+    # Sorted by size, so that files of the same length end up in the same batch
+    jobs.sort(key=lambda job: os.path.getsize(job[0]))
+    batches = [jobs[i:i + BATCH_SIZE] for i in range(0, len(jobs), BATCH_SIZE)]
 
+    if threads < 2 or len(batches) < 2:
+        n_images = sum(map(render_spectrograms, batches))
+    else:
+        with Pool(min(threads, len(batches))) as p:
+            n_images = sum(p.imap_unordered(render_spectrograms, batches))
 
-    print('DONE')
+    print('DONE, {} spectrograms'.format(n_images))
 
 
 if __name__ == '__main__':
@@ -97,8 +225,7 @@ if __name__ == '__main__':
 
     source_directory = pathlib.Path(args.source_directory)
     dest_directory = pathlib.Path(args.dest_directory)
-    sox_path = _get_sox_path(args.sox_path)
     noise_prof = args.noise_prof
     script_dir = args.script_dir
 
-    main(source_directory, dest_directory, sox_path, noise_prof, script_dir)
\ No newline at end of file
+    main(source_directory, dest_directory, noise_prof, script_dir, max(1, args.threads))
@@ -0,0 +1,187 @@
+"""Module to store detections in a columnar Parquet file.
+"""
+import datetime
+import json
+import os
+
+import numpy as np
+
+import config as cfg
+
+
+def get_parquet_path(output_path: str):
+    """Returns the path of the Parquet file for an output path.
+
+    Args:
+        output_path: The output file or folder.
+
+    Returns:
+        The output path itself if it is a .parquet file, otherwise "Results.parquet" inside of it.
+    """
+    if output_path.rsplit(".", 1)[-1].lower() == "parquet":
+        return output_path
+
+    return os.path.join(output_path, "Results.parquet")
+
+
+class DetectionWriter:
+    """Writes the detections of a run into a Parquet file.
+
+    Every detection is one row with the file, the start and end in seconds,
+    the label index and the score, together with the run metadata. Rows are
+    buffered and written in row groups, so readers can load single columns
+    and row ranges. The label names are stored in the file metadata.
+
+    Only one process may write to a file, the workers hand their detections
+    to the process that owns the writer.
+    """
+
+    def __init__(self, path: str, row_group_size: int = 65536):
+        """Opens the Parquet file.
+
+        Args:
+            path: Path to the Parquet file, it is overwritten if it exists.
+            row_group_size: Number of detections per row group.
+        """
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("The parquet result type requires pyarrow, install it with 'pip install pyarrow'.")
+
+        self.pa = pa
+        self.path = path
+        self.row_group_size = row_group_size
+        self.buffer = []
+        self.n_buffered = 0
+        self.n_rows = 0
+
+        self.run = datetime.datetime.now().isoformat(timespec="seconds")
+        self.run_metadata = {
+            "model": os.path.basename(cfg.MODEL_PATH),
+            "classifier": os.path.basename(cfg.CUSTOM_CLASSIFIER) if cfg.CUSTOM_CLASSIFIER else "",
+            "sample_rate": cfg.SAMPLE_RATE,
+            "overlap": cfg.SIG_OVERLAP,
+            "sensitivity": (1.0 - cfg.SIGMOID_SENSITIVITY) + 1.0,
+            "min_conf": cfg.MIN_CONFIDENCE,
+        }
+
+        self.schema = pa.schema(
+            [
+                ("run", pa.dictionary(pa.int32(), pa.string())),
+                ("file", pa.dictionary(pa.int32(), pa.string())),
+                ("start", pa.float64()),
+                ("end", pa.float64()),
+                ("label", pa.int32()),
+                ("score", pa.float32()),
+                ("model", pa.dictionary(pa.int32(), pa.string())),
+                ("classifier", pa.dictionary(pa.int32(), pa.string())),
+                ("sample_rate", pa.int32()),
+                ("overlap", pa.float32()),
+                ("sensitivity", pa.float32()),
+                ("min_conf", pa.float32()),
+            ],
+            metadata={
+                "labels": json.dumps(cfg.TRANSLATED_LABELS),
+                "run": json.dumps({"run": self.run, **self.run_metadata}),
+            },
+        )
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Written under a temporary name, so an interrupted run never leaves a truncated file
+        self.tmp_path = f"{path}.{os.getpid()}.tmp"
+        self.writer = pq.ParquetWriter(self.tmp_path, self.schema, compression="zstd")
+
+    def write(self, fpath: str, results: tuple[list, tuple]):
+        """Adds the detections of a file.
+
+        Args:
+            fpath: Path to the audio file.
+            results: The results as ([(start, end) per chunk], (chunk index, label index, score)).
+        """
+        timestamps, (chunk_idx, label_idx, scores) = results
+
+        if not len(chunk_idx):
+            return
+
+        bounds = np.array(timestamps, dtype="float64")[chunk_idx]
+        self.buffer.append((fpath, bounds[:, 0], bounds[:, 1], label_idx, scores))
+        self.n_buffered += len(chunk_idx)
+
+        if self.n_buffered >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        """Writes the buffered detections as row groups."""
+        if not self.buffer:
+            return
+
+        pa = self.pa
+        n = self.n_buffered
+        files = [fpath for fpath, *_ in self.buffer]
+        lengths = [len(start) for _, start, *_ in self.buffer]
+
+        def constant(value, type):
+            return pa.DictionaryArray.from_arrays(pa.array(np.zeros(n, dtype="int32")), pa.array([value], type))
+
+        columns = {
+            "run": constant(self.run, pa.string()),
+            "file": pa.DictionaryArray.from_arrays(
+                pa.array(np.repeat(np.arange(len(files), dtype="int32"), lengths)), pa.array(files, pa.string())
+            ),
+            "start": pa.array(np.concatenate([b[1] for b in self.buffer])),
+            "end": pa.array(np.concatenate([b[2] for b in self.buffer])),
+            "label": pa.array(np.concatenate([b[3] for b in self.buffer]).astype("int32")),
+            "score": pa.array(np.concatenate([b[4] for b in self.buffer]).astype("float32")),
+            "model": constant(self.run_metadata["model"], pa.string()),
+            "classifier": constant(self.run_metadata["classifier"], pa.string()),
+            "sample_rate": pa.array(np.full(n, self.run_metadata["sample_rate"], dtype="int32")),
+            "overlap": pa.array(np.full(n, self.run_metadata["overlap"], dtype="float32")),
+            "sensitivity": pa.array(np.full(n, self.run_metadata["sensitivity"], dtype="float32")),
+            "min_conf": pa.array(np.full(n, self.run_metadata["min_conf"], dtype="float32")),
+        }
+
+        self.writer.write_table(pa.table(columns, schema=self.schema), row_group_size=self.row_group_size)
+        self.n_rows += n
+        self.buffer = []
+        self.n_buffered = 0
+
+    def close(self):
+        """Writes the remaining detections, closes the file and moves it to its path."""
+        self.flush()
+        self.writer.close()
+        os.replace(self.tmp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is None:
+            self.close()
+            return
+
+        # Interrupted, the partial file is removed and an existing file at the path is kept
+        self.writer.close()
+
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+def read_detections(path: str, columns: list[str] = None, filters=None):
+    """Reads detections from a Parquet file.
+
+    Args:
+        path: Path to the Parquet file.
+        columns: Names of the columns to read, all if None.
+        filters: Row filters in pyarrow's format, e.g. [("score", ">", 0.9)].
+
+    Returns:
+        The detections as pyarrow table and the list of labels.
+    """
+    import pyarrow.parquet as pq
+
+    labels = json.loads(pq.read_schema(path).metadata[b"labels"])
+
+    return pq.read_table(path, columns=columns, filters=filters), labels
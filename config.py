@@ -40,6 +40,10 @@ SIG_LENGTH: float = 144000 / SAMPLE_RATE
 # Define overlap between consecutive chunks < SIG_LENGTH; 0 = no overlap
 SIG_OVERLAP: float = SIG_LENGTH / 4.0
 
+# Resampler used when the native sample rate of a file differs from SAMPLE_RATE.
+# Values in ['polyphase', 'kaiser_fast']; files already at SAMPLE_RATE are not resampled.
+RESAMPLE_TYPE: str = 'polyphase'
+
 # Define minimum length of audio chunk for prediction, 
 # chunks shorter than SIG_LENGTH seconds will be padded with zeros
 SIG_MINLEN: float = SIG_LENGTH / 3.0
@@ -88,16 +92,74 @@ SIGMOID_SENSITIVITY: float = 1.0
 # probabilities and needs to be adjusted)
 MIN_CONFIDENCE: float = 0.6
 
+# Maximum number of labels reported per chunk, 0 reports all labels above MIN_CONFIDENCE
+TOP_K: int = 0
+
+# Custom classifiers applied to the same embeddings in multi-head mode, as
+# dicts with name, classifier, labels and translated_labels. Empty for one classifier.
+HEADS: list[dict] = []
+
+# Ultrasonic pre-screen: chunks whose loudest frame in the band from
+# PRESCREEN_FMIN to PRESCREEN_FMAX (Hz) is less than PRESCREEN_DB dB above
+# the chunk's median frame are not passed to the model. 0 disables it.
+PRESCREEN_DB: float = 0.0
+PRESCREEN_FMIN: int = 15000
+PRESCREEN_FMAX: int = 120000
+
+# Noise profiles of microphones recorded with `sox noiseprof`, as
+# {name: (path, level)}. The level in [0, 1] sets how far above the noise
+# floor a frequency bin must be to pass the spectral gate.
+NOISE_PROFILES: dict[str, tuple[str, float]] = {
+    "audiomoth": ("checkpoints/bats/mic-noise/noise-audiomoth-1-2.prof", 0.5),
+    "emtouch2": ("checkpoints/bats/mic-noise/noise-touch2.prof", 0.7),
+    "emtouch2-raspi": ("checkpoints/bats/mic-noise/noise-raspi-touch2.prof", 0.7),
+}
+
+# Path of the noise profile removed from the audio before inference and its
+# level, see NOISE_PROFILES. Empty = no noise reduction.
+NOISE_PROFILE: str = ''
+NOISE_LEVEL: float = 0.5
+
 # Number of samples to process at the same time. Higher values can increase
 # processing speed, but will also increase memory usage.
 # Might only be useful for GPU inference.
 BATCH_SIZE: int = 1
 
+# Files are analyzed largest-first. With several CPU threads, files longer than
+# JOB_LENGTH seconds are split into time ranges that are analyzed in parallel
+# and merged into one result per file. 0 = never split files.
+JOB_LENGTH: float = 600.0
+
 # Specifies the output format. 'table' denotes a Raven selection table,
 # 'audacity' denotes a TXT file with the same format as Audacity timeline labels
 # 'csv' denotes a CSV file with start, end, species and confidence.
 RESULT_TYPE = 'csv'
 
+# Folder for the audio segments of the detections, which are collected while
+# the files are analyzed. At most SEGMENTS_MAX random segments of
+# SEGMENTS_LENGTH seconds are saved per species. Empty = no segments.
+SEGMENTS_PATH: str = ''
+SEGMENTS_LENGTH: float = 3.0
+SEGMENTS_MAX: int = 100
+
+# Path to the SQLite detection database, results are only stored in it if set
+DB_PATH: str = ''
+
+# Id of the current run in the detection database
+DB_RUN_ID: int = 0
+
+# Folder of the embedding cache, embeddings of unchanged files are reused if set
+EMBEDDING_CACHE_PATH: str = ''
+
+# Data type of the cached embeddings, 'float16' or 'float32'
+EMBEDDING_CACHE_DTYPE: str = 'float16'
+
+# Output format of embeddings.py, 'txt', 'npy', 'npz' or 'dir' (folder with .npy arrays and metadata)
+EMBEDDINGS_FORMAT: str = 'txt'
+
+# Data type of the embeddings written by embeddings.py in binary formats, 'float32' or 'float16'
+EMBEDDINGS_DTYPE: str = 'float32'
+
 #####################
 # Training settings #
 #####################
@@ -118,6 +180,10 @@ TRAIN_LEARNING_RATE: float = 0.01
 # If >0, a two-layer classifier will be trained
 TRAIN_HIDDEN_UNITS: int = 0
 
+# Training engine, 'keras' (TensorFlow, exports .tflite) or 'numpy'
+# (no TensorFlow needed, exports a .npz classifier evaluated with NumPy)
+TRAIN_ENGINE: str = 'keras'
+
 #####################
 # Misc runtime vars #
 #####################
@@ -145,6 +211,7 @@ def get_config():
         'SIG_LENGTH': SIG_LENGTH,
         'SIG_OVERLAP': SIG_OVERLAP,
         'SIG_MINLEN': SIG_MINLEN,
+        'RESAMPLE_TYPE': RESAMPLE_TYPE,
         'LATITUDE': LATITUDE,
         'LONGITUDE': LONGITUDE,
         'WEEK': WEEK,
@@ -158,13 +225,31 @@ def get_config():
         'APPLY_SIGMOID': APPLY_SIGMOID,
         'SIGMOID_SENSITIVITY': SIGMOID_SENSITIVITY,
         'MIN_CONFIDENCE': MIN_CONFIDENCE,
+        'TOP_K': TOP_K,
+        'HEADS': HEADS,
+        'PRESCREEN_DB': PRESCREEN_DB,
+        'PRESCREEN_FMIN': PRESCREEN_FMIN,
+        'PRESCREEN_FMAX': PRESCREEN_FMAX,
+        'NOISE_PROFILE': NOISE_PROFILE,
+        'NOISE_LEVEL': NOISE_LEVEL,
         'BATCH_SIZE': BATCH_SIZE,
+        'JOB_LENGTH': JOB_LENGTH,
         'RESULT_TYPE': RESULT_TYPE,
+        'SEGMENTS_PATH': SEGMENTS_PATH,
+        'SEGMENTS_LENGTH': SEGMENTS_LENGTH,
+        'SEGMENTS_MAX': SEGMENTS_MAX,
+        'DB_PATH': DB_PATH,
+        'DB_RUN_ID': DB_RUN_ID,
+        'EMBEDDING_CACHE_PATH': EMBEDDING_CACHE_PATH,
+        'EMBEDDING_CACHE_DTYPE': EMBEDDING_CACHE_DTYPE,
+        'EMBEDDINGS_FORMAT': EMBEDDINGS_FORMAT,
+        'EMBEDDINGS_DTYPE': EMBEDDINGS_DTYPE,
         'TRAIN_DATA_PATH': TRAIN_DATA_PATH,
         'TRAIN_EPOCHS': TRAIN_EPOCHS,
         'TRAIN_BATCH_SIZE': TRAIN_BATCH_SIZE,
         'TRAIN_LEARNING_RATE': TRAIN_LEARNING_RATE,
         'TRAIN_HIDDEN_UNITS': TRAIN_HIDDEN_UNITS,
+        'TRAIN_ENGINE': TRAIN_ENGINE,
         'CODES': CODES,
         'LABELS': LABELS,
         'TRANSLATED_LABELS': TRANSLATED_LABELS,
@@ -187,6 +272,7 @@ def set_config(c):
     global SIG_LENGTH
     global SIG_OVERLAP
     global SIG_MINLEN
+    global RESAMPLE_TYPE
     global LATITUDE
     global LONGITUDE
     global WEEK
@@ -200,13 +286,31 @@ def set_config(c):
     global APPLY_SIGMOID
     global SIGMOID_SENSITIVITY
     global MIN_CONFIDENCE
+    global TOP_K
+    global HEADS
+    global PRESCREEN_DB
+    global PRESCREEN_FMIN
+    global PRESCREEN_FMAX
+    global NOISE_PROFILE
+    global NOISE_LEVEL
     global BATCH_SIZE
+    global JOB_LENGTH
     global RESULT_TYPE
+    global SEGMENTS_PATH
+    global SEGMENTS_LENGTH
+    global SEGMENTS_MAX
+    global DB_PATH
+    global DB_RUN_ID
+    global EMBEDDING_CACHE_PATH
+    global EMBEDDING_CACHE_DTYPE
+    global EMBEDDINGS_FORMAT
+    global EMBEDDINGS_DTYPE
     global TRAIN_DATA_PATH
     global TRAIN_EPOCHS
     global TRAIN_BATCH_SIZE
     global TRAIN_LEARNING_RATE
     global TRAIN_HIDDEN_UNITS
+    global TRAIN_ENGINE
     global CODES
     global LABELS
     global TRANSLATED_LABELS
@@ -226,6 +330,7 @@ def set_config(c):
     SIG_LENGTH = c['SIG_LENGTH']
     SIG_OVERLAP = c['SIG_OVERLAP']
     SIG_MINLEN = c['SIG_MINLEN']
+    RESAMPLE_TYPE = c['RESAMPLE_TYPE']
     LATITUDE = c['LATITUDE']
     LONGITUDE = c['LONGITUDE']
     WEEK = c['WEEK']
@@ -239,13 +344,31 @@ def set_config(c):
     APPLY_SIGMOID = c['APPLY_SIGMOID']
     SIGMOID_SENSITIVITY = c['SIGMOID_SENSITIVITY']
     MIN_CONFIDENCE = c['MIN_CONFIDENCE']
+    TOP_K = c['TOP_K']
+    HEADS = c['HEADS']
+    PRESCREEN_DB = c['PRESCREEN_DB']
+    PRESCREEN_FMIN = c['PRESCREEN_FMIN']
+    PRESCREEN_FMAX = c['PRESCREEN_FMAX']
+    NOISE_PROFILE = c['NOISE_PROFILE']
+    NOISE_LEVEL = c['NOISE_LEVEL']
     BATCH_SIZE = c['BATCH_SIZE']
+    JOB_LENGTH = c['JOB_LENGTH']
     RESULT_TYPE = c['RESULT_TYPE']
+    SEGMENTS_PATH = c['SEGMENTS_PATH']
+    SEGMENTS_LENGTH = c['SEGMENTS_LENGTH']
+    SEGMENTS_MAX = c['SEGMENTS_MAX']
+    DB_PATH = c['DB_PATH']
+    DB_RUN_ID = c['DB_RUN_ID']
+    EMBEDDING_CACHE_PATH = c['EMBEDDING_CACHE_PATH']
+    EMBEDDING_CACHE_DTYPE = c['EMBEDDING_CACHE_DTYPE']
+    EMBEDDINGS_FORMAT = c['EMBEDDINGS_FORMAT']
+    EMBEDDINGS_DTYPE = c['EMBEDDINGS_DTYPE']
     TRAIN_DATA_PATH = c['TRAIN_DATA_PATH']
     TRAIN_EPOCHS = c['TRAIN_EPOCHS']
     TRAIN_BATCH_SIZE = c['TRAIN_BATCH_SIZE']
     TRAIN_LEARNING_RATE = c['TRAIN_LEARNING_RATE']
     TRAIN_HIDDEN_UNITS = c['TRAIN_HIDDEN_UNITS']
+    TRAIN_ENGINE = c['TRAIN_ENGINE']
     CODES = c['CODES']
     LABELS = c['LABELS']
     TRANSLATED_LABELS = c['TRANSLATED_LABELS']
@@ -0,0 +1,340 @@
+"""Module to store detections in a SQLite database.
+
+The database keeps the runs, the analyzed files and their detections, indexed
+by species, file and time, so results can be queried without parsing the
+result files. It runs in WAL mode, so the analysis processes can add their
+results while the database is being read.
+"""
+import argparse
+import datetime
+import os
+import re
+import sqlite3
+
+import audio
+import config as cfg
+import embedding_cache
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started TEXT NOT NULL,
+    source TEXT,
+    model TEXT,
+    classifier TEXT,
+    sample_rate INTEGER,
+    overlap REAL,
+    sensitivity REAL,
+    min_conf REAL
+);
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    size INTEGER,
+    mtime REAL,
+    duration REAL,
+    content_hash TEXT,
+    recorded REAL
+);
+CREATE TABLE IF NOT EXISTS analyses (
+    file_id INTEGER NOT NULL REFERENCES files (id),
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    analyzed TEXT NOT NULL,
+    PRIMARY KEY (file_id, run_id)
+);
+CREATE TABLE IF NOT EXISTS detections (
+    id INTEGER PRIMARY KEY,
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    file_id INTEGER NOT NULL REFERENCES files (id),
+    start_time REAL NOT NULL,
+    end_time REAL NOT NULL,
+    timestamp REAL,
+    species TEXT NOT NULL,
+    common_name TEXT,
+    score REAL NOT NULL,
+    classifier TEXT
+);
+CREATE INDEX IF NOT EXISTS detections_species ON detections (species, timestamp);
+CREATE INDEX IF NOT EXISTS detections_file ON detections (file_id, run_id, start_time);
+CREATE INDEX IF NOT EXISTS detections_time ON detections (timestamp);
+CREATE INDEX IF NOT EXISTS files_hash ON files (content_hash);
+"""
+
+# Recording start in file names like 20230512_213000.WAV (AudioMoth and others)
+RECORDED_PATTERN = re.compile(r"(\d{8})[_T-]?(\d{6})")
+
+# Open connections by (process id, database path), connections must not be shared with forked processes
+CONNECTIONS: dict[tuple[int, str], sqlite3.Connection] = {}
+
+
+def connect(db_path: str = None):
+    """Opens the detection database and creates the tables if needed.
+
+    Args:
+        db_path: Path to the database, defaults to cfg.DB_PATH.
+
+    Returns:
+        The connection, it is reused for further calls in the same process.
+    """
+    db_path = db_path or cfg.DB_PATH
+    key = (os.getpid(), db_path)
+
+    if key not in CONNECTIONS:
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+
+        con = sqlite3.connect(db_path, timeout=60)
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("PRAGMA synchronous=NORMAL")
+        con.executescript(SCHEMA)
+
+        CONNECTIONS[key] = con
+
+    return CONNECTIONS[key]
+
+
+def start_run(source: str, db_path: str = None):
+    """Adds a run with the current analysis settings.
+
+    Args:
+        source: Name of the program that runs the analysis.
+        db_path: Path to the database, defaults to cfg.DB_PATH.
+
+    Returns:
+        The id of the run.
+    """
+    con = connect(db_path)
+
+    with con:
+        cursor = con.execute(
+            "INSERT INTO runs (started, source, model, classifier, sample_rate, overlap, sensitivity, min_conf) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                datetime.datetime.now().isoformat(timespec="seconds"),
+                source,
+                os.path.basename(cfg.MODEL_PATH),
+                os.path.basename(cfg.CUSTOM_CLASSIFIER) if cfg.CUSTOM_CLASSIFIER else None,
+                cfg.SAMPLE_RATE,
+                cfg.SIG_OVERLAP,
+                (1.0 - cfg.SIGMOID_SENSITIVITY) + 1.0,
+                cfg.MIN_CONFIDENCE,
+            ),
+        )
+
+    return cursor.lastrowid
+
+
+def get_recording_time(path: str, mtime: float):
+    """Returns the start of a recording.
+
+    Args:
+        path: Path to the audio file.
+        mtime: Modification time of the file, used if the file name has no date.
+
+    Returns:
+        The start of the recording as POSIX timestamp.
+    """
+    match = RECORDED_PATTERN.search(os.path.basename(path))
+
+    if match:
+        try:
+            return datetime.datetime.strptime("".join(match.groups()), "%Y%m%d%H%M%S").timestamp()
+        except ValueError:
+            pass
+
+    return mtime
+
+
+def add_detections(fpath: str, detections, name: str = None, run_id: int = None, db_path: str = None,
+                   classifier: str = None):
+    """Adds the detections of a file in a single transaction.
+
+    Previous detections of the file in the same run and by the same classifier
+    are replaced, so the heads of a multi-head run keep their detections.
+
+    Args:
+        fpath: Path to the audio file.
+        detections: Iterable of (start, end, label, score), the label as "Scientific name_Common name".
+        name: Path under which the file is stored, defaults to fpath.
+        run_id: Id of the run, defaults to cfg.DB_RUN_ID.
+        db_path: Path to the database, defaults to cfg.DB_PATH.
+        classifier: Name of the classifier that made the detections.
+    """
+    con = connect(db_path)
+    run_id = run_id or cfg.DB_RUN_ID
+    name = name or fpath
+    stat = os.stat(fpath)
+    recorded = get_recording_time(name, stat.st_mtime)
+    row = con.execute("SELECT size, mtime, duration, content_hash FROM files WHERE path = ?", (name,)).fetchone()
+
+    # Only new or changed files are read again, e.g. not for every head of a multi-head run
+    if row and row[0] == stat.st_size and row[1] == stat.st_mtime:
+        duration, content_hash = row[2], row[3]
+    else:
+        duration = audio.getAudioFileLength(fpath)
+        content_hash = embedding_cache.get_content_hash(fpath)
+
+    with con:
+        con.execute(
+            "INSERT INTO files (path, size, mtime, duration, content_hash, recorded) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (path) DO UPDATE SET size = excluded.size, mtime = excluded.mtime, "
+            "duration = excluded.duration, content_hash = excluded.content_hash, recorded = excluded.recorded",
+            (name, stat.st_size, stat.st_mtime, duration, content_hash, recorded),
+        )
+        file_id = con.execute("SELECT id FROM files WHERE path = ?", (name,)).fetchone()[0]
+
+        con.execute("DELETE FROM detections WHERE file_id = ? AND run_id = ? AND classifier IS ?",
+                    (file_id, run_id, classifier))
+        con.executemany(
+            "INSERT INTO detections (run_id, file_id, start_time, end_time, timestamp, species, common_name, score, "
+            "classifier) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                (run_id, file_id, start, end, recorded + start, *(label.split("_", 1) + [None])[:2], score,
+                 classifier)
+                for start, end, label, score in detections
+            ),
+        )
+        con.execute(
+            "INSERT OR REPLACE INTO analyses (file_id, run_id, analyzed) VALUES (?, ?, ?)",
+            (file_id, run_id, datetime.datetime.now().isoformat(timespec="seconds")),
+        )
+
+
+def add_results(fpath: str, results: tuple[list, tuple]):
+    """Adds the results of bat_ident for a file.
+
+    The detections are stored under the name of cfg.CUSTOM_CLASSIFIER, which
+    is the classifier of the current head in multi-head mode.
+
+    Args:
+        fpath: Path to the audio file.
+        results: The results as ([(start, end) per chunk], (chunk index, label index, score)).
+    """
+    timestamps, detections = results
+
+    add_detections(
+        fpath,
+        (
+            (float(timestamps[chunk][0]), float(timestamps[chunk][1]), cfg.LABELS[label], float(score))
+            for chunk, label, score in zip(*detections)
+        ),
+        classifier=os.path.basename(cfg.CUSTOM_CLASSIFIER) if cfg.CUSTOM_CLASSIFIER else None,
+    )
+
+
+def get_analyzed_files(db_path: str = None):
+    """Returns all files that were analyzed.
+
+    Args:
+        db_path: Path to the database, defaults to cfg.DB_PATH.
+
+    Returns:
+        A dictionary {path: (size, mtime, content hash)}.
+    """
+    rows = connect(db_path).execute(
+        "SELECT path, size, mtime, content_hash FROM files WHERE id IN (SELECT file_id FROM analyses)"
+    )
+
+    return {path: (size, mtime, content_hash) for path, size, mtime, content_hash in rows}
+
+
+def is_analyzed(fpath: str, db_path: str = None):
+    """Checks if a file was analyzed and has not changed since.
+
+    Args:
+        fpath: Path to the audio file.
+        db_path: Path to the database, defaults to cfg.DB_PATH.
+
+    Returns:
+        `True` if the file was analyzed with its current size and modification time.
+    """
+    stat = os.stat(fpath)
+    row = connect(db_path).execute(
+        "SELECT 1 FROM files WHERE path = ? AND size = ? AND mtime = ? AND id IN (SELECT file_id FROM analyses)",
+        (fpath, stat.st_size, stat.st_mtime),
+    ).fetchone()
+
+    return row is not None
+
+
+def query_detections(species: str = None, min_score: float = 0.0, since: datetime.datetime = None,
+                     until: datetime.datetime = None, path: str = None, limit: int = None, db_path: str = None):
+    """Queries the detections.
+
+    Args:
+        species: Scientific name or its beginning, e.g. "Myotis" for all Myotis species.
+        min_score: Minimum score.
+        since: Only detections at or after this time.
+        until: Only detections before this time.
+        path: Only detections in this file.
+        limit: Maximum number of detections.
+        db_path: Path to the database, defaults to cfg.DB_PATH.
+
+    Returns:
+        A list of (path, start, end, timestamp, species, common name, score) sorted by time.
+    """
+    query = (
+        "SELECT files.path, start_time, end_time, timestamp, species, common_name, score "
+        "FROM detections JOIN files ON files.id = detections.file_id WHERE score >= ?"
+    )
+    params = [min_score]
+
+    if species:
+        # Range instead of LIKE, so the species index is used
+        query += " AND species >= ? AND species < ?"
+        params += [species, species + "\U0010ffff"]
+
+    if since:
+        query += " AND timestamp >= ?"
+        params.append(since.timestamp())
+
+    if until:
+        query += " AND timestamp < ?"
+        params.append(until.timestamp())
+
+    if path:
+        query += " AND files.path = ?"
+        params.append(path)
+
+    query += " ORDER BY timestamp"
+
+    if limit:
+        query += " LIMIT ?"
+        params.append(limit)
+
+    return connect(db_path).execute(query, params).fetchall()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query the detection database.")
+    parser.add_argument("--db", required=True, help="Path to the detection database.")
+    parser.add_argument("--species", default=None, help="Scientific name or its beginning, e.g. 'Myotis'.")
+    parser.add_argument("--min_conf", type=float, default=0.0, help="Minimum confidence. Defaults to 0.0.")
+    parser.add_argument("--since", default=None, help="Only detections at or after this date, e.g. '2024-05-01'.")
+    parser.add_argument("--until", default=None, help="Only detections before this date, e.g. '2024-06-01'.")
+    parser.add_argument("--file", default=None, help="Only detections in this file.")
+    parser.add_argument("--limit", type=int, default=None, help="Maximum number of detections.")
+    parser.add_argument("--analyzed", action="store_true", help="List the analyzed files instead of detections.")
+
+    args = parser.parse_args()
+
+    if args.analyzed:
+        for fpath in get_analyzed_files(args.db):
+            print(fpath)
+    else:
+        rows = query_detections(
+            args.species,
+            args.min_conf,
+            datetime.datetime.fromisoformat(args.since) if args.since else None,
+            datetime.datetime.fromisoformat(args.until) if args.until else None,
+            args.file,
+            args.limit,
+            args.db,
+        )
+
+        print("File,Start (s),End (s),Time,Scientific name,Common name,Confidence")
+
+        for fpath, start, end, timestamp, species, common_name, score in rows:
+            print("{},{},{},{},{},{},{:.4f}".format(
+                fpath, start, end, datetime.datetime.fromtimestamp(timestamp).isoformat(timespec="seconds"),
+                species, common_name, score))
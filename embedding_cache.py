@@ -0,0 +1,226 @@
+"""Module to cache the embeddings of the main net on disk.
+
+Embeddings only depend on the audio, the chunk geometry and the main net, not
+on the classifier, the sensitivity or the confidence threshold. They are
+stored once per file as .npy shard, named after a key built from the content
+hash of the file, SAMPLE_RATE, SIG_LENGTH, SIG_OVERLAP, the resampler and the
+checksum of the main net, and are memory-mapped when read. Moved or renamed
+files are still found, changed files or settings get a new key.
+
+Every stored shard is also appended to index.jsonl in the cache folder, which
+lists the source file, the shape and the data type of each shard.
+"""
+import datetime
+import hashlib
+import json
+import os
+
+import numpy as np
+
+import config as cfg
+import utils
+
+INDEX_NAME = "index.jsonl"
+
+# Checksums of the main net by model path
+MODEL_CHECKSUMS: dict[str, str] = {}
+
+# Content hashes by (path, size, modification time), so a file is only hashed once per process
+CONTENT_HASHES: dict[tuple, str] = {}
+
+
+def get_model_checksum(model_path: str = None):
+    """Returns the checksum of the main net.
+
+    Args:
+        model_path: Path to the model, defaults to cfg.MODEL_PATH.
+
+    Returns:
+        The content hash of the model file.
+    """
+    model_path = model_path or cfg.MODEL_PATH
+
+    if model_path not in MODEL_CHECKSUMS:
+        # Protobuf models are folders
+        path = os.path.join(model_path, "saved_model.pb") if os.path.isdir(model_path) else model_path
+        MODEL_CHECKSUMS[model_path] = utils.contentHash(path)
+
+    return MODEL_CHECKSUMS[model_path]
+
+
+def get_content_hash(fpath: str):
+    """Returns the content hash of a file, computed once per process.
+
+    Args:
+        fpath: Path to the file.
+
+    Returns:
+        The content hash of the file.
+    """
+    stat = os.stat(fpath)
+    key = (fpath, stat.st_size, stat.st_mtime_ns)
+
+    if key not in CONTENT_HASHES:
+        CONTENT_HASHES[key] = utils.contentHash(fpath)
+
+    return CONTENT_HASHES[key]
+
+
+def get_key(fpath: str, geometry: str = "split"):
+    """Returns the cache key of a file.
+
+    Args:
+        fpath: Path to the audio file.
+        geometry: How the signal is cut, "split" for consecutive chunks as used by the analysis,
+            "center" for the center chunk as used for training.
+
+    Returns:
+        The key as hex digest.
+    """
+    settings = {
+        "content": get_content_hash(fpath),
+        "geometry": geometry,
+        "sample_rate": cfg.SAMPLE_RATE,
+        "length": cfg.SIG_LENGTH,
+        "overlap": cfg.SIG_OVERLAP if geometry == "split" else None,
+        "minlen": cfg.SIG_MINLEN if geometry == "split" else None,
+        "resampler": cfg.RESAMPLE_TYPE,
+        "model": get_model_checksum(),
+    }
+
+    # Only part of the key with noise reduction, so existing shards stay valid
+    if cfg.NOISE_PROFILE:
+        settings["noise"] = [get_content_hash(cfg.NOISE_PROFILE), cfg.NOISE_LEVEL]
+
+    return hashlib.sha1(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def get_shard_path(key: str, cache_path: str = None):
+    """Returns the path of the shard for a key.
+
+    Args:
+        key: The cache key.
+        cache_path: The cache folder, defaults to cfg.EMBEDDING_CACHE_PATH.
+
+    Returns:
+        The path of the .npy file, in a subfolder named after the first two characters of the key.
+    """
+    return os.path.join(cache_path or cfg.EMBEDDING_CACHE_PATH, key[:2], key + ".npy")
+
+
+def load(key: str, cache_path: str = None):
+    """Loads the embeddings for a key.
+
+    Args:
+        key: The cache key.
+        cache_path: The cache folder, defaults to cfg.EMBEDDING_CACHE_PATH.
+
+    Returns:
+        The embeddings as read-only memory-mapped array or None if they are not cached.
+    """
+    path = get_shard_path(key, cache_path)
+
+    try:
+        return np.load(path, mmap_mode="r")
+    except (OSError, ValueError):
+        return None
+
+
+def save(key: str, features, fpath: str, geometry: str, cache_path: str = None):
+    """Stores the embeddings for a key.
+
+    The shard is written under a temporary name and moved into place, so
+    processes reading the cache at the same time never see a partial file.
+
+    Args:
+        key: The cache key.
+        features: The embeddings of shape (chunks, features).
+        fpath: Path to the audio file, recorded in the index.
+        geometry: How the signal was cut, see get_key().
+        cache_path: The cache folder, defaults to cfg.EMBEDDING_CACHE_PATH.
+    """
+    cache_path = cache_path or cfg.EMBEDDING_CACHE_PATH
+    path = get_shard_path(key, cache_path)
+    features = np.asarray(features, dtype=cfg.EMBEDDING_CACHE_DTYPE)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    try:
+        with open(tmp_path, "wb") as f:
+            np.save(f, features)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    entry = {
+        "key": key,
+        "file": os.path.abspath(fpath),
+        "geometry": geometry,
+        "shape": list(features.shape),
+        "dtype": features.dtype.name,
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+    }
+
+    # A single short write in append mode, lines of concurrent processes do not interleave
+    with open(os.path.join(cache_path, INDEX_NAME), "a", encoding="utf-8") as index:
+        index.write(json.dumps(entry) + "\n")
+
+
+def get_embeddings(fpath: str, compute, geometry: str = "split"):
+    """Returns the embeddings of a file from the cache or computes and stores them.
+
+    Args:
+        fpath: Path to the audio file.
+        compute: Function without arguments that computes the embeddings of shape (chunks, features).
+        geometry: How the signal is cut, see get_key().
+
+    Returns:
+        The embeddings, memory-mapped with the data type of the cache if they were cached,
+        otherwise as computed in float32. Callers upcast the cached ones block by block.
+    """
+    key = get_key(fpath, geometry)
+    features = load(key)
+
+    if features is not None:
+        return features
+
+    features = compute()
+
+    # Empty results are not worth caching and cannot be memory-mapped
+    if len(features):
+        save(key, features, fpath, geometry)
+
+    return np.asarray(features, dtype=np.float32)
+
+
+def read_index(cache_path: str = None):
+    """Reads the index of the cache.
+
+    Args:
+        cache_path: The cache folder, defaults to cfg.EMBEDDING_CACHE_PATH.
+
+    Returns:
+        A dictionary {key: entry} of the shards that still exist.
+    """
+    cache_path = cache_path or cfg.EMBEDDING_CACHE_PATH
+    entries = {}
+
+    if not os.path.isfile(os.path.join(cache_path, INDEX_NAME)):
+        return entries
+
+    with open(os.path.join(cache_path, INDEX_NAME), "r", encoding="utf-8") as index:
+        for line in index:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+
+            if os.path.isfile(get_shard_path(entry["key"], cache_path)):
+                entries[entry["key"]] = entry
+
+    return entries
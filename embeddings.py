@@ -2,14 +2,16 @@
 """
 import argparse
 import datetime
+import json
 import os
 import sys
 from multiprocessing import Pool
 
 import numpy as np
 
-import analyze
+import audio
 import config as cfg
+import embedding_cache
 import model
 import utils
 
@@ -31,99 +33,245 @@ def saveAsEmbeddingsFile(results: dict[str], fpath: str):
             f.write(timestamp.replace("-", "\t") + "\t" + ",".join(map(str, results[timestamp])) + "\n")
 
 
-def analyzeFile(item):
-    """Extracts the embeddings for a file.
+def getEmbeddingsPath(fpath: str):
+    """Returns the output path for the embeddings of a file.
+
+    Args:
+        fpath: Path to the audio file.
+
+    Returns:
+        The path of the embeddings file, or folder for the 'dir' format. A file given
+        as output path gets the extension of the format, np.save() would append it otherwise.
+    """
+    suffix = {"txt": ".birdnet.embeddings.txt", "dir": ".birdnet.embeddings"}.get(
+        cfg.EMBEDDINGS_FORMAT, ".birdnet.embeddings." + cfg.EMBEDDINGS_FORMAT
+    )
+
+    # We have to check if output path is a file or directory
+    if cfg.OUTPUT_PATH.rsplit(".", 1)[-1].lower() in ["txt", "csv", "npy", "npz"]:
+        if cfg.EMBEDDINGS_FORMAT == "txt":
+            return cfg.OUTPUT_PATH
+
+        return cfg.OUTPUT_PATH.rsplit(".", 1)[0] + {"npy": ".npy", "npz": ".npz"}.get(cfg.EMBEDDINGS_FORMAT, "")
+
+    fpath = fpath.replace(cfg.INPUT_PATH, "")
+    fpath = fpath[1:] if fpath[0] in ["/", "\\"] else fpath
+
+    return os.path.join(cfg.OUTPUT_PATH, fpath.rsplit(".", 1)[0] + suffix)
+
+
+def saveAsEmbeddingsArrays(embeddings, timestamps, path: str):
+    """Write embeddings and their timestamps as arrays.
+
+    'npy' writes the embeddings to path and the timestamps to <path>.timestamps.npy,
+    'npz' writes both into one uncompressed archive, 'dir' writes embeddings.npy,
+    timestamps.npy and meta.json into the folder path.
 
     Args:
-        item: (filepath, config)
+        embeddings: The embeddings of shape (chunks, features).
+        timestamps: Start and end of every chunk in seconds, shape (chunks, 2).
+        path: The path for the embeddings file or folder.
     """
-    # Get file path and restore cfg
-    fpath: str = item[0]
-    cfg.setConfig(item[1])
+    embeddings = np.asarray(embeddings, dtype=cfg.EMBEDDINGS_DTYPE)
+    timestamps = np.asarray(timestamps, dtype="float64")
+
+    if cfg.EMBEDDINGS_FORMAT == "npz":
+        np.savez(path, embeddings=embeddings, timestamps=timestamps)
+    elif cfg.EMBEDDINGS_FORMAT == "dir":
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "embeddings.npy"), embeddings)
+        np.save(os.path.join(path, "timestamps.npy"), timestamps)
+
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump(
+                {
+                    "shape": list(embeddings.shape),
+                    "dtype": embeddings.dtype.name,
+                    "sample_rate": cfg.SAMPLE_RATE,
+                    "sig_length": cfg.SIG_LENGTH,
+                    "overlap": cfg.SIG_OVERLAP,
+                    "model": os.path.basename(cfg.MODEL_PATH),
+                },
+                f,
+            )
+    else:
+        np.save(path, embeddings)
+        np.save(path.rsplit(".", 1)[0] + ".timestamps.npy", timestamps)
+
+
+def loadEmbeddingsArrays(path: str):
+    """Reads embeddings written by saveAsEmbeddingsArrays().
+
+    Args:
+        path: The path of the embeddings file or folder.
+
+    Returns:
+        The embeddings and the timestamps, memory-mapped for the 'npy' and 'dir' formats.
+    """
+    if path.endswith(".npz"):
+        with np.load(path) as data:
+            return data["embeddings"], data["timestamps"]
+
+    if os.path.isdir(path):
+        return (
+            np.load(os.path.join(path, "embeddings.npy"), mmap_mode="r"),
+            np.load(os.path.join(path, "timestamps.npy"), mmap_mode="r"),
+        )
+
+    return np.load(path, mmap_mode="r"), np.load(path.rsplit(".", 1)[0] + ".timestamps.npy", mmap_mode="r")
+
+
+def consolidateEmbeddings(files: list[tuple[str, str]], dataset_path: str):
+    """Concatenates the embeddings of all files into one dataset.
+
+    The dataset folder contains embeddings.npy and timestamps.npy with the rows of
+    all files, offsets.npy where the rows of file i are offsets[i]:offsets[i + 1],
+    and index.json with the audio files and the settings.
+
+    Args:
+        files: List of (audio file, embeddings path).
+        dataset_path: The dataset folder.
+    """
+    shapes = [loadEmbeddingsArrays(path)[0].shape for _, path in files]
+    offsets = np.concatenate([[0], np.cumsum([shape[0] for shape in shapes])]).astype("int64")
+
+    os.makedirs(dataset_path, exist_ok=True)
+    embeddings = np.lib.format.open_memmap(
+        os.path.join(dataset_path, "embeddings.npy"),
+        mode="w+",
+        dtype=cfg.EMBEDDINGS_DTYPE,
+        shape=(int(offsets[-1]), shapes[0][1] if shapes else 0),
+    )
+    timestamps = np.lib.format.open_memmap(
+        os.path.join(dataset_path, "timestamps.npy"), mode="w+", dtype="float64", shape=(int(offsets[-1]), 2)
+    )
+
+    # Copied file by file, the dataset is never loaded into memory as a whole
+    for i, (_, path) in enumerate(files):
+        e, t = loadEmbeddingsArrays(path)
+        embeddings[offsets[i] : offsets[i + 1]] = e
+        timestamps[offsets[i] : offsets[i + 1]] = t
+
+    embeddings.flush()
+    timestamps.flush()
+    del embeddings, timestamps
+
+    np.save(os.path.join(dataset_path, "offsets.npy"), offsets)
+
+    with open(os.path.join(dataset_path, "index.json"), "w") as f:
+        json.dump(
+            {
+                "files": [fpath for fpath, _ in files],
+                "dtype": cfg.EMBEDDINGS_DTYPE,
+                "sample_rate": cfg.SAMPLE_RATE,
+                "sig_length": cfg.SIG_LENGTH,
+                "overlap": cfg.SIG_OVERLAP,
+                "minlen": cfg.SIG_MINLEN,
+                "model": os.path.basename(cfg.MODEL_PATH),
+            },
+            f,
+        )
+
+
+def loadDataset(dataset_path: str):
+    """Memory-maps a dataset written by consolidateEmbeddings().
+
+    Args:
+        dataset_path: The dataset folder.
+
+    Returns:
+        The embeddings, the timestamps, the offsets and the list of audio files.
+    """
+    with open(os.path.join(dataset_path, "index.json"), "r") as f:
+        files = json.load(f)["files"]
+
+    return (
+        np.load(os.path.join(dataset_path, "embeddings.npy"), mmap_mode="r"),
+        np.load(os.path.join(dataset_path, "timestamps.npy"), mmap_mode="r"),
+        np.load(os.path.join(dataset_path, "offsets.npy")),
+        files,
+    )
+
+
+def analyzeFile(fpath: str):
+    """Extracts the embeddings for a file.
+
+    Worker processes get the config from utils.initWorker().
+
+    Args:
+        fpath: Path to the audio file.
 
+    Returns:
+        The path of the embeddings file or None if the file could not be analyzed.
+    """
     # Start time
     start_time = datetime.datetime.now()
 
     # Status
     print(f"Analyzing {fpath}", flush=True)
 
+    decoder = "embedding cache"
+
+    def computeEmbeddings():
+        nonlocal decoder
+
+        # Open audio file as a stream and split into batches of 3-second chunks
+        blocks, decoder = audio.openAudioStream(fpath, cfg.SAMPLE_RATE)
+        batches = audio.splitSignalStream(
+            blocks, cfg.SAMPLE_RATE, cfg.SIG_LENGTH, cfg.SIG_OVERLAP, cfg.SIG_MINLEN, cfg.BATCH_SIZE
+        )
+
+        # Pass each batch of chunks through model
+        e = [model.embeddings(samples) for samples in batches]
+
+        return np.concatenate(e) if e else np.zeros((0, 0), dtype="float32")
+
     try:
-        # Open audio file and split into 3-second chunks
-        chunks = analyze.getRawAudioFromFile(fpath)
+        if cfg.EMBEDDING_CACHE_PATH:
+            e = embedding_cache.get_embeddings(fpath, computeEmbeddings)
+        else:
+            e = computeEmbeddings()
     except Exception as ex:
-        print(f"Error: Cannot open audio file {fpath}", flush=True)
+        print(f"Error: Cannot analyze audio file {fpath}.", flush=True)
         utils.writeErrorLog(ex)
 
         return
-    
+
     # If no chunks, show error and skip
-    if len(chunks) == 0:
+    if len(e) == 0:
         msg = f"Error: Cannot open audio file {fpath}"
         print(msg, flush=True)
         writeErrorLog(msg)
 
         return
 
-    # Process each chunk
-    try:
-        start, end = 0, cfg.SIG_LENGTH
-        results = {}
-        samples = []
-        timestamps = []
-
-        for c in range(len(chunks)):
-            # Add to batch
-            samples.append(chunks[c])
-            timestamps.append([start, end])
-
-            # Advance start and end
-            start += cfg.SIG_LENGTH - cfg.SIG_OVERLAP
-            end = start + cfg.SIG_LENGTH
+    # Start and end of every chunk
+    starts = np.arange(len(e)) * (cfg.SIG_LENGTH - cfg.SIG_OVERLAP)
+    timestamps = np.stack([starts, starts + cfg.SIG_LENGTH], axis=1)
 
-            # Check if batch is full or last chunk
-            if len(samples) < cfg.BATCH_SIZE and c < len(chunks) - 1:
-                continue
-
-            # Prepare sample and pass through model
-            data = np.array(samples, dtype="float32")
-            e = model.embeddings(data)
+    # Save as embeddings file
+    try:
+        path = getEmbeddingsPath(fpath)
 
-            # Add to results
-            for i in range(len(samples)):
-                # Get timestamp
-                s_start, s_end = timestamps[i]
+        # Make target directory if it doesn't exist
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
 
-                # Get prediction
-                embeddings = e[i]
+        if cfg.EMBEDDINGS_FORMAT == "txt":
+            start, end = 0, cfg.SIG_LENGTH
+            results = {}
 
+            for embeddings in e:
                 # Store embeddings
-                results[str(s_start) + "-" + str(s_end)] = embeddings
+                results[str(start) + "-" + str(end)] = embeddings
 
-            # Reset batch
-            samples = []
-            timestamps = []
+                # Advance start and end
+                start += cfg.SIG_LENGTH - cfg.SIG_OVERLAP
+                end = start + cfg.SIG_LENGTH
 
-    except Exception as ex:
-        # Write error log
-        print(f"Error: Cannot analyze audio file {fpath}.", flush=True)
-        utils.writeErrorLog(ex)
-
-        return
-
-    # Save as embeddings file
-    try:
-        # We have to check if output path is a file or directory
-        if not cfg.OUTPUT_PATH.rsplit(".", 1)[-1].lower() in ["txt", "csv"]:
-            fpath = fpath.replace(cfg.INPUT_PATH, "")
-            fpath = fpath[1:] if fpath[0] in ["/", "\\"] else fpath
-
-            # Make target directory if it doesn't exist
-            fdir = os.path.join(cfg.OUTPUT_PATH, os.path.dirname(fpath))
-            os.makedirs(fdir, exist_ok=True)
-
-            saveAsEmbeddingsFile(results, os.path.join(cfg.OUTPUT_PATH, fpath.rsplit(".", 1)[0] + ".birdnet.embeddings.txt"))
+            saveAsEmbeddingsFile(results, path)
         else:
-            saveAsEmbeddingsFile(results, cfg.OUTPUT_PATH)
+            saveAsEmbeddingsArrays(e, timestamps, path)
 
     except Exception as ex:
         # Write error log
@@ -133,7 +281,9 @@ def analyzeFile(item):
         return
 
     delta_time = (datetime.datetime.now() - start_time).total_seconds()
-    print("Finished {} in {:.2f} seconds".format(fpath, delta_time), flush=True)
+    print("Finished {} in {:.2f} seconds ({})".format(fpath, delta_time, decoder), flush=True)
+
+    return path
 
 
 if __name__ == "__main__":
@@ -149,6 +299,26 @@ if __name__ == "__main__":
         "--overlap", type=float, default=0.0, help="Overlap of prediction segments. Values in [0.0, 2.9]. Defaults to 0.0."
     )
     parser.add_argument("--threads", type=int, default=4, help="Number of CPU threads.")
+    parser.add_argument(
+        "--embedding_cache",
+        default="",
+        help="Path to a folder to cache the embeddings in, shared with bat_ident.py and train.py. Defaults to '' (off).",
+    )
+    parser.add_argument(
+        "--format",
+        default="txt",
+        help="Output format. Values in ['txt', 'npy', 'npz', 'dir']. 'npy' writes the embeddings and the timestamps as "
+        ".npy arrays, 'npz' as one archive, 'dir' as a folder with .npy arrays and meta.json. Defaults to 'txt'.",
+    )
+    parser.add_argument(
+        "--dtype", default="float32", help="Data type of binary outputs. Values in ['float32', 'float16']. Defaults to 'float32'."
+    )
+    parser.add_argument(
+        "--consolidate",
+        default="",
+        help="Path to a folder for a dataset with the embeddings of all files in one memory-mappable array "
+        "and an offsets index. Requires a binary --format. Defaults to '' (off).",
+    )
     parser.add_argument(
         "--batchsize", type=int, default=1, help="Number of samples to process at the same time. Defaults to 1."
     )
@@ -185,20 +355,32 @@ if __name__ == "__main__":
     # Set batch size
     cfg.BATCH_SIZE = max(1, int(args.batchsize))
 
-    # Add config items to each file list entry.
-    # We have to do this for Windows which does not
-    # support fork() and thus each process has to
-    # have its own config. USE LINUX!
-    flist = [(f, cfg.getConfig()) for f in cfg.FILE_LIST]
+    # Set embedding cache
+    cfg.EMBEDDING_CACHE_PATH = args.embedding_cache
+
+    # Set output format
+    cfg.EMBEDDINGS_FORMAT = args.format.lower() if args.format.lower() in ["txt", "npy", "npz", "dir"] else "txt"
+    cfg.EMBEDDINGS_DTYPE = "float16" if args.dtype == "float16" else "float32"
 
-    # Analyze files
+    if args.consolidate and cfg.EMBEDDINGS_FORMAT == "txt":
+        cfg.EMBEDDINGS_FORMAT = "npy"
+        print("The consolidated dataset requires a binary format. Using npy output.")
+
+    # Analyze files, workers get the config once from the pool initializer
     if cfg.CPU_THREADS < 2:
-        for entry in flist:
-            analyzeFile(entry)
+        paths = set(map(analyzeFile, cfg.FILE_LIST))
     else:
-        with Pool(cfg.CPU_THREADS) as p:
-            p.map(analyzeFile, flist)
+        with Pool(cfg.CPU_THREADS, initializer=utils.initWorker, initargs=(cfg.get_config(),)) as p:
+            paths = set(
+                p.imap_unordered(analyzeFile, cfg.FILE_LIST, utils.getChunksize(len(cfg.FILE_LIST), cfg.CPU_THREADS))
+            )
+
+    if args.consolidate:
+        files = [(f, getEmbeddingsPath(f)) for f in cfg.FILE_LIST]
+        consolidateEmbeddings([(f, path) for f, path in files if path in paths], args.consolidate)
+        print(f"Saved dataset to {args.consolidate}")
 
     # A few examples to test
     # python3 embeddings.py --i example/ --o example/ --threads 4
     # python3 embeddings.py --i example/soundscape.wav --o example/soundscape.birdnet.embeddings.txt --threads 4
+    # python3 embeddings.py --i example/ --o example/ --format npy --dtype float16 --consolidate example/dataset
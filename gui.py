@@ -23,8 +23,8 @@ ORIGINAL_LABELS_FILE = cfg.LABELS_FILE
 ORIGINAL_TRANSLATED_LABELS_PATH = cfg.TRANSLATED_LABELS_PATH
 
 
-def analyzeFile_wrapper(entry):
-    return (entry[0], analyze.analyzeFile(entry))
+def analyzeFile_wrapper(fpath):
+    return (fpath, analyze.analyzeFile(fpath))
 
 
 def extractSegments_wrapper(entry):
@@ -278,10 +278,8 @@ def runAnalysis(
     # Set batch size
     cfg.BATCH_SIZE = max(1, int(batch_size))
 
-    flist = []
-
-    for f in cfg.FILE_LIST:
-        flist.append((f, cfg.getConfig()))
+    # Workers get the config once from the pool initializer
+    flist = cfg.FILE_LIST
 
     result_list = []
 
@@ -295,7 +293,9 @@ def runAnalysis(
 
             result_list.append(result)
     else:
-        with concurrent.futures.ProcessPoolExecutor(max_workers=cfg.CPU_THREADS) as executor:
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=cfg.CPU_THREADS, initializer=utils.initWorker, initargs=(cfg.get_config(),)
+        ) as executor:
             futures = (executor.submit(analyzeFile_wrapper, arg) for arg in flist)
             for i, f in enumerate(concurrent.futures.as_completed(futures), start=1):
                 if progress is not None:
@@ -527,11 +527,8 @@ def extract_segments(audio_dir, result_dir, output_dir, min_conf, num_seq, seq_l
     # Parse file list and make list of segments
     cfg.FILE_LIST = segments.parseFiles(cfg.FILE_LIST, max(1, int(num_seq)))
 
-    # Add config items to each file list entry.
-    # We have to do this for Windows which does not
-    # support fork() and thus each process has to
-    # have its own config. USE LINUX!
-    flist = [(entry, max(cfg.SIG_LENGTH, float(seq_length)), cfg.getConfig()) for entry in cfg.FILE_LIST]
+    # Add the segment length to each file list entry, workers get the config once from the pool initializer
+    flist = [(entry, max(cfg.SIG_LENGTH, float(seq_length))) for entry in cfg.FILE_LIST]
 
     result_list = []
 
@@ -544,7 +541,9 @@ def extract_segments(audio_dir, result_dir, output_dir, min_conf, num_seq, seq_l
             if progress is not None:
                 progress((i, len(flist)), total=len(flist), unit="files")
     else:
-        with concurrent.futures.ProcessPoolExecutor(max_workers=cfg.CPU_THREADS) as executor:
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=cfg.CPU_THREADS, initializer=utils.initWorker, initargs=(cfg.get_config(),)
+        ) as executor:
             futures = (executor.submit(extractSegments_wrapper, arg) for arg in flist)
             for i, f in enumerate(concurrent.futures.as_completed(futures), start=1):
                 if progress is not None:
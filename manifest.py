@@ -0,0 +1,149 @@
+"""Module to keep track of the files a batch run has completed.
+
+The manifest is an append-only JSON lines file next to the results. Every
+line records a file whose results were written completely, together with its
+size, modification time and the hash of the analysis settings. Files with a
+matching entry are skipped when the run is started again.
+"""
+import hashlib
+import json
+import os
+
+import config as cfg
+
+MANIFEST_NAME = "Results.manifest.jsonl"
+
+
+def get_manifest_path(output_path: str):
+    """Returns the path of the manifest for an output file or folder.
+
+    Args:
+        output_path: The output file or folder.
+
+    Returns:
+        The path of the manifest next to the output.
+    """
+    if output_path.rsplit(".", 1)[-1].lower() in ["txt", "csv", "parquet"]:
+        return os.path.join(os.path.dirname(output_path), MANIFEST_NAME)
+
+    return os.path.join(output_path, MANIFEST_NAME)
+
+
+def get_config_hash():
+    """Hashes the settings that change the results of an analysis.
+
+    Returns:
+        A short hex digest of the current settings.
+    """
+    settings = {
+        "model": os.path.basename(cfg.MODEL_PATH),
+        "classifier": os.path.basename(cfg.CUSTOM_CLASSIFIER) if cfg.CUSTOM_CLASSIFIER else None,
+        "heads": [os.path.basename(head["classifier"]) for head in cfg.HEADS],
+        "overlap": cfg.SIG_OVERLAP,
+        "sensitivity": cfg.SIGMOID_SENSITIVITY,
+        "sample_rate": cfg.SAMPLE_RATE,
+        "min_conf": cfg.MIN_CONFIDENCE,
+        "top_k": cfg.TOP_K,
+        "species_list": sorted(cfg.SPECIES_LIST),
+        "rtype": cfg.RESULT_TYPE,
+    }
+
+    # Skipped chunks get a score of 0, the pre-screen is only part of the hash
+    # if it is enabled, so earlier manifests stay valid
+    if cfg.PRESCREEN_DB > 0:
+        settings["prescreen"] = [cfg.PRESCREEN_DB, cfg.PRESCREEN_FMIN, cfg.PRESCREEN_FMAX]
+
+    # Only part of the hash with noise reduction, so earlier manifests stay valid
+    if cfg.NOISE_PROFILE:
+        settings["noise"] = [os.path.basename(cfg.NOISE_PROFILE), cfg.NOISE_LEVEL]
+
+    return hashlib.sha1(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+class Manifest:
+    """The completed files of a run.
+
+    Entries are loaded into a dictionary once, so checking a file only costs
+    a dictionary lookup and a stat call.
+    """
+
+    def __init__(self, path: str):
+        """Loads the manifest and opens it for appending.
+
+        Args:
+            path: Path to the manifest file.
+        """
+        self.path = path
+        self.config_hash = get_config_hash()
+        self.entries = {}
+
+        if os.path.isfile(path):
+            with open(path, "r", encoding="utf-8") as mfile:
+                for line in mfile:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Line cut off by a crash
+                        continue
+
+                    self.entries[entry["path"]] = entry
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.file = open(path, "a", encoding="utf-8")
+
+    def is_done(self, fpath: str):
+        """Checks if a file is complete and unchanged.
+
+        Args:
+            fpath: Path to the audio file.
+
+        Returns:
+            `True` if the file was analyzed with the current settings, has not changed
+            since and its result file still exists.
+        """
+        entry = self.entries.get(fpath)
+
+        if entry is None or entry["config"] != self.config_hash:
+            return False
+
+        stat = os.stat(fpath)
+
+        if entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime:
+            return False
+
+        return not entry["result"] or os.path.isfile(entry["result"])
+
+    def add(self, fpath: str, result_path: str = None):
+        """Records a completed file.
+
+        Must only be called after the results of the file have been written completely.
+
+        Args:
+            fpath: Path to the audio file.
+            result_path: Path to the result file of the audio file.
+        """
+        stat = os.stat(fpath)
+        entry = {
+            "path": fpath,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "config": self.config_hash,
+            "result": result_path,
+        }
+
+        self.file.write(json.dumps(entry) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.entries[fpath] = entry
+
+    def close(self):
+        """Closes the manifest file."""
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,6 +1,9 @@
 """Contains functions to use the BirdNET models.
 """
+import hashlib
 import os
+import time
+import types
 import warnings
 
 import numpy as np
@@ -28,6 +31,28 @@ C_INTERPRETER: tflite.Interpreter = None
 M_INTERPRETER: tflite.Interpreter = None
 PBMODEL = None
 
+# Batch sizes for which an allocated interpreter is kept. Batches are padded
+# up to the next bucket, so tensors are never reallocated on the hot path.
+# cfg.BATCH_SIZE is always added as a bucket, larger buckets are not used.
+BATCH_BUCKETS = (1, 8, 32, 64)
+
+# Allocated interpreters by batch size for the main net and the custom classifier
+INTERPRETERS: dict[int, tflite.Interpreter] = {}
+C_INTERPRETERS: dict[int, tflite.Interpreter] = {}
+
+# Custom classifiers by model path as (interpreters by batch size, input index, output index)
+C_HEADS: dict[str, tuple[dict, int, int]] = {}
+
+# Dense layers of custom classifiers by model path as [(weights (inputs, outputs), bias, relu)],
+# None if a classifier cannot be evaluated with NumPy, see loadLinearHead()
+LINEAR_HEADS: dict[str, list] = {}
+
+# Stacked weights, biases and split indices of single layer heads by model paths, see predictWithHeads()
+STACKED_HEADS: dict[tuple, tuple] = {}
+
+# Hot path timings as {stage: [number of calls, total seconds]}
+TIMINGS: dict[str, list] = {}
+
 
 def loadModel(class_output=True):
     """Initializes the BirdNET Model.
@@ -43,8 +68,8 @@ def loadModel(class_output=True):
     # Do we have to load the tflite or protobuf model?
     if cfg.MODEL_PATH.endswith(".tflite"):
         # Load TFLite model and allocate tensors.
-        INTERPRETER = tflite.Interpreter(model_path=cfg.MODEL_PATH, num_threads=cfg.TFLITE_THREADS)
-        INTERPRETER.allocate_tensors()
+        INTERPRETERS.clear()
+        INTERPRETER = _loadInterpreter(INTERPRETERS, cfg.MODEL_PATH, 1)
 
         # Get input and output tensors.
         input_details = INTERPRETER.get_input_details()
@@ -66,25 +91,127 @@ def loadModel(class_output=True):
         PBMODEL = keras.models.load_model(cfg.MODEL_PATH, compile=False)
 
 
-def loadCustomClassifier():
-    """Loads the custom classifier."""
+def loadCustomClassifier(model_path: str = None):
+    """Loads the custom classifier.
+
+    Args:
+        model_path: Path to the classifier, defaults to cfg.CUSTOM_CLASSIFIER.
+            Other classifiers are loaded as additional heads for `predictWithHeads`.
+    """
     global C_INTERPRETER
+    global C_INTERPRETERS
     global C_INPUT_LAYER_INDEX
     global C_OUTPUT_LAYER_INDEX
 
-    # Load TFLite model and allocate tensors.
-    C_INTERPRETER = tflite.Interpreter(model_path=cfg.CUSTOM_CLASSIFIER, num_threads=cfg.TFLITE_THREADS)
-    C_INTERPRETER.allocate_tensors()
+    model_path = model_path or cfg.CUSTOM_CLASSIFIER
+
+    # Load TFLite model and allocate tensors, every head has its own interpreters
+    pool = {}
+    interpreter = _loadInterpreter(pool, model_path, 1)
 
     # Get input and output tensors.
-    input_details = C_INTERPRETER.get_input_details()
-    output_details = C_INTERPRETER.get_output_details()
+    input_details = interpreter.get_input_details()
+    output_details = interpreter.get_output_details()
+
+    # Keep input tensor index and classification output of every head
+    C_HEADS[model_path] = (pool, input_details[0]["index"], output_details[0]["index"])
+
+    if model_path == cfg.CUSTOM_CLASSIFIER:
+        C_INTERPRETERS = pool
+        C_INTERPRETER = interpreter
+        C_INPUT_LAYER_INDEX = input_details[0]["index"]
+        C_OUTPUT_LAYER_INDEX = output_details[0]["index"]
+
+
+def _loadInterpreter(pool: dict, model_path: str, batch_size: int):
+    """Loads an interpreter with tensors allocated for a fixed batch size.
+
+    Args:
+        pool: The dict the interpreter is kept in, keyed by batch size.
+        model_path: Path to the TFLite model.
+        batch_size: The batch size of the input tensor.
+
+    Returns:
+        The allocated interpreter.
+    """
+    start = time.perf_counter()
+
+    interpreter = tflite.Interpreter(model_path=model_path, num_threads=cfg.TFLITE_THREADS)
+    input_details = interpreter.get_input_details()[0]
+
+    if input_details["shape"][0] != batch_size:
+        interpreter.resize_tensor_input(input_details["index"], [batch_size, *input_details["shape"][1:]])
+
+    interpreter.allocate_tensors()
+    pool[batch_size] = interpreter
+
+    _addTiming("allocate", start)
+
+    return interpreter
 
-    # Get input tensor index
-    C_INPUT_LAYER_INDEX = input_details[0]["index"]
 
-    # Get classification output
-    C_OUTPUT_LAYER_INDEX = output_details[0]["index"]
+def _addTiming(stage: str, start: float):
+    """Adds the time since start to the timings of a stage."""
+    timing = TIMINGS.setdefault(stage, [0, 0.0])
+    timing[0] += 1
+    timing[1] += time.perf_counter() - start
+
+
+def getTimings():
+    """Returns the hot path timings.
+
+    Returns:
+        A dict {stage: (number of calls, total seconds)} for the stages
+        "allocate", "set_input" and "invoke".
+    """
+    return {stage: tuple(timing) for stage, timing in TIMINGS.items()}
+
+
+def _invoke(pool: dict, model_path: str, input_index: int, output_index: int, data):
+    """Runs data through the interpreters of a pool.
+
+    Splits the data into batches of at most cfg.BATCH_SIZE and pads each batch
+    up to the next bucket, so that the pool only ever allocates one interpreter
+    per bucket. Buckets larger than cfg.BATCH_SIZE are not used, every
+    interpreter of the main net takes its own memory.
+
+    Args:
+        pool: Allocated interpreters keyed by batch size.
+        model_path: Path to the TFLite model, used to load missing buckets.
+        input_index: Index of the input tensor.
+        output_index: Index of the output tensor.
+        data: The input data of shape (n, ...).
+
+    Returns:
+        The output tensor for the n samples.
+    """
+    buckets = sorted({b for b in BATCH_BUCKETS if b < cfg.BATCH_SIZE} | {max(1, cfg.BATCH_SIZE)})
+    outputs = []
+
+    if not len(data):
+        interpreter = pool[buckets[0]] if buckets[0] in pool else _loadInterpreter(pool, model_path, buckets[0])
+        shape = next(d["shape"] for d in interpreter.get_output_details() if d["index"] == output_index)
+
+        return np.zeros((0, *shape[1:]), dtype="float32")
+
+    for i in range(0, len(data), buckets[-1]):
+        batch = data[i : i + buckets[-1]]
+        bucket = next(b for b in buckets if b >= len(batch))
+        interpreter = pool[bucket] if bucket in pool else _loadInterpreter(pool, model_path, bucket)
+
+        # Write batch and zero padding directly into the input tensor
+        start = time.perf_counter()
+        input_tensor = interpreter.tensor(input_index)
+        input_tensor()[: len(batch)] = batch
+        input_tensor()[len(batch) :] = 0
+        _addTiming("set_input", start)
+
+        start = time.perf_counter()
+        interpreter.invoke()
+        outputs.append(interpreter.get_tensor(output_index)[: len(batch)])
+        _addTiming("invoke", start)
+
+    return outputs[0] if len(outputs) == 1 else np.concatenate(outputs)
 
 
 def loadMetaModel():
@@ -208,6 +335,164 @@ def trainLinearClassifier(classifier, x_train, y_train, epochs, batch_size, lear
     return classifier, history
 
 
+def trainLinearHead(x_train, y_train, hidden_units, epochs, batch_size, learning_rate, on_epoch_end=None,
+                    patience=5, verbose=True):
+    """Trains a custom classifier with NumPy.
+
+    Same model and training schedule as buildLinearClassifier() and
+    trainLinearClassifier(), but without TensorFlow: binary cross-entropy,
+    Adam with cosine decay of the learning rate and early stopping on the
+    validation loss. The last 20% of the shuffled samples are held out for
+    validation.
+
+    Args:
+        x_train: Samples.
+        y_train: Labels.
+        hidden_units: If > 0, adds a hidden layer with ReLU activation and the given number of units.
+        epochs: Number of epochs to train.
+        batch_size: Batch size, the full data is one batch if it is not smaller.
+        learning_rate: The initial learning rate.
+        on_epoch_end: Optional callback `function(epoch, logs)`.
+        patience: Number of epochs without improvement of the validation loss before training stops.
+        verbose: Print the metrics after every epoch.
+
+    Returns:
+        (layers, history), the layers as list of (weights, bias, relu) for saveLinearHead() and
+        the history as object with a `history` dict of loss, prec, val_loss and val_prec per epoch.
+    """
+    rng = np.random.default_rng(cfg.RANDOM_SEED)
+
+    # Shuffle data and hold out a random validation split
+    idx = rng.permutation(x_train.shape[0])
+    x_train = np.asarray(x_train, dtype="float32")[idx]
+    y_train = np.asarray(y_train, dtype="float32")[idx]
+    split = int(0.8 * x_train.shape[0])
+
+    if 0 < split < x_train.shape[0]:
+        x_val, y_val = x_train[split:], y_train[split:]
+        x_train, y_train = x_train[:split], y_train[:split]
+    else:
+        x_val, y_val = x_train, y_train
+
+    # Glorot uniform weights and zero biases like Keras' Dense layers
+    sizes = [x_train.shape[1]] + ([hidden_units] if hidden_units > 0 else []) + [y_train.shape[1]]
+    params = []
+
+    for fan_in, fan_out in zip(sizes[:-1], sizes[1:]):
+        limit = np.sqrt(6.0 / (fan_in + fan_out))
+        params.append(rng.uniform(-limit, limit, (fan_in, fan_out)).astype("float32"))
+        params.append(np.zeros(fan_out, dtype="float32"))
+
+    def getLayers(params):
+        return [(params[i], params[i + 1], i + 2 < len(params)) for i in range(0, len(params), 2)]
+
+    def evaluate(layers, x, y):
+        z = _applyLinearHead(x, layers)
+
+        # Binary cross-entropy on the logits
+        loss = float(np.mean(np.maximum(z, 0) - z * y + np.log1p(np.exp(-np.abs(z)))))
+
+        # Precision of the top-1 label, counted if its score is at least 0.5
+        top = np.argmax(z, axis=1)
+        positive = z[np.arange(len(z)), top] >= 0
+        prec = float(y[np.arange(len(y)), top][positive].sum() / max(1, positive.sum()))
+
+        return loss, prec
+
+    # Adam with cosine decay over all steps
+    m = [np.zeros_like(p) for p in params]
+    v = [np.zeros_like(p) for p in params]
+    beta_1, beta_2, epsilon = 0.9, 0.999, 1e-7
+    batch_size = max(1, min(batch_size, x_train.shape[0]))
+    decay_steps = max(1.0, epochs * x_train.shape[0] / batch_size)
+    step = 0
+
+    history = {"loss": [], "prec": [], "val_loss": [], "val_prec": []}
+    best_loss, best_params, wait = np.inf, [p.copy() for p in params], 0
+
+    for epoch in range(epochs):
+        order = rng.permutation(x_train.shape[0])
+
+        for i in range(0, x_train.shape[0], batch_size):
+            x, y = x_train[order[i : i + batch_size]], y_train[order[i : i + batch_size]]
+
+            # Forward pass
+            activations = [x]
+
+            for weights, bias, relu in getLayers(params):
+                out = np.dot(activations[-1], weights) + bias
+                activations.append(np.maximum(out, 0) if relu else out)
+
+            # Gradient of the mean binary cross-entropy w.r.t. the logits
+            delta = (flat_sigmoid(activations[-1]) - y) / y.size
+            grads = [None] * len(params)
+
+            for layer in range(len(params) // 2 - 1, -1, -1):
+                grads[2 * layer] = np.dot(activations[layer].T, delta)
+                grads[2 * layer + 1] = delta.sum(axis=0)
+
+                if layer:
+                    delta = np.dot(delta, params[2 * layer].T) * (activations[layer] > 0)
+
+            step += 1
+            lr = learning_rate * 0.5 * (1 + np.cos(np.pi * min(step, decay_steps) / decay_steps))
+            lr_t = lr * np.sqrt(1 - beta_2**step) / (1 - beta_1**step)
+
+            for p, g, m_p, v_p in zip(params, grads, m, v):
+                m_p *= beta_1
+                m_p += (1 - beta_1) * g
+                v_p *= beta_2
+                v_p += (1 - beta_2) * g * g
+                p -= (lr_t * m_p / (np.sqrt(v_p) + epsilon)).astype("float32")
+
+        loss, prec = evaluate(getLayers(params), x_train, y_train)
+        val_loss, val_prec = evaluate(getLayers(params), x_val, y_val)
+        logs = {"loss": loss, "prec": prec, "val_loss": val_loss, "val_prec": val_prec}
+
+        for key, value in logs.items():
+            history[key].append(value)
+
+        if verbose:
+            print(f"Epoch {epoch + 1}/{epochs} - " + " - ".join(f"{k}: {v:.4f}" for k, v in logs.items()), flush=True)
+
+        if on_epoch_end:
+            on_epoch_end(epoch, logs)
+
+        # Early stopping, restores the weights of the best epoch
+        if val_loss < best_loss:
+            best_loss, best_params, wait = val_loss, [p.copy() for p in params], 0
+        else:
+            wait += 1
+
+            if wait >= patience:
+                break
+
+    return getLayers(best_params), types.SimpleNamespace(history=history)
+
+
+def saveLinearHeadClassifier(layers: list, model_path: str, labels: list[str]):
+    """Saves a classifier trained with trainLinearHead().
+
+    Saves the layers as .npz file, which can be used as custom classifier,
+    as well as the used labels in a .txt.
+
+    Args:
+        layers: List of (weights, bias, relu) per layer.
+        model_path: Path the model will be saved at.
+        labels: List of labels used for the classifier.
+    """
+    # Make folders
+    if os.path.dirname(model_path):
+        os.makedirs(os.path.dirname(model_path), exist_ok=True)
+
+    saveLinearHead(model_path, layers)
+
+    # Save labels
+    with open(model_path.rsplit(".", 1)[0] + "_Labels.txt", "w") as f:
+        for label in labels:
+            f.write(label + "\n")
+
+
 def saveLinearClassifier(classifier, model_path, labels):
     """Saves a custom classifier on the hard drive.
 
@@ -235,6 +520,200 @@ def saveLinearClassifier(classifier, model_path, labels):
             f.write(label + "\n")
 
 
+def saveLinearHead(model_path: str, layers: list, **metadata):
+    """Saves the dense layers of a classifier as .npz file.
+
+    The file can be used as custom classifier and is evaluated with NumPy.
+
+    Args:
+        model_path: Path of the .npz file.
+        layers: List of (weights of shape (inputs, outputs), bias, relu) per layer.
+        **metadata: Additional arrays to store in the file.
+    """
+    arrays = {}
+
+    for i, (weights, bias, relu) in enumerate(layers):
+        arrays[f"weights_{i}"] = weights
+        arrays[f"bias_{i}"] = bias
+        arrays[f"relu_{i}"] = np.array(relu)
+
+    # Write to a temporary file first, several processes may cache the same head
+    tmp_path = f"{model_path}.{os.getpid()}.tmp"
+
+    with open(tmp_path, "wb") as f:
+        np.savez(f, **arrays, **metadata)
+
+    os.replace(tmp_path, model_path)
+
+
+def _readLinearHead(model_path: str):
+    """Reads the dense layers from a .npz file written by saveLinearHead()."""
+    layers = []
+
+    with np.load(model_path) as data:
+        while f"weights_{len(layers)}" in data:
+            i = len(layers)
+            layers.append(
+                (
+                    np.ascontiguousarray(data[f"weights_{i}"], dtype="float32"),
+                    np.ascontiguousarray(data[f"bias_{i}"], dtype="float32"),
+                    bool(data[f"relu_{i}"]),
+                )
+            )
+
+    return layers
+
+
+def _extractLinearHead(model_path: str):
+    """Extracts the dense layers of a TFLite classifier.
+
+    Only classifiers that consist of FULLY_CONNECTED ops are supported. The
+    interpreter does not expose fused activations, so the result is checked
+    against the interpreter with and without ReLU on the hidden layers.
+
+    Args:
+        model_path: Path to the TFLite classifier.
+
+    Returns:
+        List of (weights of shape (inputs, outputs), bias, relu) or None.
+    """
+    try:
+        interpreter = tflite.Interpreter(model_path=model_path)
+        interpreter.allocate_tensors()
+        input_index = interpreter.get_input_details()[0]["index"]
+        output_index = interpreter.get_output_details()[0]["index"]
+        layers = []
+        current = input_index
+
+        # Private API of the interpreter, without it the classifier runs with TFLite
+        if not hasattr(interpreter, "_get_ops_details"):
+            print(f"Cannot read the layers of {model_path}, using TFLite for the classifier.", flush=True)
+            return None
+
+        for op in interpreter._get_ops_details():
+            if op["op_name"] == "DELEGATE":
+                continue
+
+            if op["op_name"] != "FULLY_CONNECTED" or op["inputs"][0] != current:
+                return None
+
+            weights = interpreter.get_tensor(op["inputs"][1])
+            has_bias = len(op["inputs"]) > 2 and op["inputs"][2] >= 0
+            bias = interpreter.get_tensor(op["inputs"][2]) if has_bias else np.zeros(len(weights))
+            layers.append((np.ascontiguousarray(weights.T, dtype="float32"), bias.astype("float32"), False))
+            current = op["outputs"][0]
+
+        if not layers or current != output_index:
+            return None
+
+        # Reference output of the interpreter
+        x = np.random.RandomState(cfg.RANDOM_SEED).normal(0, 1, (4, layers[0][0].shape[0])).astype("float32")
+        expected = []
+
+        for sample in x:
+            interpreter.set_tensor(input_index, sample[None])
+            interpreter.invoke()
+            expected.append(interpreter.get_tensor(output_index)[0])
+
+    except Exception:
+        return None
+
+    for relu in (True, False):
+        candidate = [(weights, bias, relu and i < len(layers) - 1) for i, (weights, bias, _) in enumerate(layers)]
+
+        if np.allclose(_applyLinearHead(x, candidate), expected, rtol=1e-3, atol=1e-3):
+            return candidate
+
+    return None
+
+
+def getLinearHeadCachePath(model_path: str):
+    """Returns the path the extracted layers of a .tflite classifier are cached in.
+
+    Args:
+        model_path: Path to the classifier.
+
+    Returns:
+        The path of the <model>_<hash>_Head.npz file in the heads folder of
+        cfg.EMBEDDING_CACHE_PATH or None if the embedding cache is off.
+    """
+    if not cfg.EMBEDDING_CACHE_PATH:
+        return None
+
+    name = os.path.basename(model_path).rsplit(".", 1)[0]
+
+    # Classifiers with the same name in different folders get their own cache
+    digest = hashlib.sha1(os.path.abspath(model_path).encode("utf-8")).hexdigest()[:12]
+
+    return os.path.join(cfg.EMBEDDING_CACHE_PATH, "heads", f"{name}_{digest}_Head.npz")
+
+
+def loadLinearHead(model_path: str):
+    """Loads the dense layers of a custom classifier for NumPy inference.
+
+    .npz classifiers are read directly. The weights of .tflite classifiers are
+    extracted once per process and, with the embedding cache, stored as float32
+    arrays on disk, see getLinearHeadCachePath().
+
+    Args:
+        model_path: Path to the classifier.
+
+    Returns:
+        List of (weights of shape (inputs, outputs), bias, relu) per layer or
+        None if the classifier is not a plain stack of dense layers.
+    """
+    if model_path in LINEAR_HEADS:
+        return LINEAR_HEADS[model_path]
+
+    if model_path.endswith(".npz"):
+        layers = _readLinearHead(model_path)
+    else:
+        cache_path = getLinearHeadCachePath(model_path)
+        stat = os.stat(model_path)
+        source = np.array([stat.st_size, stat.st_mtime_ns])
+        layers = None
+
+        # Cache is only valid for the same model file
+        if cache_path and os.path.isfile(cache_path):
+            with np.load(cache_path) as data:
+                if "source" in data and np.array_equal(data["source"], source):
+                    layers = _readLinearHead(cache_path)
+
+        if layers is None:
+            layers = _extractLinearHead(model_path)
+
+            if layers and cache_path:
+                try:
+                    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+                    saveLinearHead(cache_path, layers, source=source)
+                except OSError:
+                    pass
+
+    LINEAR_HEADS[model_path] = layers
+
+    return layers
+
+
+def _applyLinearHead(x, layers: list):
+    """Evaluates dense layers, one matrix multiplication per layer.
+
+    Args:
+        x: The input features of shape (n, inputs).
+        layers: List of (weights, bias, relu), see loadLinearHead().
+
+    Returns:
+        The logits of shape (n, outputs).
+    """
+    for weights, bias, relu in layers:
+        x = np.dot(x, weights)
+        x += bias
+
+        if relu:
+            np.maximum(x, 0, out=x)
+
+    return x
+
+
 def predictFilter(lat, lon, week):
     """Predicts the probability for each species.
 
@@ -290,8 +769,18 @@ def explore(lat: float, lon: float, week: int):
     return l_filter
 
 
-def flat_sigmoid(x, sensitivity=-1):
-    return 1 / (1.0 + np.exp(sensitivity * np.clip(x, -15, 15)))
+def flat_sigmoid(x, sensitivity=-1, out=None):
+    if out is None:
+        return 1 / (1.0 + np.exp(sensitivity * np.clip(x, -15, 15)))
+
+    # Same computation without temporary arrays
+    np.clip(x, -15, 15, out=out)
+    out *= sensitivity
+    np.exp(out, out=out)
+    out += 1.0
+    np.reciprocal(out, out=out)
+
+    return out
 
 
 def predict(sample):
@@ -314,14 +803,8 @@ def predict(sample):
         loadModel()
 
     if PBMODEL == None:
-        # Reshape input tensor
-        INTERPRETER.resize_tensor_input(INPUT_LAYER_INDEX, [len(sample), *sample[0].shape])
-        INTERPRETER.allocate_tensors()
-
         # Make a prediction (Audio only for now)
-        INTERPRETER.set_tensor(INPUT_LAYER_INDEX, np.array(sample, dtype="float32"))
-        INTERPRETER.invoke()
-        prediction = INTERPRETER.get_tensor(OUTPUT_LAYER_INDEX)
+        prediction = _invoke(INTERPRETERS, cfg.MODEL_PATH, INPUT_LAYER_INDEX, OUTPUT_LAYER_INDEX, sample)
 
         return prediction
 
@@ -341,27 +824,96 @@ def predictWithCustomClassifier(sample):
     Returns:
         The prediction scores for the sample.
     """
+    return classify(embeddings(sample))
+
+
+def classify(feature_vector):
+    """Applies the custom classifier to embeddings.
+
+    Args:
+        feature_vector: Embeddings of shape (n, features), e.g. from the embedding cache.
+
+    Returns:
+        The prediction scores for the n embeddings.
+    """
     global C_INTERPRETER
 
+    # Plain dense classifiers are evaluated with NumPy
+    layers = loadLinearHead(cfg.CUSTOM_CLASSIFIER)
+
+    if layers:
+        return _applyLinearHead(np.asarray(feature_vector, dtype="float32"), layers)
+
     # Does interpreter exist?
     if C_INTERPRETER == None:
         loadCustomClassifier()
 
-    # Get embeddings
-    feature_vector = embeddings(sample)
-
-    # Reshape input tensor
-    C_INTERPRETER.resize_tensor_input(C_INPUT_LAYER_INDEX, [len(feature_vector), *feature_vector[0].shape])
-    C_INTERPRETER.allocate_tensors()
-
     # Make a prediction
-    C_INTERPRETER.set_tensor(C_INPUT_LAYER_INDEX, np.array(feature_vector, dtype="float32"))
-    C_INTERPRETER.invoke()
-    prediction = C_INTERPRETER.get_tensor(C_OUTPUT_LAYER_INDEX)
+    prediction = _invoke(C_INTERPRETERS, cfg.CUSTOM_CLASSIFIER, C_INPUT_LAYER_INDEX, C_OUTPUT_LAYER_INDEX, feature_vector)
 
     return prediction
 
 
+def predictWithHeads(sample, model_paths: list[str]):
+    """Applies several custom classifiers to the same embeddings.
+
+    The embeddings are computed only once, every classifier is a head on top of them.
+
+    Args:
+        sample: Audio samples.
+        model_paths: Paths to the custom classifiers.
+
+    Returns:
+        A list with the prediction scores of every classifier.
+    """
+    return classifyWithHeads(embeddings(sample), model_paths)
+
+
+def classifyWithHeads(feature_vector, model_paths: list[str]):
+    """Applies several custom classifiers to embeddings.
+
+    Single layer heads are stacked and evaluated with one matrix multiplication.
+
+    Args:
+        feature_vector: Embeddings of shape (n, features).
+        model_paths: Paths to the custom classifiers.
+
+    Returns:
+        A list with the prediction scores of every classifier.
+    """
+    feature_vector = np.asarray(feature_vector, dtype="float32")
+    heads = [loadLinearHead(model_path) for model_path in model_paths]
+
+    if all(layers and len(layers) == 1 for layers in heads):
+        key = tuple(model_paths)
+
+        if key not in STACKED_HEADS:
+            STACKED_HEADS[key] = (
+                np.ascontiguousarray(np.concatenate([layers[0][0] for layers in heads], axis=1)),
+                np.concatenate([layers[0][1] for layers in heads]),
+                np.cumsum([len(layers[0][1]) for layers in heads])[:-1],
+            )
+
+        weights, bias, splits = STACKED_HEADS[key]
+
+        return np.split(_applyLinearHead(feature_vector, [(weights, bias, False)]), splits, axis=1)
+
+    predictions = []
+
+    for model_path, layers in zip(model_paths, heads):
+        if layers:
+            predictions.append(_applyLinearHead(feature_vector, layers))
+            continue
+
+        if model_path not in C_HEADS:
+            loadCustomClassifier(model_path)
+
+        pool, input_index, output_index = C_HEADS[model_path]
+        predictions.append(_invoke(pool, model_path, input_index, output_index, feature_vector))
+
+    return predictions
+
+
 def embeddings(sample):
     """Extracts the embeddings for a sample.
 
@@ -377,13 +929,7 @@ def embeddings(sample):
     if INTERPRETER == None:
         loadModel(False)
 
-    # Reshape input tensor
-    INTERPRETER.resize_tensor_input(INPUT_LAYER_INDEX, [len(sample), *sample[0].shape])
-    INTERPRETER.allocate_tensors()
-
     # Extract feature embeddings
-    INTERPRETER.set_tensor(INPUT_LAYER_INDEX, np.array(sample, dtype="float32"))
-    INTERPRETER.invoke()
-    features = INTERPRETER.get_tensor(OUTPUT_LAYER_INDEX)
+    features = _invoke(INTERPRETERS, cfg.MODEL_PATH, INPUT_LAYER_INDEX, OUTPUT_LAYER_INDEX, sample)
 
     return features
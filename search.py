@@ -0,0 +1,393 @@
+"""Module to search for similar chunks in extracted embeddings.
+
+The index is an inverted file with product quantization (IVF-PQ) built on a
+dataset written by embeddings.py --consolidate. Embeddings are normalized, so
+distances rank by cosine similarity. Every vector is assigned to the nearest
+of n_lists coarse centroids, and its residual to that centroid is encoded with
+one byte per subvector. Assignment and encoding work on a PCA projection
+of the embeddings, which keeps building cheap for tens of millions of
+vectors. A query only scans the lists of its nprobe nearest
+centroids with table lookups, and the best candidates are re-ranked with the
+exact embeddings, which are memory-mapped from the dataset.
+
+The index is stored in the dataset folder as search_index.npz (projection,
+centroids, codebooks and list boundaries), search_codes.npy and search_ids.npy (codes and
+dataset rows sorted by list).
+"""
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+import audio
+import config as cfg
+import embeddings
+import model
+
+INDEX_NAME = "search_index.npz"
+CODES_NAME = "search_codes.npy"
+IDS_NAME = "search_ids.npy"
+
+# Number of vectors encoded at a time while building the index
+BLOCK_SIZE = 65536
+
+
+def _normalize(x):
+    """Scales vectors to unit length.
+
+    Args:
+        x: Vectors of shape (n, d).
+
+    Returns:
+        The normalized vectors as float32.
+    """
+    x = np.asarray(x, dtype="float32")
+
+    return x / np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-12)
+
+
+def _assign(x, centroids):
+    """Returns the index of the nearest centroid for each vector.
+
+    Args:
+        x: Vectors of shape (n, d).
+        centroids: Centroids of shape (k, d).
+
+    Returns:
+        The nearest centroid of each vector.
+    """
+    norms = (centroids * centroids).sum(axis=1)
+    assignment = np.empty(len(x), dtype="int64")
+
+    # ||x - c||^2 without the constant ||x||^2, in blocks that keep the distance matrix small
+    for i in range(0, len(x), 4096):
+        assignment[i : i + 4096] = np.argmin(norms - 2 * np.dot(x[i : i + 4096], centroids.T), axis=1)
+
+    return assignment
+
+
+def _kmeans(x, k: int, iterations: int = 10, seed: int = 0):
+    """Clusters vectors with Lloyd's algorithm.
+
+    Args:
+        x: Training vectors of shape (n, d).
+        k: Number of clusters.
+        iterations: Number of iterations.
+        seed: Seed for the initial centroids.
+
+    Returns:
+        The centroids of shape (k, d).
+    """
+    rng = np.random.default_rng(seed)
+    centroids = x[rng.choice(len(x), k, replace=False)].copy()
+
+    for _ in range(iterations):
+        assignment = _assign(x, centroids)
+        counts = np.bincount(assignment, minlength=k)
+        nonempty = counts > 0
+        order = np.argsort(assignment, kind="stable")
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[nonempty]
+
+        centroids[nonempty] = np.add.reduceat(x[order], starts, axis=0) / counts[nonempty, None]
+
+        # Empty clusters restart at random vectors
+        if not nonempty.all():
+            centroids[~nonempty] = x[rng.choice(len(x), int((~nonempty).sum()), replace=False)]
+
+    return centroids
+
+
+def _project(x, mean, projection):
+    """Normalizes vectors and projects them onto the principal components.
+
+    Args:
+        x: Vectors of shape (n, d).
+        mean: Mean of the normalized training vectors.
+        projection: Principal components of shape (d, components).
+
+    Returns:
+        The projected vectors of shape (n, components).
+    """
+    return np.dot(_normalize(x) - mean, projection)
+
+
+def build_index(dataset_path: str, n_lists: int = None, n_subvectors: int = 32, n_components: int = 128,
+                train_size: int = 100000, seed: int = 0):
+    """Builds the search index of a dataset.
+
+    Args:
+        dataset_path: Folder of a dataset written by embeddings.py --consolidate.
+        n_lists: Number of coarse centroids, defaults to 4 * sqrt(number of vectors).
+        n_subvectors: Number of bytes per encoded vector, reduced to a divisor of n_components.
+        n_components: Number of principal components the vectors are projected onto.
+        train_size: Number of vectors the centroids and codebooks are trained on.
+        seed: Seed for the training sample.
+    """
+    data, _, _, _ = embeddings.loadDataset(dataset_path)
+    n = len(data)
+    rng = np.random.default_rng(seed)
+
+    # Train on a sorted random sample, so the memory-mapped rows are read in order
+    sample = _normalize(data[np.sort(rng.choice(n, min(n, train_size), replace=False))])
+    mean = sample.mean(axis=0)
+    sample -= mean
+
+    # Principal components from the eigenvectors of the covariance, largest first
+    _, vectors = np.linalg.eigh(np.dot(sample.T, sample))
+    projection = np.ascontiguousarray(vectors[:, ::-1][:, : min(n_components, len(mean))])
+    sample = np.dot(sample, projection)
+
+    dim = projection.shape[1]
+    n_lists = max(1, min(n_lists or int(4 * np.sqrt(n)), len(sample)))
+    n_subvectors = max(m for m in range(1, min(n_subvectors, dim) + 1) if dim % m == 0)
+    sub_dim = dim // n_subvectors
+
+    centroids = _kmeans(sample, n_lists, seed=seed)
+
+    # Codebooks only need a few hundred residuals per code
+    subset = sample[rng.choice(len(sample), min(len(sample), 256 * 256), replace=False)]
+    residuals = subset - centroids[_assign(subset, centroids)]
+    n_codes = min(256, len(residuals))
+    codebooks = np.stack(
+        [_kmeans(residuals[:, j * sub_dim : (j + 1) * sub_dim], n_codes, seed=seed) for j in range(n_subvectors)]
+    )
+
+    # Encode all vectors block by block
+    lists = np.empty(n, dtype="int32")
+    codes = np.empty((n, n_subvectors), dtype="uint8")
+
+    for i in range(0, n, BLOCK_SIZE):
+        x = _project(data[i : i + BLOCK_SIZE], mean, projection)
+        lists[i : i + BLOCK_SIZE] = _assign(x, centroids)
+        residuals = x - centroids[lists[i : i + BLOCK_SIZE]]
+
+        for j in range(n_subvectors):
+            codes[i : i + BLOCK_SIZE, j] = _assign(residuals[:, j * sub_dim : (j + 1) * sub_dim], codebooks[j])
+
+    # Vectors of a list are stored next to each other
+    order = np.argsort(lists, kind="stable")
+    list_offsets = np.concatenate([[0], np.cumsum(np.bincount(lists, minlength=n_lists))]).astype("int64")
+
+    np.save(os.path.join(dataset_path, CODES_NAME), codes[order])
+    np.save(os.path.join(dataset_path, IDS_NAME), order.astype("int64"))
+    np.savez(
+        os.path.join(dataset_path, INDEX_NAME),
+        mean=mean,
+        projection=projection,
+        centroids=centroids.astype("float32"),
+        codebooks=codebooks.astype("float32"),
+        list_offsets=list_offsets,
+    )
+
+
+class SearchIndex:
+    """The search index of a dataset.
+
+    Codes and embeddings are memory-mapped, so only the lists that are
+    scanned and the re-ranked rows are read from disk.
+    """
+
+    def __init__(self, dataset_path: str):
+        """Loads the index, it must have been built with build_index().
+
+        Args:
+            dataset_path: Folder of the dataset.
+        """
+        with np.load(os.path.join(dataset_path, INDEX_NAME)) as index:
+            self.mean = index["mean"]
+            self.projection = index["projection"]
+            self.centroids = index["centroids"]
+            self.codebooks = index["codebooks"]
+            self.list_offsets = index["list_offsets"]
+
+        self.codes = np.load(os.path.join(dataset_path, CODES_NAME), mmap_mode="r")
+        self.ids = np.load(os.path.join(dataset_path, IDS_NAME), mmap_mode="r")
+        self.embeddings, self.timestamps, self.offsets, self.files = embeddings.loadDataset(dataset_path)
+
+        # Queries have to be cut like the dataset
+        with open(os.path.join(dataset_path, "index.json"), "r") as f:
+            settings = json.load(f)
+            self.sample_rate, self.sig_length = settings["sample_rate"], settings["sig_length"]
+            self.sig_overlap = settings["overlap"]
+
+            # Datasets written before the minimum length was recorded
+            self.sig_minlen = settings.get("minlen", cfg.SIG_MINLEN)
+
+        self.centroid_norms = (self.centroids * self.centroids).sum(axis=1)
+        self.codebook_norms = (self.codebooks * self.codebooks).sum(axis=2)
+
+    def _scan(self, q, nprobe: int):
+        """Returns the approximate squared distances of the vectors in the nearest lists.
+
+        Args:
+            q: Projected query of shape (components,).
+            nprobe: Number of lists to scan.
+
+        Returns:
+            The positions in the sorted codes and their distances.
+        """
+        distances = self.centroid_norms - 2 * np.dot(self.centroids, q)
+        probes = np.argpartition(distances, nprobe - 1)[:nprobe] if nprobe < len(distances) else np.arange(len(distances))
+        n_subvectors, _, sub_dim = self.codebooks.shape
+        positions, estimates = [], []
+
+        for l in probes:
+            start, end = self.list_offsets[l], self.list_offsets[l + 1]
+
+            if start == end:
+                continue
+
+            # Lookup table of the squared distances between each residual subvector and its codes
+            r = (q - self.centroids[l]).reshape(n_subvectors, sub_dim)
+            table = self.codebook_norms - 2 * np.einsum("md,mcd->mc", r, self.codebooks) + (r * r).sum(axis=1)[:, None]
+
+            positions.append(np.arange(start, end))
+            estimates.append(table[np.arange(n_subvectors), self.codes[start:end]].sum(axis=1))
+
+        if not positions:
+            return np.zeros(0, dtype="int64"), np.zeros(0, dtype="float32")
+
+        return np.concatenate(positions), np.concatenate(estimates)
+
+    def search(self, queries, k: int = 10, nprobe: int = 16, rerank: int = 10):
+        """Finds the most similar chunks.
+
+        Args:
+            queries: Embeddings of shape (n, d), e.g. of the chunks of a query clip.
+            k: Number of results.
+            nprobe: Number of lists scanned per query, more lists find more true neighbours but take longer.
+            rerank: Number of candidates per result that are re-ranked with the exact embeddings,
+                0 to rank by the approximate distances of the projected vectors.
+
+        Returns:
+            The dataset rows and their cosine similarities, best first. Each row is
+            scored with the query it is most similar to.
+        """
+        best = {}
+
+        queries = _normalize(queries)
+
+        for q, p in zip(queries, np.dot(queries - self.mean, self.projection)):
+            positions, estimates = self._scan(p, nprobe)
+            n_candidates = min(len(positions), k * max(1, rerank))
+
+            if not n_candidates:
+                continue
+
+            top = np.argpartition(estimates, n_candidates - 1)[:n_candidates]
+            rows = np.sort(self.ids[positions[top]])
+
+            if rerank:
+                scores = np.dot(_normalize(self.embeddings[rows]), q)
+            else:
+                scores = 1.0 - 0.5 * estimates[top][np.argsort(self.ids[positions[top]])]
+
+            for row, score in zip(rows.tolist(), scores.tolist()):
+                if score > best.get(row, -np.inf):
+                    best[row] = score
+
+        ranked = sorted(best.items(), key=lambda item: item[1], reverse=True)[:k]
+
+        return np.array([row for row, _ in ranked], dtype="int64"), np.array([s for _, s in ranked], dtype="float32")
+
+    def describe(self, rows):
+        """Returns the file and time span of dataset rows.
+
+        Args:
+            rows: Dataset rows.
+
+        Returns:
+            A list of (file, start, end).
+        """
+        files = np.searchsorted(self.offsets, rows, side="right") - 1
+
+        return [(self.files[f], float(self.timestamps[r][0]), float(self.timestamps[r][1])) for f, r in zip(files, rows)]
+
+
+def embed_clip(path: str, sample_rate: int = None, sig_length: float = None, sig_overlap: float = None,
+               sig_minlen: float = None):
+    """Computes the embeddings of the chunks of an audio clip.
+
+    Args:
+        path: Path to the audio file.
+        sample_rate: Sample rate the clip is resampled to, defaults to cfg.SAMPLE_RATE.
+        sig_length: Length of the chunks in seconds, defaults to cfg.SIG_LENGTH.
+        sig_overlap: Overlap of the chunks in seconds, defaults to cfg.SIG_OVERLAP.
+        sig_minlen: Minimum length of the last chunk in seconds, defaults to cfg.SIG_MINLEN.
+
+    Returns:
+        The embeddings of shape (chunks, features).
+
+    Raises:
+        ValueError: If the clip is shorter than the minimum length.
+    """
+    sample_rate = sample_rate or cfg.SAMPLE_RATE
+    sig_length = sig_length or cfg.SIG_LENGTH
+    sig_overlap = cfg.SIG_OVERLAP if sig_overlap is None else sig_overlap
+    sig_minlen = cfg.SIG_MINLEN if sig_minlen is None else sig_minlen
+
+    blocks, _ = audio.openAudioStream(path, sample_rate)
+    batches = audio.splitSignalStream(blocks, sample_rate, sig_length, sig_overlap, sig_minlen, cfg.BATCH_SIZE)
+    e = [model.embeddings(samples) for samples in batches]
+
+    if not e:
+        raise ValueError(f"Clip too short, it must be at least {sig_minlen} seconds long.")
+
+    return np.concatenate(e)
+
+
+def search_clip(index: SearchIndex, path: str, k: int = 10, nprobe: int = 16):
+    """Finds the chunks most similar to an audio clip.
+
+    The clip is cut with the settings of the dataset, not the ones in cfg.
+
+    Args:
+        index: The search index.
+        path: Path to the query audio file.
+        k: Number of results.
+        nprobe: Number of lists scanned per query chunk.
+
+    Returns:
+        A list of (file, start, end, similarity), best first.
+    """
+    queries = embed_clip(path, index.sample_rate, index.sig_length, index.sig_overlap, index.sig_minlen)
+    rows, scores = index.search(queries, k, nprobe)
+
+    return [(*match, float(score)) for match, score in zip(index.describe(rows), scores)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Search for chunks that are similar to an audio clip.")
+    parser.add_argument("--dataset", required=True, help="Folder of a dataset written by embeddings.py --consolidate.")
+    parser.add_argument("--build", action="store_true", help="Build the search index of the dataset.")
+    parser.add_argument("--lists", type=int, default=0, help="Number of lists of the index. Defaults to 4 * sqrt(chunks).")
+    parser.add_argument("--subvectors", type=int, default=32, help="Bytes per chunk in the index. Defaults to 32.")
+    parser.add_argument("--components", type=int, default=128, help="Dimensions the index works on. Defaults to 128.")
+    parser.add_argument("--i", default="", help="Path to the query audio clip.")
+    parser.add_argument("--k", type=int, default=10, help="Number of results. Defaults to 10.")
+    parser.add_argument("--nprobe", type=int, default=16, help="Number of lists scanned per query. Defaults to 16.")
+    parser.add_argument("--batchsize", type=int, default=1, help="Number of query chunks embedded at the same time.")
+
+    args = parser.parse_args()
+
+    # Set paths relative to script path
+    cfg.MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])), cfg.MODEL_PATH)
+    cfg.BATCH_SIZE = max(1, int(args.batchsize))
+
+    if args.build:
+        build_index(args.dataset, args.lists or None, args.subvectors, args.components)
+        print(f"Built search index in {args.dataset}")
+
+    if args.i:
+        index = SearchIndex(args.dataset)
+
+        print("File,Start (s),End (s),Similarity")
+
+        for fpath, start, end, score in search_clip(index, args.i, args.k, args.nprobe):
+            print("{},{},{},{:.4f}".format(fpath, start, end, score))
+
+    # A few examples to test
+    # python3 search.py --dataset example/dataset --build
+    # python3 search.py --dataset example/dataset --i example/call.wav --k 20
@@ -82,24 +82,35 @@ def parseFiles(flist: list[dict], max_segments=100):
         max_segments: Number of segments per species.
 
     Returns:
-        TODO @kahst
+        A list of (audio file path, segments), see selectSegments().
     """
-    species_segments: dict[str, list] = {}
+    segments: list[dict] = []
 
     for f in flist:
-        # Paths
-        afile = f["audio"]
-        rfile = f["result"]
-
         # Get all segments for result file
-        segments = findSegments(afile, rfile)
+        segments.extend(findSegments(f["audio"], f["result"]))
+
+    return selectSegments(segments, max_segments)
+
 
-        # Parse segments by species
-        for s in segments:
-            if s["species"] not in species_segments:
-                species_segments[s["species"]] = []
+def selectSegments(segments: list[dict], max_segments=100):
+    """Selects random segments per species and groups them by audio file.
 
-            species_segments[s["species"]].append(s)
+    Args:
+        segments: List of dicts as returned by findSegments().
+        max_segments: Number of segments per species.
+
+    Returns:
+        A list of (audio file path, segments).
+    """
+    species_segments: dict[str, list] = {}
+
+    # Parse segments by species
+    for s in segments:
+        if s["species"] not in species_segments:
+            species_segments[s["species"]] = []
+
+        species_segments[s["species"]].append(s)
 
     # Shuffle segments for each species and limit to max_segments
     for s in species_segments:
@@ -193,26 +204,37 @@ def findSegments(afile: str, rfile: str):
     return segments
 
 
-def extractSegments(item: tuple[tuple[str, list[dict]], float, dict[str]]):
+def extractSegments(item: tuple[tuple[str, list[dict]], float], output_path: str = None):
     """Saves each segment separately.
 
     Creates an audio file for each species segment.
 
+    Worker processes get the config from utils.initWorker().
+
     Args:
-        item: A tuple that contains ((audio file path, segments), segment length, config)
+        item: A tuple that contains ((audio file path, segments), segment length)
+        output_path: Folder for the species folders of the segments, defaults to cfg.OUTPUT_PATH.
     """
-    # Paths and config
+    # Paths and segment length
     afile = item[0][0]
     segments = item[0][1]
     seg_length = item[1]
-    cfg.set_config(item[2])
 
     # Status
     print(f"Extracting segments from {afile}")
 
+    # Sample ranges of the segments, centered on the detections
+    ranges = []
+
+    for seg in segments:
+        start = int(seg["start"] * cfg.SAMPLE_RATE)
+        end = int(seg["end"] * cfg.SAMPLE_RATE)
+        offset = int((seg_length * cfg.SAMPLE_RATE) - (end - start)) // 2
+        ranges.append((max(0, start - offset), end + offset))
+
     try:
-        # Open audio file
-        sig, _ = audio.openAudioFile(afile, cfg.SAMPLE_RATE)
+        # Only decode the ranges of the segments
+        signals = audio.readAudioRanges(afile, ranges, cfg.SAMPLE_RATE)
     except Exception as ex:
         print(f"Error: Cannot open audio file {afile}", flush=True)
         utils.writeErrorLog(ex)
@@ -220,22 +242,12 @@ def extractSegments(item: tuple[tuple[str, list[dict]], float, dict[str]]):
         return
 
     # Extract segments
-    for seg_cnt, seg in enumerate(segments, 1):
+    for seg_cnt, (seg, seg_sig) in enumerate(zip(segments, signals), 1):
         try:
-            # Get start and end times
-            start = int(seg["start"] * cfg.SAMPLE_RATE)
-            end = int(seg["end"] * cfg.SAMPLE_RATE)
-            offset = ((seg_length * cfg.SAMPLE_RATE) - (end - start)) // 2
-            start = max(0, start - offset)
-            end = min(len(sig), end + offset)
-
             # Make sure segment is long enough
-            if end > start:
-                # Get segment raw audio from signal
-                seg_sig = sig[int(start) : int(end)]
-
+            if len(seg_sig) > 0:
                 # Make output path
-                outpath = os.path.join(cfg.OUTPUT_PATH, seg["species"])
+                outpath = os.path.join(output_path or cfg.OUTPUT_PATH, seg["species"])
                 os.makedirs(outpath, exist_ok=True)
 
                 # Save segment
@@ -286,19 +298,17 @@ if __name__ == "__main__":
     # Parse file list and make list of segments
     cfg.FILE_LIST = parseFiles(cfg.FILE_LIST, max(1, int(args.max_segments)))
 
-    # Add config items to each file list entry.
-    # We have to do this for Windows which does not
-    # support fork() and thus each process has to
-    # have its own config. USE LINUX!
-    flist = [(entry, max(cfg.SIG_LENGTH, float(args.seg_length)), cfg.get_config()) for entry in cfg.FILE_LIST]
+    # Add the segment length to each file list entry
+    flist = [(entry, max(cfg.SIG_LENGTH, float(args.seg_length))) for entry in cfg.FILE_LIST]
 
-    # Extract segments
+    # Extract segments, workers get the config once from the pool initializer
     if cfg.CPU_THREADS < 2:
         for entry in flist:
             extractSegments(entry)
     else:
-        with Pool(cfg.CPU_THREADS) as p:
-            p.map(extractSegments, flist)
+        with Pool(cfg.CPU_THREADS, initializer=utils.initWorker, initargs=(cfg.get_config(),)) as p:
+            for _ in p.imap_unordered(extractSegments, flist, utils.getChunksize(len(flist), cfg.CPU_THREADS)):
+                pass
 
     # A few examples to test
     # python3 segments.py --audio example/ --results example/ --o example/segments/
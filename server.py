@@ -13,9 +13,15 @@ import bottle
 
 import analyze # TODO: Could use bat_ident in the future instead
 import config as cfg
+import detection_db
+import embedding_cache
+import search
 import species
 import utils
 
+# Search index for the /search endpoint, loaded with --search
+SEARCH_INDEX: search.SearchIndex = None
+
 
 def resultPooling(lines: list[str], num_results=5, pmode="avg"):
     """Parses the results into list of (species, score).
@@ -65,6 +71,60 @@ def healthcheck():
     return json.dumps({"msg": "Server is healthy."})
 
 
+@bottle.route("/search", method="POST")
+def handleSearchRequest():
+    """Handles a similarity search request.
+
+    Takes a POST request with an audio clip and returns the most similar
+    chunks of the dataset given with --search.
+
+    Returns:
+        A json response with the matches.
+    """
+    if SEARCH_INDEX is None:
+        return json.dumps({"msg": "No search index."})
+
+    upload = bottle.request.files.get("audio")
+    mdata = json.loads(bottle.request.forms.get("meta", "{}"))
+
+    if not upload:
+        return json.dumps({"msg": "No audio file."})
+
+    ext = os.path.splitext(upload.filename.lower())[1]
+
+    if ext[1:] not in cfg.ALLOWED_FILETYPES:
+        return json.dumps({"msg": "Filetype not supported."})
+
+    file_path_tmp = tempfile.NamedTemporaryFile(suffix=ext, delete=False)
+    file_path_tmp.close()
+
+    try:
+        upload.save(file_path_tmp.name, overwrite=True)
+
+        k = min(1000, max(1, int(mdata.get("k", 10))))
+        nprobe = max(1, int(mdata.get("nprobe", 16)))
+        matches = search.search_clip(SEARCH_INDEX, file_path_tmp.name, k, nprobe)
+
+        return json.dumps(
+            {
+                "msg": "success",
+                "results": [
+                    {"file": fpath, "start": start, "end": end, "similarity": score}
+                    for fpath, start, end, score in matches
+                ],
+            }
+        )
+
+    except Exception as e:
+        # Write error log
+        print(f"Error: Cannot search for {upload.filename}.", flush=True)
+        utils.writeErrorLog(e)
+
+        return json.dumps({"msg": f"Error during search: {e}"})
+    finally:
+        os.unlink(file_path_tmp.name)
+
+
 @bottle.route("/analyze", method="POST")
 def handleRequest():
     """Handles a classification request.
@@ -149,7 +209,7 @@ def handleRequest():
             cfg.SPECIES_LIST = []
 
         # Analyze file
-        success, results = analyze.analyzeFile((file_path, cfg.get_config()))
+        success, results = analyze.analyzeFile(file_path)
 
         # Parse results
         if success:
@@ -167,6 +227,29 @@ def handleRequest():
             # Prepare response
             data = {"msg": "success", "results": results, "meta": mdata}
 
+            # Store detections in the database, a database error does not fail the analysis
+            if cfg.DB_PATH:
+                try:
+                    # Uploads that are not saved often share names like audio.wav, the content hash keeps them apart
+                    if mdata.get("save", False):
+                        db_name = file_path
+                    else:
+                        db_name = "upload/{}/{}".format(embedding_cache.get_content_hash(file_path), upload.filename)
+
+                    detection_db.add_detections(
+                        file_path,
+                        (
+                            (*map(float, timestamp.split("-", 1)), label, float(score))
+                            for timestamp, scores in results.items()
+                            for label, score in scores
+                            if float(score) > cfg.MIN_CONFIDENCE
+                        ),
+                        name=db_name,
+                    )
+                except Exception as ex:
+                    print(f"Error: Cannot store detections of {file_path} in the database.", flush=True)
+                    utils.writeErrorLog(ex)
+
             # Save response as metadata file
             if mdata.get("save", False):
                 with open(file_path.rsplit(".", 1)[0] + ".json", "w") as f:
@@ -290,6 +373,14 @@ if __name__ == "__main__":
         "--spath", default="uploads/", help="Path to folder where uploaded files should be stored. Defaults to '/uploads'."
     )
     parser.add_argument("--threads", type=int, default=4, help="Number of CPU threads for analysis. Defaults to 4.")
+    parser.add_argument(
+        "--db", default="", help="Path to a SQLite database the detections are stored in. Defaults to '' (off)."
+    )
+    parser.add_argument(
+        "--search",
+        default="",
+        help="Path to a dataset with a search index (see search.py) for the /search endpoint. Defaults to '' (off).",
+    )
     parser.add_argument(
         "--locale",
         default="en",
@@ -337,6 +428,15 @@ if __name__ == "__main__":
     # Set number of TFLite threads
     cfg.TFLITE_THREADS = max(1, int(args.threads))
 
+    # Open detection database
+    if args.db:
+        cfg.DB_PATH = args.db
+        cfg.DB_RUN_ID = detection_db.start_run("server")
+
+    # Load search index
+    if args.search:
+        SEARCH_INDEX = search.SearchIndex(args.search)
+
     # Run server
     print(f"UP AND RUNNING! LISTENING ON {args.host}:{args.port}", flush=True)
 
@@ -0,0 +1,44 @@
+"""Shared fixtures of the tests.
+
+The modules of the analyzer live in the repository root, which is added to
+the import path here, so the tests run with `python -m pytest` from the root.
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config as cfg  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def restore_config():
+    """Restores the config after every test, the modules read it as globals."""
+    config = cfg.get_config()
+
+    yield
+
+    cfg.set_config(config)
+
+
+@pytest.fixture
+def write_wav(tmp_path):
+    """Returns a function that writes random noise as 16 bit WAV file.
+
+    The function takes the file name, the duration in seconds, the sample rate
+    and the number of channels and returns the path of the file.
+    """
+    import soundfile as sf
+
+    def write(name: str, seconds: float, rate: int, channels: int = 1, seed: int = 0):
+        rng = np.random.default_rng(seed)
+        sig = rng.uniform(-0.5, 0.5, (int(seconds * rate), channels)).astype("float32")
+        path = str(tmp_path / name)
+        sf.write(path, sig, rate, "PCM_16")
+
+        return path
+
+    return write
@@ -0,0 +1,112 @@
+"""Regression tests of the streaming decoder and chunker against the whole-file baseline."""
+import numpy as np
+import pytest
+
+import audio
+import config as cfg
+
+
+def stream_chunks(blocks, rate, seconds, overlap, minlen, batch_size):
+    batches = list(audio.splitSignalStream(blocks, rate, seconds, overlap, minlen, batch_size))
+
+    return np.concatenate(batches) if batches else np.zeros((0, int(seconds * rate)), dtype="float32")
+
+
+@pytest.mark.parametrize("overlap", [0.0, 0.1, 0.25])
+@pytest.mark.parametrize("block_size", [997, 4000, 100000])
+@pytest.mark.parametrize("batch_size", [1, 3, 16])
+def test_split_signal_stream_matches_split_signal(overlap, block_size, batch_size):
+    rate, seconds, minlen = 8000, 0.5, 0.5 / 3
+    sig = np.random.default_rng(1).uniform(-1, 1, 23 * 1000 + 517).astype("float32")
+    expected = audio.splitSignal(sig, rate, seconds, overlap, minlen)
+
+    blocks = (sig[i : i + block_size] for i in range(0, len(sig), block_size))
+    chunks = stream_chunks(blocks, rate, seconds, overlap, minlen, batch_size)
+
+    assert chunks.shape == (len(expected), int(seconds * rate))
+
+    # The chunks that lie inside the signal are identical, the padded end only in its signal part
+    length = int(seconds * rate)
+    step = int((seconds - overlap) * rate)
+
+    for i, split in enumerate(expected):
+        n = min(length, len(sig) - i * step)
+        np.testing.assert_array_equal(chunks[i][:n], split[:n])
+
+
+def test_split_signal_stream_short_signal():
+    rate, seconds, minlen = 8000, 0.5, 0.5 / 3
+    short = np.ones(int(minlen * rate) - 1, dtype="float32")
+
+    assert len(stream_chunks([short], rate, seconds, 0.0, minlen, 4)) == 0
+    assert len(audio.splitSignal(short, rate, seconds, 0.0, minlen)) == 0
+
+
+def test_chunk_signal_is_a_view():
+    sig = np.arange(100, dtype="float32")
+    chunks = audio.chunkSignal(sig, 10, 2.0, 0.5)
+
+    assert chunks.shape == (6, 20)
+    assert np.shares_memory(chunks, sig)
+    np.testing.assert_array_equal(chunks[1], sig[15:35])
+
+
+def test_native_stream_matches_open_audio_file(write_wav):
+    path = write_wav("native.wav", 2.3, cfg.SAMPLE_RATE)
+    sig, _ = audio.openAudioFile(path, cfg.SAMPLE_RATE)
+    blocks, decoder = audio.openAudioStream(path, cfg.SAMPLE_RATE, block_seconds=0.3)
+
+    assert decoder == "native"
+    np.testing.assert_array_equal(np.concatenate(list(blocks)), sig)
+
+
+def test_stereo_stream_is_mixed_down(write_wav):
+    path = write_wav("stereo.wav", 1.0, cfg.SAMPLE_RATE, channels=2)
+    sig, _ = audio.openAudioFile(path, cfg.SAMPLE_RATE)
+    blocks, decoder = audio.openAudioStream(path, cfg.SAMPLE_RATE, block_seconds=0.3)
+
+    assert decoder == "soundfile"
+    assert sig.ndim == 1
+    np.testing.assert_allclose(np.concatenate(list(blocks)), sig, atol=1e-7)
+
+
+@pytest.mark.parametrize("resampler", ["polyphase", "kaiser_fast"])
+def test_resampled_stream_matches_open_audio_file(write_wav, resampler):
+    cfg.RESAMPLE_TYPE = resampler
+    path = write_wav("resampled.wav", 2.1, 384000)
+    sig, rate = audio.openAudioFile(path, cfg.SAMPLE_RATE)
+    blocks, decoder = audio.openAudioStream(path, cfg.SAMPLE_RATE, block_seconds=0.25)
+    streamed = np.concatenate(list(blocks))
+
+    assert rate == cfg.SAMPLE_RATE
+    assert decoder == f"soundfile+{resampler}"
+    assert len(streamed) == len(sig)
+    np.testing.assert_allclose(streamed, sig, atol=1e-4)
+
+
+def test_polyphase_matches_kaiser_fast_baseline():
+    pytest.importorskip("librosa")
+
+    # A tone well below the new Nyquist frequency passes both filters unchanged
+    t = np.arange(38400) / 384000
+    sig = np.sin(2 * np.pi * 20000 * t).astype("float32")
+    polyphase = audio.resample(sig, 384000, 256000, "polyphase")
+    kaiser = audio.resample(sig, 384000, 256000, "kaiser_fast")
+
+    assert polyphase.dtype == np.float32
+    assert len(polyphase) == len(kaiser) == 25600
+    np.testing.assert_allclose(polyphase[500:-500], kaiser[500:-500], atol=5e-3)
+
+
+@pytest.mark.parametrize("rate", [256000, 384000])
+def test_range_read_matches_whole_file(write_wav, rate):
+    path = write_wav("range.wav", 3.0, rate)
+    sig = np.concatenate(list(audio.openAudioStream(path, cfg.SAMPLE_RATE, block_seconds=0.5)[0]))
+    offset, duration = 1.25, 0.8
+    start = int(round(offset * cfg.SAMPLE_RATE))
+
+    blocks, _ = audio.openAudioStream(path, cfg.SAMPLE_RATE, 0.5, offset, duration)
+    part = np.concatenate(list(blocks))
+
+    assert len(part) == int(round(duration * cfg.SAMPLE_RATE))
+    np.testing.assert_allclose(part, sig[start : start + len(part)], atol=1e-4)
@@ -0,0 +1,145 @@
+"""Regression tests of the job ranges and the result extraction of bat_ident.py."""
+import operator
+
+import numpy as np
+import pytest
+
+import bat_ident
+import config as cfg
+
+LABELS = [f"Species {i}_Common {i}" for i in range(12)]
+
+
+@pytest.fixture(autouse=True)
+def labels():
+    cfg.LABELS = LABELS
+    cfg.TRANSLATED_LABELS = LABELS
+    cfg.SPECIES_LIST = []
+    cfg.CODES = {}
+    cfg.MIN_CONFIDENCE = 0.1
+    cfg.TOP_K = 0
+
+
+def baseline_detections(prediction):
+    """The detections as the baseline analyze_file() and save_result_file() found them."""
+    detections = []
+
+    for chunk, pred in enumerate(prediction):
+        for label, score in sorted(zip(cfg.LABELS, pred), key=operator.itemgetter(1), reverse=True):
+            if score > cfg.MIN_CONFIDENCE and (not cfg.SPECIES_LIST or label in cfg.SPECIES_LIST):
+                detections.append((chunk, cfg.LABELS.index(label), score))
+
+    return detections
+
+
+def as_list(detections):
+    return list(zip(*(d.tolist() for d in detections)))
+
+
+@pytest.mark.parametrize("min_conf", [0.1, 0.5, 0.9])
+@pytest.mark.parametrize("species_list", [[], LABELS[2:7]])
+def test_extract_detections_matches_baseline(min_conf, species_list):
+    cfg.MIN_CONFIDENCE = min_conf
+    cfg.SPECIES_LIST = species_list
+    prediction = np.random.default_rng(2).random((40, len(LABELS)), dtype="float32")
+
+    # Ties are kept in label order like the stable sort of the baseline
+    prediction[3, [1, 4, 8]] = 0.95
+
+    assert as_list(bat_ident.extract_detections(prediction)) == baseline_detections(prediction)
+
+
+def test_extract_detections_top_k():
+    cfg.TOP_K = 3
+    prediction = np.random.default_rng(3).random((20, len(LABELS)), dtype="float32")
+    chunk_idx, label_idx, scores = bat_ident.extract_detections(prediction, first_chunk=100)
+
+    for chunk in range(20):
+        best = np.argsort(prediction[chunk])[::-1][:3]
+        expected = [label for label in best if prediction[chunk, label] > cfg.MIN_CONFIDENCE]
+
+        assert label_idx[chunk_idx == chunk + 100].tolist() == expected
+
+
+def test_extract_detections_empty():
+    chunk_idx, label_idx, scores = bat_ident.extract_detections(np.zeros((0, len(LABELS))))
+
+    assert len(chunk_idx) == len(label_idx) == len(scores) == 0
+
+
+@pytest.mark.parametrize("overlap", [0.0, 0.1, 0.2])
+def test_collect_results_timestamps(overlap):
+    cfg.SIG_OVERLAP = overlap
+    step = cfg.SIG_LENGTH - overlap
+    predictions = [np.zeros((7, len(LABELS))), np.zeros((5, len(LABELS)))]
+    timestamps, _ = bat_ident.collect_results(predictions)
+
+    assert len(timestamps) == 12
+    assert timestamps[0] == ("0", str(cfg.SIG_LENGTH))
+
+    for i, (start, end) in enumerate(timestamps):
+        assert float(start) == pytest.approx(i * step)
+        assert float(end) == pytest.approx(i * step + cfg.SIG_LENGTH)
+
+        # No float noise such as 2.7750000000000004 in the result files
+        assert len(start.split(".")[-1]) <= 6
+
+    # A time range gives the same timestamps as the whole file
+    assert bat_ident.collect_results([np.zeros((4, len(LABELS)))], first_chunk=5)[0] == timestamps[5:9]
+
+
+@pytest.mark.parametrize("cpu_threads, job_length", [(4, 60.0), (8, 600.0), (3, 100.0)])
+def test_get_jobs_ranges_cover_every_chunk_once(write_wav, cpu_threads, job_length):
+    cfg.CPU_THREADS = cpu_threads
+    cfg.JOB_LENGTH = job_length
+    step = cfg.SIG_LENGTH - cfg.SIG_OVERLAP
+    durations = {"long.wav": 190.0, "short.wav": 5.0, "medium.wav": 75.0}
+
+    # Only the header is read, so the files are written at a low rate
+    files = {write_wav(name, seconds, 1000): seconds for name, seconds in durations.items()}
+    jobs = bat_ident.get_jobs(list(files))
+
+    assert sorted({fpath for fpath, _, _ in jobs}) == sorted(files)
+    assert len([f for f, _, _ in jobs if f.endswith("long.wav")]) > 1
+    assert len([f for f, _, _ in jobs if f.endswith("short.wav")]) == 1
+
+    for fpath, duration in files.items():
+        ranges = sorted((first, n) for f, first, n in jobs if f == fpath)
+        n_chunks = int(np.ceil(duration / step))
+
+        # Consecutive ranges of whole chunks, the last one reads to the end of the file
+        assert ranges[0][0] == 0
+        assert ranges[-1][1] is None
+        assert all(n is not None and n > 0 for _, n in ranges[:-1])
+        assert all(first + n == following for (first, n), (following, _) in zip(ranges, ranges[1:]))
+        assert ranges[-1][0] < n_chunks
+
+    # Longest jobs first
+    lengths = [(n or int(np.ceil(files[f] / step)) - first) for f, first, n in jobs]
+    assert lengths == sorted(lengths, reverse=True)
+
+
+def test_get_jobs_without_split(write_wav):
+    cfg.JOB_LENGTH = 60.0
+    files = [write_wav("a.wav", 200.0, 1000), write_wav("b.wav", 300.0, 1000)]
+
+    cfg.CPU_THREADS = 1
+    assert bat_ident.get_jobs(files) == [(files[1], 0, None), (files[0], 0, None)]
+
+    cfg.CPU_THREADS = 4
+    assert bat_ident.get_jobs(files, split=False) == [(files[1], 0, None), (files[0], 0, None)]
+
+    cfg.JOB_LENGTH = 0.0
+    assert len(bat_ident.get_jobs(files)) == 2
+
+
+def test_merged_ranges_match_whole_file():
+    cfg.SIG_OVERLAP = 0.1
+    prediction = np.random.default_rng(4).random((50, len(LABELS)), dtype="float32")
+    whole = bat_ident.collect_results([prediction])
+
+    parts = [{None: bat_ident.collect_results([prediction[first : first + 16]], first)} for first in range(0, 50, 16)]
+    timestamps, detections = bat_ident.merge_results(parts)[None]
+
+    assert timestamps == whole[0]
+    assert as_list(detections) == as_list(whole[1])
@@ -0,0 +1,123 @@
+"""Tests of the keys and the shards of the embedding cache."""
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+import config as cfg
+import embedding_cache
+
+
+@pytest.fixture(autouse=True)
+def cache(tmp_path):
+    model_path = tmp_path / "model.tflite"
+    model_path.write_bytes(b"model")
+    cfg.MODEL_PATH = str(model_path)
+    cfg.EMBEDDING_CACHE_PATH = str(tmp_path / "cache")
+    cfg.NOISE_PROFILE = ""
+
+    return cfg.EMBEDDING_CACHE_PATH
+
+
+@pytest.fixture
+def audio_file(tmp_path):
+    path = tmp_path / "recording.wav"
+    path.write_bytes(os.urandom(4096))
+
+    return str(path)
+
+
+@pytest.mark.parametrize(
+    "name, value",
+    [
+        ("SAMPLE_RATE", 384000),
+        ("SIG_LENGTH", 1.0),
+        ("SIG_OVERLAP", 0.1),
+        ("SIG_MINLEN", 0.5),
+        ("RESAMPLE_TYPE", "kaiser_fast"),
+    ],
+)
+def test_key_changes_with_chunk_geometry(audio_file, name, value):
+    key = embedding_cache.get_key(audio_file)
+    setattr(cfg, name, value)
+
+    assert embedding_cache.get_key(audio_file) != key
+
+
+def test_key_changes_with_content_and_model(tmp_path, audio_file):
+    key = embedding_cache.get_key(audio_file)
+
+    with open(audio_file, "ab") as f:
+        f.write(b"\1")
+
+    assert embedding_cache.get_key(audio_file) != key
+
+    key = embedding_cache.get_key(audio_file)
+    other_model = tmp_path / "other.tflite"
+    other_model.write_bytes(b"other model")
+    cfg.MODEL_PATH = str(other_model)
+
+    assert embedding_cache.get_key(audio_file) != key
+
+
+def test_key_changes_with_geometry_and_noise_profile(tmp_path, audio_file):
+    key = embedding_cache.get_key(audio_file)
+
+    assert embedding_cache.get_key(audio_file, "center") != key
+
+    profile = tmp_path / "noise.prof"
+    profile.write_text("Channel: 0\n")
+    cfg.NOISE_PROFILE = str(profile)
+
+    assert embedding_cache.get_key(audio_file) != key
+
+
+def test_key_ignores_name_and_thresholds(tmp_path, audio_file):
+    key = embedding_cache.get_key(audio_file)
+    copy = str(tmp_path / "renamed.wav")
+    shutil.copyfile(audio_file, copy)
+    cfg.MIN_CONFIDENCE = 0.9
+    cfg.SIGMOID_SENSITIVITY = 1.25
+    cfg.CUSTOM_CLASSIFIER = "checkpoints/bats/v1.0/BattyBirdNET-UK-256kHz.tflite"
+
+    assert embedding_cache.get_key(copy) == key
+
+
+def test_center_key_ignores_overlap(audio_file):
+    key = embedding_cache.get_key(audio_file, "center")
+    cfg.SIG_OVERLAP = 0.2
+
+    assert embedding_cache.get_key(audio_file, "center") == key
+
+
+def test_get_embeddings_computes_once(audio_file):
+    features = np.random.default_rng(5).random((7, 16), dtype="float32")
+    calls = []
+
+    def compute():
+        calls.append(1)
+
+        return features
+
+    computed = embedding_cache.get_embeddings(audio_file, compute)
+    cached = embedding_cache.get_embeddings(audio_file, compute)
+
+    assert len(calls) == 1
+    assert computed.dtype == np.float32
+    np.testing.assert_array_equal(computed, features)
+
+    # Memory-mapped with the data type of the cache
+    assert isinstance(cached, np.memmap)
+    assert cached.dtype == np.dtype(cfg.EMBEDDING_CACHE_DTYPE)
+    np.testing.assert_allclose(cached, features, atol=1e-3)
+
+    entries = embedding_cache.read_index()
+    assert list(entries) == [embedding_cache.get_key(audio_file)]
+    assert entries[embedding_cache.get_key(audio_file)]["shape"] == [7, 16]
+
+
+def test_empty_embeddings_are_not_cached(audio_file):
+    embedding_cache.get_embeddings(audio_file, lambda: np.zeros((0, 0), dtype="float32"))
+
+    assert embedding_cache.load(embedding_cache.get_key(audio_file)) is None
@@ -0,0 +1,110 @@
+"""Tests of the run manifest that lets batch runs skip completed files."""
+import os
+
+import pytest
+
+import config as cfg
+import manifest
+
+
+def is_done(path: str, fpath: str):
+    with manifest.Manifest(path) as run:
+        return run.is_done(fpath)
+
+
+@pytest.fixture
+def audio_file(tmp_path):
+    path = tmp_path / "recording.wav"
+    path.write_bytes(b"\0" * 1000)
+
+    return str(path)
+
+
+@pytest.mark.parametrize(
+    "name, value",
+    [
+        ("CUSTOM_CLASSIFIER", "checkpoints/bats/v1.0/BattyBirdNET-UK-256kHz.tflite"),
+        ("SIG_OVERLAP", 0.1),
+        ("SIGMOID_SENSITIVITY", 1.25),
+        ("SAMPLE_RATE", 384000),
+        ("MIN_CONFIDENCE", 0.9),
+        ("TOP_K", 3),
+        ("SPECIES_LIST", ["Myotis daubentonii_Daubenton's Bat"]),
+        ("RESULT_TYPE", "audacity"),
+        ("PRESCREEN_DB", 10.0),
+        ("NOISE_PROFILE", "checkpoints/bats/mic-noise/noise-audiomoth-1-2.prof"),
+    ],
+)
+def test_config_hash_changes_with_settings(name, value):
+    config_hash = manifest.get_config_hash()
+    setattr(cfg, name, value)
+
+    assert manifest.get_config_hash() != config_hash
+
+
+def test_config_hash_ignores_disabled_settings():
+    config_hash = manifest.get_config_hash()
+
+    # Only part of the hash if the pre-screen or the noise reduction is enabled
+    cfg.PRESCREEN_FMIN = 20000
+    cfg.NOISE_LEVEL = 0.9
+
+    assert manifest.get_config_hash() == config_hash
+
+
+def test_manifest_path(tmp_path):
+    assert manifest.get_manifest_path("out/Results.csv") == os.path.join("out", manifest.MANIFEST_NAME)
+    assert manifest.get_manifest_path("out") == os.path.join("out", manifest.MANIFEST_NAME)
+
+
+def test_completed_file_is_skipped_after_restart(tmp_path, audio_file):
+    path = str(tmp_path / manifest.MANIFEST_NAME)
+    result = tmp_path / "recording.bat.results.csv"
+    result.write_text("")
+
+    run = manifest.Manifest(path)
+    assert not run.is_done(audio_file)
+
+    run.add(audio_file, str(result))
+    assert run.is_done(audio_file)
+    run.close()
+
+    assert is_done(path, audio_file)
+
+
+def test_changed_file_or_settings_are_analyzed_again(tmp_path, audio_file):
+    path = str(tmp_path / manifest.MANIFEST_NAME)
+    run = manifest.Manifest(path)
+    run.add(audio_file)
+    run.close()
+
+    min_conf = cfg.MIN_CONFIDENCE
+    cfg.MIN_CONFIDENCE = 0.8
+    assert not is_done(path, audio_file)
+
+    cfg.MIN_CONFIDENCE = min_conf
+    assert is_done(path, audio_file)
+
+    stat = os.stat(audio_file)
+    os.utime(audio_file, (stat.st_atime, stat.st_mtime + 10))
+    assert not is_done(path, audio_file)
+
+
+def test_missing_result_file_is_analyzed_again(tmp_path, audio_file):
+    path = str(tmp_path / manifest.MANIFEST_NAME)
+    with manifest.Manifest(path) as run:
+        run.add(audio_file, str(tmp_path / "missing.csv"))
+
+        assert not run.is_done(audio_file)
+
+
+def test_truncated_line_is_ignored(tmp_path, audio_file):
+    path = str(tmp_path / manifest.MANIFEST_NAME)
+    run = manifest.Manifest(path)
+    run.add(audio_file)
+    run.close()
+
+    with open(path, "a") as f:
+        f.write('{"path": "other.wav", "si')
+
+    assert is_done(path, audio_file)
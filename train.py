@@ -3,29 +3,63 @@
 Can be used to train a custom classifier with new training data.
 """
 import argparse
+import itertools
+import math
 import os
+import time
+from multiprocessing import Pool, shared_memory
 
 import numpy as np
 
 import audio
 import config as cfg
+import embedding_cache
 import model
 import utils
 
 
+def _decodeTrainingFile(path: str):
+    """Loads the center segment of a training file.
+
+    Worker processes get the config from utils.initWorker().
+
+    Args:
+        path: Path to the audio file.
+
+    Returns:
+        The signal or None if the file could not be read.
+    """
+    try:
+        # Load audio
+        sig, rate = audio.openAudioFile(path, sample_rate=cfg.SAMPLE_RATE)
+
+        # Crop center segment
+        return audio.cropCenter(sig, rate, cfg.SIG_LENGTH).astype("float32")
+    except Exception as ex:
+        print(f"Error: Cannot open audio file {path}", flush=True)
+        utils.writeErrorLog(ex)
+
+        return None
+
+
 def _loadTrainingData():
     """Loads the data for training.
 
     Reads all subdirectories of "config.TRAIN_DATA_PATH" and uses their names as new labels.
 
     These directories should contain all the training data for each label.
+
+    Files are decoded in cfg.CPU_THREADS processes while the main process computes
+    the embeddings in batches of cfg.BATCH_SIZE. If cfg.EMBEDDING_CACHE_PATH is set,
+    embeddings of files that were seen before are read from the cache, so only new
+    or changed files are decoded.
     """
     # Get list of subfolders as labels
     labels = list(sorted(utils.list_subdirectories(cfg.TRAIN_DATA_PATH)))
 
-    # Load training data
-    x_train = []
-    y_train = []
+    # Training files and their label vectors
+    files = []
+    label_vectors = []
 
     for i, label in enumerate(labels):
         # Get label vector
@@ -47,33 +81,76 @@ def _loadTrainingData():
 
         # Get list of files
         # Filter files that start with '.' because macOS seems to them for temp files.
-        files = filter(
+        for f in filter(
             os.path.isfile,
             (
                 os.path.join(cfg.TRAIN_DATA_PATH, label, f)
                 for f in sorted(os.listdir(os.path.join(cfg.TRAIN_DATA_PATH, label)))
                 if not f.startswith(".") and f.rsplit(".", 1)[-1].lower() in cfg.ALLOWED_FILETYPES
             ),
-        )
+        ):
+            files.append(f)
+            label_vectors.append(label_vector)
+
+    # Get cached feature embeddings
+    features = [None] * len(files)
+    keys = {}
+
+    if cfg.EMBEDDING_CACHE_PATH:
+        for i, f in enumerate(files):
+            keys[i] = embedding_cache.get_key(f, "center")
+            cached = embedding_cache.load(keys[i])
+
+            if cached is not None:
+                features[i] = np.asarray(cached[0], dtype="float32")
+
+    missing = [i for i, e in enumerate(features) if e is None]
+
+    if cfg.EMBEDDING_CACHE_PATH:
+        print(f"Found {len(files) - len(missing)} of {len(files)} files in the embedding cache", flush=True)
+
+    def addEmbeddings(batch):
+        # Pass the batch of signals through model
+        e = model.embeddings(np.array([sig for _, sig in batch], dtype="float32"))
+
+        for (i, _), embeddings in zip(batch, e):
+            if cfg.EMBEDDING_CACHE_PATH:
+                embedding_cache.save(keys[i], embeddings[None], files[i], "center")
+
+            features[i] = np.asarray(embeddings, dtype="float32")
+
+    # Decode the remaining files in parallel and embed them in batches
+    items = [files[i] for i in missing]
+    pool = None
+
+    if cfg.CPU_THREADS > 1 and len(items) > 1:
+        pool = Pool(cfg.CPU_THREADS, initializer=utils.initWorker, initargs=(cfg.get_config(),))
+
+    signals = pool.imap(_decodeTrainingFile, items, chunksize=8) if pool else map(_decodeTrainingFile, items)
+    batch = []
 
-        # Load files
-        for f in files:
-            # Load audio
-            sig, rate = audio.openAudioFile(f, sample_rate=cfg.SAMPLE_RATE)
+    try:
+        for i, sig in zip(missing, signals):
+            if sig is None:
+                continue
 
-            # Crop center segment
-            sig = audio.cropCenter(sig, rate, cfg.SIG_LENGTH)
-            #print(f"Sig {sig.shape[0]} ", flush=True)
-            # Get feature embeddings
-            embeddings = model.embeddings([sig])[0]
+            batch.append((i, sig))
 
-            # Add to training data
-            x_train.append(embeddings)
-            y_train.append(label_vector)
+            if len(batch) >= cfg.BATCH_SIZE:
+                addEmbeddings(batch)
+                batch = []
 
-    # Convert to numpy arrays
-    x_train = np.array(x_train, dtype="float32")
-    y_train = np.array(y_train, dtype="float32")
+        if batch:
+            addEmbeddings(batch)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    # Convert to numpy arrays, without the files that could not be read
+    loaded = [i for i, e in enumerate(features) if e is not None]
+    x_train = np.array([features[i] for i in loaded], dtype="float32")
+    y_train = np.array([label_vectors[i] for i in loaded], dtype="float32")
 
     return x_train, y_train, labels
 
@@ -84,13 +161,38 @@ def trainModel(on_epoch_end=None):
         on_epoch_end: A callback function that takes two arguments `epoch`, `logs`.
 
     Returns:
-        A keras `History` object, whose `history` property contains all the metrics.
+        A keras `History` object, or an object with the same `history` property for the
+        NumPy engine, whose `history` property contains all the metrics.
     """
 
     print("Loading training data...", flush=True)
     x_train, y_train, labels = _loadTrainingData()
     print(f"...Done. Loaded {x_train.shape[0]} training samples and {y_train.shape[1]} labels.", flush=True)
 
+    # Train without TensorFlow
+    if cfg.TRAIN_ENGINE == "numpy":
+        # NumPy classifiers are saved as .npz
+        model_path = cfg.CUSTOM_CLASSIFIER.rsplit(".", 1)[0] + ".npz"
+
+        print("Training model...", flush=True)
+        layers, history = model.trainLinearHead(
+            x_train,
+            y_train,
+            cfg.TRAIN_HIDDEN_UNITS,
+            epochs=cfg.TRAIN_EPOCHS,
+            batch_size=cfg.TRAIN_BATCH_SIZE,
+            learning_rate=cfg.TRAIN_LEARNING_RATE,
+            on_epoch_end=on_epoch_end
+        )
+
+        # Best validation precision (at minimum validation loss)
+        best_val_prec = history.history["val_prec"][np.argmin(history.history["val_loss"])]
+
+        model.saveLinearHeadClassifier(layers, model_path, labels)
+        print(f"...Done. Best top-1 precision: {best_val_prec}. Saved to {model_path}", flush=True)
+
+        return history
+
     # Build model
     print("Building model...", flush=True)
     classifier = model.buildLinearClassifier(y_train.shape[1], x_train.shape[1], cfg.TRAIN_HIDDEN_UNITS)
@@ -127,6 +229,185 @@ def trainModel(on_epoch_end=None):
 
 
 
+# Training data of a sweep worker, attached to the shared memory of the main process
+SWEEP_DATA = {}
+
+
+def _initSweepWorker(shm_name: str, shape: tuple, y_train, config: dict):
+    """Initializes a sweep worker.
+
+    Args:
+        shm_name: Name of the shared memory with the samples.
+        shape: Shape of the samples.
+        y_train: Labels.
+        config: The config of the main process.
+    """
+    cfg.set_config(config)
+
+    # Keep a reference, the array is only valid as long as the shared memory is open
+    SWEEP_DATA["shm"] = shared_memory.SharedMemory(name=shm_name)
+    SWEEP_DATA["x"] = np.ndarray(shape, dtype="float32", buffer=SWEEP_DATA["shm"].buf)
+    SWEEP_DATA["y"] = y_train
+
+
+def _getFolds(y_train, folds: int):
+    """Assigns the samples to folds, stratified by label.
+
+    Args:
+        y_train: Labels.
+        folds: Number of folds.
+
+    Returns:
+        The fold of every sample.
+    """
+    rng = np.random.default_rng(cfg.RANDOM_SEED)
+
+    # Samples without a label (noise) are a class of their own
+    key = np.where(y_train.any(axis=1), y_train.argmax(axis=1), -1)
+    order = rng.permutation(len(key))
+    order = order[np.argsort(key[order], kind="stable")]
+    fold_of = np.empty(len(key), dtype="int64")
+    fold_of[order] = np.arange(len(key)) % folds
+
+    return fold_of
+
+
+def _trainFold(job):
+    """Trains one configuration on all but one fold and evaluates it on that fold.
+
+    Args:
+        job: (configuration index, configuration, fold, number of folds)
+
+    Returns:
+        (configuration index, true positives, false positives, false negatives per label, seconds, epochs,
+        wall clock start and end)
+    """
+    index, config, fold, folds = job
+    x, y = SWEEP_DATA["x"], SWEEP_DATA["y"]
+    test = _getFolds(y, folds) == fold
+
+    started = time.time()
+    start = time.perf_counter()
+    layers, history = model.trainLinearHead(
+        x[~test],
+        y[~test],
+        config["hidden_units"],
+        epochs=cfg.TRAIN_EPOCHS,
+        batch_size=config["batch_size"],
+        learning_rate=config["learning_rate"],
+        verbose=False,
+    )
+    seconds = time.perf_counter() - start
+
+    # Detections at the minimum confidence
+    detected = model.flat_sigmoid(model._applyLinearHead(x[test], layers)) >= cfg.MIN_CONFIDENCE
+    truth = y[test] > 0
+
+    return (
+        index,
+        (detected & truth).sum(axis=0),
+        (detected & ~truth).sum(axis=0),
+        (~detected & truth).sum(axis=0),
+        seconds,
+        len(history.history["loss"]),
+        (started, time.time()),
+    )
+
+
+def sweepModel(configs: list[dict], folds: int = 5):
+    """Evaluates classifier configurations with k-fold cross-validation.
+
+    The training data is loaded once and shared with the workers through
+    shared memory. The folds of all configurations are trained in parallel
+    in cfg.CPU_THREADS processes with the NumPy engine.
+
+    Args:
+        configs: List of dicts with hidden_units, learning_rate and batch_size.
+        folds: Number of folds.
+
+    Returns:
+        A list with a dict per configuration with the configuration, the precision
+        and recall per label, their means and the training time.
+    """
+    print("Loading training data...", flush=True)
+    x_train, y_train, labels = _loadTrainingData()
+    print(f"...Done. Loaded {x_train.shape[0]} training samples and {y_train.shape[1]} labels.", flush=True)
+
+    folds = max(2, min(folds, x_train.shape[0]))
+    jobs = [(i, config, fold, folds) for i, config in enumerate(configs) for fold in range(folds)]
+    results = [
+        {"tp": 0, "fp": 0, "fn": 0, "seconds": 0.0, "epochs": 0, "started": math.inf, "finished": 0.0}
+        for _ in configs
+    ]
+
+    shm = shared_memory.SharedMemory(create=True, size=max(1, x_train.nbytes))
+
+    try:
+        np.ndarray(x_train.shape, dtype="float32", buffer=shm.buf)[:] = x_train
+        initargs = (shm.name, x_train.shape, y_train, cfg.get_config())
+
+        print(f"Training {len(configs)} configurations with {folds} folds...", flush=True)
+
+        with Pool(cfg.CPU_THREADS, initializer=_initSweepWorker, initargs=initargs) as p:
+            for index, tp, fp, fn, seconds, epochs, (started, finished) in p.imap_unordered(_trainFold, jobs):
+                result = results[index]
+                result["tp"] += tp
+                result["fp"] += fp
+                result["fn"] += fn
+                result["seconds"] += seconds
+                result["epochs"] += epochs
+                # From the start of the first fold to the end of the last fold of the configuration
+                result["started"] = min(result["started"], started)
+                result["finished"] = max(result["finished"], finished)
+    finally:
+        shm.close()
+        shm.unlink()
+
+    report = []
+
+    for config, result in zip(configs, results):
+        precision = result["tp"] / np.maximum(1, result["tp"] + result["fp"])
+        recall = result["tp"] / np.maximum(1, result["tp"] + result["fn"])
+
+        # Labels without positive samples, like noise, are not part of the means
+        has_samples = (result["tp"] + result["fn"]) > 0
+
+        report.append(
+            {
+                **config,
+                "precision": dict(zip(labels, precision.tolist())),
+                "recall": dict(zip(labels, recall.tolist())),
+                "mean_precision": float(precision[has_samples].mean()) if has_samples.any() else 0.0,
+                "mean_recall": float(recall[has_samples].mean()) if has_samples.any() else 0.0,
+                "train_seconds": result["seconds"],
+                "wall_seconds": max(0.0, result["finished"] - result["started"]),
+                "epochs": result["epochs"] / folds,
+            }
+        )
+
+    return report
+
+
+def saveSweepReport(report: list[dict], path: str):
+    """Saves the results of a sweep as CSV, one row per configuration and label.
+
+    Args:
+        report: The results of sweepModel().
+        path: Path of the CSV file.
+    """
+    with open(path, "w") as f:
+        f.write("Hidden units,Learning rate,Batch size,Label,Precision,Recall,Train time (s),Wall time (s),Epochs\n")
+
+        for r in report:
+            for label in r["precision"]:
+                f.write(
+                    "{},{},{},{},{:.4f},{:.4f},{:.2f},{:.2f},{:.1f}\n".format(
+                        r["hidden_units"], r["learning_rate"], r["batch_size"], label, r["precision"][label],
+                        r["recall"][label], r["train_seconds"], r["wall_seconds"], r["epochs"],
+                    )
+                )
+
+
 if __name__ == "__main__":
     # Parse arguments
     parser = argparse.ArgumentParser(description="Train a custom classifier with BirdNET")
@@ -143,6 +424,38 @@ if __name__ == "__main__":
         default=0,
         help="Number of hidden units. Defaults to 0. If set to >0, a two-layer classifier is used.",
     )
+    parser.add_argument(
+        "--engine",
+        default="keras",
+        help="Training engine. Values in ['keras', 'numpy']. 'numpy' trains without TensorFlow and saves the "
+        "classifier as .npz next to --o, which can be used like a .tflite classifier. Defaults to 'keras'.",
+    )
+    parser.add_argument(
+        "--embedding_cache",
+        default="",
+        help="Path to a folder to cache the embeddings of the training files in, retraining only embeds new "
+        "or changed files. Defaults to '' (off).",
+    )
+    parser.add_argument(
+        "--sweep",
+        action="store_true",
+        help="Evaluate all combinations of --sweep_hidden_units, --sweep_learning_rates and --sweep_batch_sizes "
+        "with k-fold cross-validation instead of training a classifier. Uses the NumPy engine.",
+    )
+    parser.add_argument("--sweep_hidden_units", default="0,128,512", help="Comma separated hidden units to sweep.")
+    parser.add_argument("--sweep_learning_rates", default="0.001,0.01", help="Comma separated learning rates to sweep.")
+    parser.add_argument("--sweep_batch_sizes", default="32,128", help="Comma separated batch sizes to sweep.")
+    parser.add_argument("--folds", type=int, default=5, help="Number of cross-validation folds. Defaults to 5.")
+    parser.add_argument(
+        "--min_conf", type=float, default=0.5, help="Confidence at which a sweep counts a detection. Defaults to 0.5."
+    )
+    parser.add_argument("--threads", type=int, default=4, help="Number of CPU threads to decode files. Defaults to 4.")
+    parser.add_argument(
+        "--embedding_batchsize",
+        type=int,
+        default=32,
+        help="Number of files passed through the main net at the same time. Defaults to 32.",
+    )
 
     args = parser.parse_args()
 
@@ -153,6 +466,35 @@ if __name__ == "__main__":
     cfg.TRAIN_BATCH_SIZE = args.batch_size
     cfg.TRAIN_LEARNING_RATE = args.learning_rate
     cfg.TRAIN_HIDDEN_UNITS = args.hidden_units
-
-    # Train model
-    trainModel()
+    cfg.TRAIN_ENGINE = "numpy" if args.engine == "numpy" else "keras"
+    cfg.EMBEDDING_CACHE_PATH = args.embedding_cache
+    cfg.CPU_THREADS = max(1, int(args.threads))
+    cfg.BATCH_SIZE = max(1, int(args.embedding_batchsize))
+
+    if args.sweep:
+        cfg.MIN_CONFIDENCE = max(0.01, min(0.99, float(args.min_conf)))
+        configs = [
+            {"hidden_units": int(h), "learning_rate": float(lr), "batch_size": int(b)}
+            for h, lr, b in itertools.product(
+                args.sweep_hidden_units.split(","), args.sweep_learning_rates.split(","), args.sweep_batch_sizes.split(",")
+            )
+        ]
+        report = sweepModel(configs, args.folds)
+        report_path = cfg.CUSTOM_CLASSIFIER.rsplit(".", 1)[0] + "_Sweep.csv"
+
+        if os.path.dirname(report_path):
+            os.makedirs(os.path.dirname(report_path), exist_ok=True)
+
+        saveSweepReport(report, report_path)
+
+        print("Hidden units,Learning rate,Batch size,Mean precision,Mean recall,Train time (s),Wall time (s)")
+
+        for r in sorted(report, key=lambda r: r["mean_precision"] + r["mean_recall"], reverse=True):
+            print("{},{},{},{:.4f},{:.4f},{:.2f},{:.2f}".format(
+                r["hidden_units"], r["learning_rate"], r["batch_size"], r["mean_precision"], r["mean_recall"],
+                r["train_seconds"], r["wall_seconds"]))
+
+        print(f"Saved per-label results to {report_path}")
+    else:
+        # Train model
+        trainModel()
@@ -1,5 +1,6 @@
 """Module containing common function.
 """
+import hashlib
 import os
 import traceback
 from pathlib import Path
@@ -42,6 +43,50 @@ def readLines(path: str):
     return Path(path).read_text(encoding="utf-8").splitlines() if path else []
 
 
+def contentHash(path: str, block_size: int = 1 << 20):
+    """Computes the hash of a file's content.
+
+    Identifies a recording independent of its path and modification time.
+
+    Args:
+        path: Path to the file.
+        block_size: Number of bytes read at a time.
+
+    Returns:
+        The hex digest of the BLAKE2b hash of the content.
+    """
+    h = hashlib.blake2b(digest_size=20)
+
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+
+    return h.hexdigest()
+
+
+def writeFileAtomic(path: str, text: str):
+    """Writes a text file so that it either exists completely or not at all.
+
+    The text is written to a temporary file next to the target, which then replaces the target.
+
+    Args:
+        path: Path to the file.
+        text: The content.
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
 def list_subdirectories(path: str):
     """Lists all directories inside a path.
 
@@ -75,3 +120,32 @@ def writeErrorLog(ex: Exception):
     """
     with open(cfg.ERROR_LOG_FILE, "a") as elog:
         elog.write("".join(traceback.TracebackException.from_exception(ex).format()) + "\n")
+
+
+def initWorker(config: dict):
+    """Restores the config in a worker process.
+
+    Used as initializer of process pools, so the config is sent to every
+    worker once instead of with every file. Needed where processes are
+    spawned instead of forked (Windows, macOS).
+
+    Args:
+        config: The config of the main process, see config.get_config().
+    """
+    cfg.set_config(config)
+
+
+def getChunksize(n_items: int, n_workers: int):
+    """Returns the number of items sent to a pool worker at a time.
+
+    About four chunks per worker keep the inter-process overhead low for
+    large file lists, while the last chunks still balance the load.
+
+    Args:
+        n_items: Number of items, e.g. files.
+        n_workers: Number of worker processes.
+
+    Returns:
+        The chunksize for Pool.imap_unordered().
+    """
+    return max(1, min(64, n_items // (4 * max(1, n_workers))))